@@ -83,10 +83,10 @@ class MetapackDocumentUrl(Url, _MetapackUrl):
 
     @property
     def doc(self):
-        """Return the metatab document for the URL"""
-        from metapack import MetapackDoc
+        """Return the metatab document for the URL, shared through the document registry"""
+        from metapack.registry import DocumentRegistry
         t = self.get_resource().get_target()
-        return MetapackDoc(t, package_url=self.package_url)
+        return DocumentRegistry.get_instance().get(self, ref=t)
 
     @property
     def generator(self):
@@ -0,0 +1,96 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Streaming and memory-mapped access to resource target files.
+
+Resource.readlines() reads a whole file into a list of strings. The functions
+here let a resource be read a line at a time, or mapped into memory, so the
+operating system pages it in as it is read. Compressed files are recognized
+by their first bytes, and are decompressed as they are read.
+"""
+
+import mmap
+
+from metapack.exc import ResourceError
+
+# Leading bytes of compressed files, and the name of the compression
+MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+
+def compression(path):
+    """Return the name of the compression of a file, 'gzip', 'bz2', 'xz' or 'zstd', or None if it is
+    not compressed"""
+
+    with open(path, 'rb') as f:
+        head = f.read(6)
+
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+
+    return None
+
+
+def open_binary(path, decompress=True):
+    """Open a file for reading bytes. If decompress is True and the file is compressed, the returned
+    file decompresses it as it is read. zstd requires the zstandard package."""
+
+    kind = compression(path) if decompress else None
+
+    if kind == 'gzip':
+        import gzip
+        return gzip.open(path, 'rb')
+    elif kind == 'bz2':
+        import bz2
+        return bz2.open(path, 'rb')
+    elif kind == 'xz':
+        import lzma
+        return lzma.open(path, 'rb')
+    elif kind == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ResourceError("File '{}' is zstd compressed; install the zstandard package to read it"
+                                .format(path))
+
+        import io
+
+        f = open(path, 'rb')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+    else:
+        return open(path, 'rb')
+
+
+def iter_lines(path, encoding='utf8', binary=False, decompress=True):
+    """Yield the lines of a file, with their line endings, as readlines() would return them, without
+    reading the whole file. Lines are bytes if binary is True, or strings decoded with encoding and with
+    universal newlines otherwise."""
+    import io
+
+    with open_binary(path, decompress) as f:
+        if binary:
+            yield from f
+        else:
+            yield from io.TextIOWrapper(f, encoding=encoding)
+
+
+def map_file(path):
+    """Return a read-only mmap of a file. It supports the buffer protocol, so memoryview() and
+    numpy.frombuffer() use it without copying, and it is a context manager that unmaps the file. Empty
+    files, which can't be mapped, return an empty bytes"""
+
+    if compression(path):
+        raise ResourceError("Can't memory map '{}', which is compressed; use iterlines() to read it"
+                            .format(path))
+
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            return memoryview(b'')
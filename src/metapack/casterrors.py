@@ -0,0 +1,224 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Compact accounting of casting errors.
+
+By default, the row processors record each failed cast as a formatted message
+in a set per column, and raise TooManyCastingErrors when there are more than
+50. On a dirty source, the messages cost string formatting and a count over
+all columns for every bad cell, and the iteration stops. An ErrorSummary
+records failed casts as a count per column, a bounded random sample of the
+bad values and the numbers of the first rows with errors, and never raises,
+so the failed values just become None.
+
+The cast functions in this module have the same results as the rowgenerators
+cast_* functions, but record failures in an ErrorSummary. Compiled row
+processors use them when they are given an ErrorSummary for their errors.
+"""
+
+import random
+
+from rowgenerators.valuetype.core import FailedValue
+
+DEFAULT_MAX_SAMPLES = 10  # Size of the reservoir of bad values, per column
+DEFAULT_MAX_ROWS = 10  # Number of row numbers to record, per column
+
+
+class ColumnErrors(object):
+    """Casting errors for one column"""
+
+    __slots__ = ('count', 'samples', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+        self.rows = []
+
+    def to_dict(self):
+        return dict(count=self.count, samples=list(self.samples), rows=list(self.rows))
+
+    def __repr__(self):
+        return '<ColumnErrors count={} samples={} rows={}>'.format(self.count, self.samples, self.rows)
+
+
+class ErrorSummary(object):
+    """Casting errors for all of the columns of a resource. For each column, it has the number of
+    failed casts, a reservoir sample of up to max_samples of the values that failed, and the numbers of the
+    first max_rows rows with a failure.
+
+    Iterating over the summary, or calling keys(), returns the names of the columns with errors, and
+    indexing it with a column name returns a ColumnErrors. """
+
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES, max_rows=DEFAULT_MAX_ROWS, seed=None):
+        self.max_samples = max_samples
+        self.max_rows = max_rows
+        self.columns = {}
+        self._random = random.Random(seed)
+
+    def add(self, header, value, row_n=None):
+        """Record a value that failed to cast in a column"""
+
+        try:
+            c = self.columns[header]
+        except KeyError:
+            c = self.columns[header] = ColumnErrors()
+
+        c.count += 1
+
+        # Reservoir sampling, so the samples are uniform over all of the failed values
+        if len(c.samples) < self.max_samples:
+            c.samples.append(value)
+        else:
+            i = self._random.randrange(c.count)
+            if i < self.max_samples:
+                c.samples[i] = value
+
+        if row_n is not None and len(c.rows) < self.max_rows:
+            c.rows.append(row_n)
+
+    def add_many(self, header, values, row_numbers=None):
+        """Record several values that failed to cast in a column, with their row numbers"""
+
+        if row_numbers is None:
+            row_numbers = [None] * len(values)
+
+        for v, row_n in zip(values, row_numbers):
+            self.add(header, v, row_n)
+
+    def merge(self, other):
+        """Add the errors from another ErrorSummary, such as one from a worker process. The counts are
+        exact; the samples are a random selection from the samples of both, weighted by their counts"""
+
+        for header, o in other.columns.items():
+
+            c = self.columns.get(header)
+
+            if c is None:
+                c = self.columns[header] = ColumnErrors()
+
+            # Each sample stands for count / len(samples) failed values on its side
+            pool = ([(v, c.count / len(c.samples)) for v in c.samples] +
+                    [(v, o.count / len(o.samples)) for v in o.samples])
+
+            if len(pool) > self.max_samples:
+                # Weighted sampling without replacement, so each side is represented in proportion to its count
+                pool = sorted(pool, key=lambda e: self._random.random() ** (1.0 / e[1]), reverse=True)
+                pool = pool[:self.max_samples]
+
+            c.samples = [v for v, _ in pool]
+            c.rows = sorted(c.rows + o.rows)[:self.max_rows]
+            c.count += o.count
+
+    def clear(self):
+        self.columns.clear()
+
+    @property
+    def total(self):
+        """Total number of failed casts"""
+        return sum(c.count for c in self.columns.values())
+
+    def keys(self):
+        return self.columns.keys()
+
+    def items(self):
+        return self.columns.items()
+
+    def __getitem__(self, header):
+        return self.columns[header]
+
+    def __contains__(self, header):
+        return header in self.columns
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __bool__(self):
+        return bool(self.columns)
+
+    def to_dict(self):
+        """Return the summary as a dict of column names to dicts of the count, samples and row numbers"""
+        return {k: c.to_dict() for k, c in self.columns.items()}
+
+    def messages(self):
+        """Return a dict of column names to lists of messages, like the errors dict of a row processor"""
+
+        return {k: ["{} values failed to cast, in rows {}{}; for instance: {}"
+                    .format(c.count, ', '.join(str(e) for e in c.rows), ', ...' if c.count > len(c.rows) else '',
+                            ', '.join(repr(e) for e in c.samples))]
+                for k, c in self.columns.items()}
+
+    def __getstate__(self):
+        return dict(max_samples=self.max_samples, max_rows=self.max_rows, columns=self.to_dict())
+
+    def __setstate__(self, state):
+        self.__init__(state['max_samples'], state['max_rows'])
+
+        for k, d in state['columns'].items():
+            c = self.columns[k] = ColumnErrors()
+            c.count, c.samples, c.rows = d['count'], d['samples'], d['rows']
+
+    def __repr__(self):
+        return '<ErrorSummary {}>'.format(', '.join('{}: {}'.format(k, c.count) for k, c in self.columns.items()))
+
+
+def cast_int(v, header_d, summary, row_n=None):
+    if isinstance(v, FailedValue):
+        summary.add(header_d, str(v), row_n)
+        return None
+
+    if v != 0 and not bool(v):
+        return None
+
+    try:
+        return int(v)
+    except (TypeError, ValueError, OverflowError):
+        summary.add(header_d, v, row_n)
+        return None
+
+
+def cast_float(v, header_d, summary, row_n=None):
+    if isinstance(v, FailedValue):
+        summary.add(header_d, str(v), row_n)
+        return None
+
+    if v != 0 and not bool(v):
+        return None
+
+    try:
+        return float(v)
+    except (TypeError, ValueError, OverflowError):
+        summary.add(header_d, v, row_n)
+        return None
+
+
+def cast_str(v, header_d, summary, row_n=None):
+    if isinstance(v, FailedValue):  # The row processor records these, but still returns the string
+        summary.add(header_d, str(v), row_n)
+
+    if v != 0 and not bool(v):
+        return None
+
+    try:
+        return str(v)
+    except Exception:
+        summary.add(header_d, repr(v), row_n)
+        return None
+
+
+def cast_other(cast, v, header_d, summary, row_n=None):
+    """Run one of the other rowgenerators cast functions, which records errors as messages, and record any
+    failure in the summary"""
+    from collections import defaultdict
+
+    errors = defaultdict(set)
+
+    v_out = cast(v, header_d, errors)
+
+    if errors:
+        summary.add(header_d, str(v), row_n)
+
+    return v_out
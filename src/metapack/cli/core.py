@@ -107,6 +107,17 @@ def dump_resources(doc):
         prt(r.name, r.resolved_url)
 
 
+def dump_error_summary(summary, name):
+    """Write a table of the casting errors in an ErrorSummary to the error log, so it doesn't mix with rows
+    written to stdout"""
+
+    rows = [[col, c.count, ', '.join(str(e) for e in c.rows), ', '.join(repr(e) for e in c.samples)]
+            for col, c in summary.items()]
+
+    warn("Casting errors in resource '{}': {} values in {} columns".format(name, summary.total, len(summary)))
+    logger_err.warning(tabulate(rows, headers='Column Errors Rows Samples'.split()))
+
+
 def dump_resource(doc, name, lines=None):
     import unicodecsv as csv
     import sys
@@ -114,6 +125,8 @@ def dump_resource(doc, name, lines=None):
     from tabulate import tabulate
     from rowgenerators.rowpipe.exceptions import CasterExceptionError, TooManyCastingErrors
 
+    from metapack.casterrors import ErrorSummary
+
     r = doc.resource(name=name)
 
     if not r:
@@ -126,6 +139,11 @@ def dump_resource(doc, name, lines=None):
     gen = islice(r, 1, lines)
 
     def dump_errors(error_set):
+        if isinstance(error_set, ErrorSummary):
+            if error_set:
+                dump_error_summary(error_set, r.name)
+            return
+
         for col, errors in error_set.items():
             warn("Errors in casting column '{}' in resource '{}' ".format(col, r.name))
             for error in errors:
@@ -82,7 +82,7 @@ def walk_packages(args, u):
     # Try all files as packages
     if not isdir(u.path):
         try:
-            yield open_package(u.path)
+            yield open_package(u.path, lazy=True)
         except (RowGeneratorError, MetatabFileNotFound):
             pass
 
@@ -91,7 +91,7 @@ def walk_packages(args, u):
     for root, dirs, files in walk(u.path):
 
         try:
-            p = open_package(root)
+            p = open_package(root, lazy=True)
 
             # This was a package, so only recurse if it is a source package and has a _packages dir
 
@@ -115,7 +115,7 @@ def walk_packages(args, u):
             if not islink(join(root, f)):
                 try:
 
-                    p = open_package(join(root, f))
+                    p = open_package(join(root, f), lazy=True)
                     if str(p.ref) not in seen:
                         yield p
                     seen.add(str(p.ref))
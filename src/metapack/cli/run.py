@@ -15,8 +15,16 @@ from tabulate import tabulate
 from terminaltables import GithubFlavoredMarkdownTable, SingleTable
 
 from metapack import Downloader
-from metapack.cli.core import MetapackCliMemo, err, list_rr, prt
+from metapack.cli.core import (
+    MetapackCliMemo,
+    dump_error_summary,
+    err,
+    list_rr,
+    prt,
+    warn
+)
 from metapack.exc import MetatabFileNotFound
+from metapack.prefetch import DEFAULT_WORKERS
 from metapack.util import get_materialized_data_cache
 
 downloader = Downloader.get_instance()
@@ -95,18 +103,36 @@ def run(subparsers):
     output_group.add_argument('-N', '--number', action='store_true', help="Add line numbers as the first column")
     output_group.add_argument('-n', '--no-schema', action='store_true', help="Don't use the schema to tansform the "
                                                                              "data ")
+    output_group.add_argument('-e', '--error-summary', action='store_true',
+                              help="Count casting errors per column, rather than stopping after too many errors, "
+                                   "and write a summary of them to stderr when all rows have been read. Can't be "
+                                   "used with -L, -T or -S")
+    output_group.add_argument('--fast-json', action='store_true',
+                              help="With -j, encode JSON lines with orjson, if it is installed. The output is compact "
+                                   "and not ASCII escaped")
+    output_group.add_argument('--prefetch', action='store_true',
+                              help="Before running, download the remote files of all of the package's resources and "
+                                   "references into the cache, several at a time")
+    output_group.add_argument('--prefetch-workers', type=int, default=DEFAULT_WORKERS, metavar='N',
+                              help="Number of concurrent downloads for --prefetch. Default {}".format(DEFAULT_WORKERS))
 
     parser.set_defaults(handler=None)
 
 
 def run_run(args):
 
+    if args.error_summary and (args.limit or args.table or args.sample):
+        err("-e/--error-summary is written after all rows have been read, so it can't be used with "
+            "-L/--limit, -T/--table or -S/--sample, which only read some of the rows")
+
     m = MetapackCliMemo(args, downloader)
 
     r = m.get_resource()
 
     if m.args.no_schema:
         r = r.row_generator
+    elif r and m.args.error_summary:
+        r.summarize_errors = True
 
     try:
         doc = m.doc
@@ -116,6 +142,11 @@ def run_run(args):
     # Remove any data that may have been cached , for instance, from Jupyter notebooks
     shutil.rmtree(get_materialized_data_cache(doc), ignore_errors=True)
 
+    if m.args.prefetch:
+        for url, result in doc.prefetch(workers=m.args.prefetch_workers).items():
+            if isinstance(result, Exception):
+                warn("Failed to prefetch '{}': {}".format(url, result))
+
     if not r:
         prt('Select a resource to run:')
         list_rr(doc)
@@ -213,8 +244,8 @@ def run_run(args):
             gen_wrap = partial(add_number, gen_wrap)
 
         if m.args.json:
-            for i,j in enumerate(gen_wrap(r.iterjson())):
-                print(j)
+            from metapack.jsonstruct import write_ndjson
+            write_ndjson(gen_wrap(r.iterstruct), sys.stdout, fast=m.args.fast_json)
 
         elif m.args.yaml:
             for i,j in enumerate(gen_wrap(r.iteryaml())):
@@ -229,3 +260,6 @@ def run_run(args):
             w = csv.writer(sys.stdout)
             for i,j in enumerate(gen_wrap(r)):
                 w.writerow(j)
+
+    if m.args.error_summary and getattr(r, 'errors', None):
+        dump_error_summary(r.errors, r.name)
@@ -0,0 +1,375 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Compiled row processing functions.
+
+The rowgenerators RowProcessor generates one function per column per stage,
+calls each of them for every cell through a row function for the stage, and
+gives transforms a RowProxy of the row, so each cell costs several function
+calls and attribute lookups. This module generates a single function for a
+whole row processor table, which processes a list of rows in one loop. The
+casts and transforms of every column are inlined, values are held in local
+variables between stages, and references to other columns in a transform,
+such as ``row.value`` or ``row['value']``, are rewritten to read those local
+variables. A RowProxy is only built for stages with transforms that use the
+row some other way.
+
+The per-column code comes from the rowgenerators code generator, so
+transforms have the same meaning as they have in a RowProcessor. The
+generated code is cached on disk, keyed by the source headers, the table and
+the transform environment.
+"""
+
+import ast
+import hashlib
+import re
+from os import replace
+from os.path import exists, splitext
+
+from metapack.util import temp_path
+
+# Change this when the generated code changes, to invalidate cached code
+CODEGEN_VERSION = 1
+
+file_header = """
+# Row processing function generated by metapack.codegen
+import sys
+from rowgenerators.rowproxy import RowProxy
+from rowgenerators.valuetype import resolve_value_type
+from rowgenerators.rowpipe.exceptions import CasterExceptionError, RowProcessorError
+"""
+
+summary_header = """from metapack.casterrors import cast_int as summary_cast_int, cast_float as summary_cast_float
+from metapack.casterrors import cast_str as summary_cast_str, cast_other as summary_cast_other
+"""
+
+function_template = """
+
+def process_rows(rows, row_numbers, errors, scratch, accumulator, pipe, manager, source):
+
+    source_proxy = RowProxy({source_headers})
+    dest_proxy = RowProxy({dest_headers})
+
+    out = []
+    append = out.append
+
+    for row_n, src_row in zip(row_numbers, rows):
+        try:
+{body}
+
+            append([
+{result}
+            ])
+
+        except Exception as e:
+            raise RowProcessorError("Exception at source ({{}}) row {{}}: {{}}".format(type(source), row_n, str(e))) from e
+
+    return out
+"""
+
+column_template = """# {header_d}, stage {stage}
+v = {v}
+try:
+{try_lines}
+except Exception as exc:
+{exception}
+{var} = v
+"""
+
+
+class RowReferences(ast.NodeTransformer):
+    """Rewrite references to the values of a row in transform code. ``row.name``, ``row['name']``
+    and ``row[n]`` become the expressions in ``columns``, and the per-column names that the rowgenerators
+    code generator uses become constants. Any other use of ``row`` is left alone, and sets ``uses_row``"""
+
+    def __init__(self, headers, columns, constants):
+        super().__init__()
+
+        self.positions = {h: i for i, h in enumerate(headers)}
+        self.columns = columns
+        self.constants = constants
+        self.referenced = set()
+        self.uses_row = False
+
+    def _column(self, node, key):
+
+        i = key if isinstance(key, int) else self.positions.get(key)
+
+        if i is None or not (0 <= i < len(self.columns)):
+            return self.generic_visit(node)
+
+        self.referenced.add(i)
+
+        return ast.copy_location(ast.parse(self.columns[i], mode='eval').body, node)
+
+    def visit_Attribute(self, node):
+
+        if isinstance(node.value, ast.Name) and node.value.id == 'row' and isinstance(node.ctx, ast.Load):
+            return self._column(node, node.attr)
+
+        return self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+
+        key = node.slice.value if isinstance(node.slice, ast.Index) else node.slice  # Index is Python < 3.9
+
+        if (isinstance(node.value, ast.Name) and node.value.id == 'row' and isinstance(node.ctx, ast.Load)
+                and isinstance(key, ast.Constant) and isinstance(key.value, (str, int))
+                and not isinstance(key.value, bool)):
+            return self._column(node, key.value)
+
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+
+        if node.id == 'row':
+            self.uses_row = True
+        elif node.id in self.constants and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Constant(self.constants[node.id]), node)
+
+        return node
+
+
+def _unparse(tree):
+    try:
+        return ast.unparse(tree)
+    except AttributeError:  # Python < 3.9
+        import meta
+        return meta.dump_python_source(tree).strip()
+
+
+def _rewrite(lines, headers, columns, constants):
+    """Rewrite lines of generated column code, returning the new lines, the positions of the columns the
+    code refers to, and whether the code uses the row in a way that requires a RowProxy"""
+
+    v = RowReferences(headers, columns, constants)
+
+    out = [_unparse(ast.fix_missing_locations(v.visit(ast.parse(l.strip())))) for l in lines]
+
+    return out, v.referenced, v.uses_row
+
+
+def _indent(lines, n):
+    return '\n'.join((' ' * n) + l if l else l for l in '\n'.join(lines).splitlines())
+
+
+def _column_stack(env, stage, segment):
+    from rowgenerators.rowpipe.codegen import make_stack
+
+    preamble, try_lines, exception, _ = make_stack(env, stage, segment)
+
+    return preamble, try_lines, exception
+
+
+def transform_env(env=None):
+    """Return the environment that transform code is generated and run in: the rowgenerators
+    execution context, updated with env"""
+    from rowgenerators.rowpipe.codegen import exec_context
+
+    exec_env = exec_context()
+    exec_env.update(env or {})
+
+    return exec_env
+
+
+def table_references(dest_table, env):
+    """Return the names of the columns of a row processor table that transforms after the first stage
+    refer to, or None if any transform uses the whole row, as transform functions that take a ``row``
+    argument do."""
+
+    headers = list(dest_table.headers)
+    names = ['c_{}'.format(i) for i in range(len(headers))]
+
+    referenced = set()
+
+    for stage, segments in enumerate(dest_table.stage_transforms):
+
+        if stage == 0:
+            continue
+
+        for segment in segments:
+            _, try_lines, exception = _column_stack(env, stage, segment)
+
+            _, refs, uses_row = _rewrite(try_lines + ([exception] if exception else []), headers, names, {})
+
+            if uses_row:
+                return None
+
+            referenced |= refs
+
+    return {headers[i] for i in referenced}
+
+
+def make_row_function(source_headers, dest_table, env, summary=False):
+    """Return the code for a module that defines a ``process_rows`` function, which applies all of the casts
+    and transforms of a row processor table to a list of rows. It is called as::
+
+        process_rows(rows, row_numbers, errors, scratch, accumulator, pipe, manager, source)
+
+    and returns a list of the processed rows. Casting errors are added to the errors dict, or, if
+    summary is True, errors must be a metapack.casterrors.ErrorSummary, and failed casts are recorded
+    in it without raising TooManyCastingErrors.
+
+    :param source_headers: Headers of the source rows
+    :param dest_table: A rowgenerators.rowpipe.Table
+    :param env: The transform environment, as for a RowProcessor
+    :param summary: If True, record casting errors in an ErrorSummary
+    """
+
+    source_headers = list(source_headers)
+    dest_headers = list(dest_table.headers)
+    table_name = re.sub(r'[^\w]+', '_', dest_table.name or 'table')
+
+    preamble = []
+    body = []
+
+    # The expression for the current value of each column. Before the first stage, there are no
+    # values yet; first stage transforms read from the source row
+    current = None
+
+    for stage, segments in enumerate(dest_table.stage_transforms):
+
+        stage_blocks = []
+        next_current = []
+        stage_uses_row = False
+
+        for i_d, (segment, column) in enumerate(zip(segments, dest_table)):
+
+            if stage > 0 and list(segment) == ['v'] and not segment['exception']:
+                next_current.append(current[i_d])  # Passthrough
+                continue
+
+            f_name = '{}_{}_{}'.format(table_name, re.sub(r'[^\w]+', '_', column.name), stage)
+
+            if stage == 0:
+                headers = source_headers
+                columns = ['src_row[{}]'.format(i) for i in range(len(source_headers))]
+
+                if column.name in source_headers:
+                    i_s = source_headers.index(column.name)
+                    header_s = column.name
+                    v = 'src_row[{}]'.format(i_s)
+                else:
+                    i_s = header_s = None
+                    v = 'row_n' if i_d == 0 else 'None'  # The first column gets the row number
+            else:
+                headers = dest_headers
+                columns = current
+                i_s = i_d
+                header_s = None
+                v = current[i_d]
+
+            constants = dict(i_s=i_s, i_d=i_d, header_s=header_s, header_d=column.name)
+
+            col_preamble, try_lines, exception = _column_stack(env, stage, segment)
+
+            preamble.extend(l for l in col_preamble if l not in preamble)
+
+            try_lines, _, uses_row = _rewrite(try_lines, headers, columns, constants)
+
+            if exception:
+                exception, _, exc_uses_row = _rewrite([exception], headers, columns, constants)
+                uses_row = uses_row or exc_uses_row
+            else:
+                exception = ['raise CasterExceptionError({!r}, {!r}, v, exc, sys.exc_info())'
+                             .format(f_name, column.name)]
+
+            stage_uses_row = stage_uses_row or uses_row
+
+            var = 's{}_{}'.format(stage, i_d)
+
+            stage_blocks.append(column_template.format(
+                header_d=column.name.replace('\n', ' '),
+                stage=stage,
+                v=v,
+                try_lines=_indent(try_lines, 4),
+                exception=_indent(exception, 4),
+                var=var
+            ))
+
+            next_current.append(var)
+
+        if stage_uses_row:
+            if stage == 0:
+                body.append('row = source_proxy.set_row(src_row)')
+            else:
+                body.append('row = dest_proxy.set_row([{}])'.format(', '.join(current)))
+
+        body.extend(stage_blocks)
+
+        current = next_current
+
+    # The final datatype cast, skipping the cast function for values that already have the type
+    def final_cast(c, var):
+        type_name = c.datatype.__name__
+
+        if summary and c.datatype in (int, float, str):
+            cast = 'summary_cast_{}({}, {!r}, errors, row_n)'.format(type_name, var, c.name)
+        elif summary:
+            cast = 'summary_cast_other(cast_{}, {}, {!r}, errors, row_n)'.format(type_name, var, c.name)
+        else:
+            cast = 'cast_{}({}, {!r}, errors)'.format(type_name, var, c.name)
+
+        if c.datatype in (int, float):
+            return '{v} if type({v}) is {t} else {c}'.format(v=var, t=c.datatype.__name__, c=cast)
+        elif c.datatype is str:
+            return '{v} if type({v}) is str and {v} else {c}'.format(v=var, c=cast)
+        else:
+            return cast
+
+    result = ',\n'.join(final_cast(c, current[i]) for i, c in enumerate(dest_table))
+
+    return '\n'.join([file_header] + ([summary_header] if summary else []) + preamble) + function_template.format(
+        source_headers=repr(source_headers),
+        dest_headers=repr(dest_headers),
+        body=_indent(body, 12),
+        result=_indent([result], 16)
+    )
+
+
+def code_key(source_headers, dest_table, extra=None):
+    """Return a hash of everything that the generated code depends on"""
+
+    columns = [(c.name, c.datatype.__name__, c.valuetype.__name__, c.transform) for c in dest_table]
+
+    return hashlib.sha1(repr((CODEGEN_VERSION, list(source_headers), dest_table.name, columns, extra))
+                        .encode('utf8')).hexdigest()
+
+
+def compile_row_function(source_headers, dest_table, env, code_path=None, key=None, summary=False):
+    """Return a compiled process_rows() function for a row processor table. If code_path is given, the
+    generated code is saved in a file next to it, named with a hash of the table, the source
+    headers and key, and the saved file is used instead of generating the code again.
+
+    :param source_headers: Headers of the source rows
+    :param dest_table: A rowgenerators.rowpipe.Table
+    :param env: The transform environment. The function is defined in a copy of it.
+    :param code_path: Path of the resource's generated code
+    :param key: Anything else the code depends on, such as a fingerprint of the transform functions
+    :param summary: If True, the function records casting errors in an ErrorSummary
+    """
+    exec_env = transform_env(env)
+
+    if code_path:
+        path = '{}-{}.py'.format(splitext(code_path)[0], code_key(source_headers, dest_table, (key, summary))[:16])
+    else:
+        path = '<compiled {}>'.format(dest_table.name)
+
+    if code_path and exists(path):
+        with open(path) as f:
+            code = f.read()
+    else:
+        code = make_row_function(source_headers, dest_table, exec_env, summary)
+
+        if code_path:
+            tmp = temp_path(path)
+
+            with open(tmp, 'w') as f:
+                f.write(code)
+
+            replace(tmp, path)
+
+    exec(compile(code, path, 'exec'), exec_env)
+
+    return exec_env['process_rows']
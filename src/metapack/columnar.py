@@ -0,0 +1,391 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Column-oriented access to resource data, as Apache Arrow record batches.
+
+Row generators produce one list per row; the functions in this module collect
+those rows into chunks and transpose them into typed Arrow arrays, so consumers
+can work on whole columns at a time. The FrameBuilder does the same for pandas,
+appending chunks of rows into typed numpy column buffers.
+"""
+
+from itertools import islice, zip_longest
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def arrow_type(datatype):
+    """Return the Arrow type for a Metatab schema datatype, or None if the type
+    should be inferred from the data"""
+    import pyarrow as pa
+
+    type_map = {
+        'integer': pa.int64(),
+        'int': pa.int64(),
+        'number': pa.float64(),
+        'float': pa.float64(),
+        'string': pa.string(),
+        'str': pa.string(),
+        'text': pa.string(),
+        'unknown': pa.string(),
+        'geometry': pa.string(),
+        'boolean': pa.bool_(),
+        'bool': pa.bool_(),
+        'date': pa.date32(),
+        'datetime': pa.timestamp('us'),
+        'time': pa.time64('us'),
+    }
+
+    return type_map.get(datatype)
+
+
+def arrow_schema(headers, types):
+    """Return an Arrow schema for a list of headers and Arrow types. Untyped columns are strings"""
+    import pyarrow as pa
+
+    return pa.schema([(str(h), t if t is not None else pa.string()) for h, t in zip(headers, types)])
+
+
+def _convert_value(v, type_):
+    """Convert a single value to a python value compatible with an Arrow type, or None
+    if it can't be converted"""
+    import pyarrow as pa
+
+    errors = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError, OverflowError)
+
+    try:
+        return pa.scalar(v, type=type_).as_py()
+    except errors:
+        pass
+
+    try:
+        # Strings, mostly, which Arrow will parse with a cast, but not on construction
+        return pa.scalar(v).cast(type_).as_py()
+    except errors:
+        return None
+
+
+def to_arrow_array(values, type_=None):
+    """Convert a sequence of python values to an Arrow array. If the type is given and some of the values
+    can't be converted to it, string columns get the str() of the value and other columns get a null,
+    which is the same result as a casting error in the row processor. """
+    import pyarrow as pa
+
+    try:
+        return pa.array(values, type=type_, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        if type_ is None:
+            type_ = pa.string()
+
+    if pa.types.is_string(type_):
+        return pa.array([None if v is None else str(v) for v in values], type=type_)
+    else:
+        return pa.array([_convert_value(v, type_) for v in values], type=type_)
+
+
+def cast_source_array(array, type_, column, errors, row_numbers=None):
+    """Cast an Arrow array of source strings to an Arrow type, with the same values and casting errors as
+    the row processor. The array is cast by Arrow only if all of its values are in forms that Arrow converts
+    exactly as the row processor does; otherwise the values are cast in python with
+    metapack.processor.cast_column(), which records the values that can't be cast in errors.
+
+    :param array: Arrow string array of source values, with nulls for empty values
+    :param type_: Arrow type to cast to
+    :param column: Row processor table column, for the datatype and value type of the cast
+    :param errors: Dict of sets of error messages, or an ErrorSummary
+    :param row_numbers: Row numbers of the values, for errors recorded in an ErrorSummary
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from metapack.processor import _fast_patterns, cast_column
+
+    if type_ is None or pa.types.is_string(type_):
+        return array
+
+    pattern = _fast_patterns.get(column.datatype)
+
+    if pattern is not None:
+        exact = pc.match_substring_regex(array, '^(?:{})$'.format(pattern))
+
+        if pc.all(pc.or_kleene(exact, pc.is_null(array))).as_py() is not False:
+            try:
+                return array.cast(type_)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+
+    values = cast_column(array.to_pylist(), column.datatype, column.name, errors, row_numbers, column.valuetype)
+
+    return to_arrow_array(values, type_)
+
+
+def transpose_rows(rows, n_cols):
+    """Transpose a list of rows into a list of n_cols columns. Short rows are padded with None,
+    and values past the last column are dropped"""
+
+    columns = list(zip_longest(*rows))[:n_cols]
+
+    while len(columns) < n_cols:
+        columns.append((None,) * len(rows))
+
+    return columns
+
+
+def _is_null(v):
+    return v is None or (isinstance(v, float) and v != v)
+
+
+def record_lost_values(values, array, header, errors, row_n=0):
+    """Record the values that became nulls in the conversion of a column to an Arrow array as casting
+    errors, so values that don't fit the type of a column are not lost silently
+
+    :param values: Python values of the column
+    :param array: Arrow array the values were converted to
+    :param header: Column name
+    :param errors: Dict of sets of error messages, or an ErrorSummary
+    :param row_n: Row number of the first value, for errors recorded in an ErrorSummary
+    """
+    from metapack.casterrors import ErrorSummary
+
+    if array.null_count == sum(1 for v in values if _is_null(v)):
+        return
+
+    for i, (v, null) in enumerate(zip(values, array.is_null().to_pylist())):
+        if null and not _is_null(v):
+            if isinstance(errors, ErrorSummary):
+                errors.add(header, v, row_n + i)
+            else:
+                errors.setdefault(header, set()).add(u"Failed to cast '{}' ( {} ) to {} in '{}'"
+                                                     .format(v, type(v), array.type, header))
+
+
+def record_batch(rows, headers, types, errors=None, row_n=0):
+    """Build a record batch from a list of rows. If errors is given, values that can't be converted to
+    the types are recorded in it with record_lost_values()"""
+    import pyarrow as pa
+
+    columns = transpose_rows(rows, len(headers))
+
+    arrays = [to_arrow_array(c, t) for c, t in zip(columns, types)]
+
+    if errors is not None:
+        for c, a, h in zip(columns, arrays, headers):
+            record_lost_values(c, a, str(h), errors, row_n)
+
+    # Columns that were all null when their type was inferred are typed as strings,
+    # so later batches with values will still fit.
+    arrays = [a.cast(pa.string()) if pa.types.is_null(a.type) else a for a in arrays]
+
+    return pa.RecordBatch.from_arrays(arrays, names=[str(h) for h in headers])
+
+
+def iter_record_batches(rows, headers, types=None, batch_size=DEFAULT_BATCH_SIZE, errors=None):
+    """Yield Arrow record batches from an iterable of data rows, which must not include the header.
+
+    :param rows: Iterable of data rows
+    :param headers: Column names
+    :param types: Sequence of Arrow types, one per header. None entries are inferred from the first batch,
+        and all later batches are converted to the types of the first.
+    :param batch_size: Maximum number of rows in each batch
+    :param errors: Dict of sets of error messages, or an ErrorSummary, to record the values of later batches
+        that can't be converted to the types of the first, and become nulls
+    """
+
+    types = list(types) if types else [None] * len(headers)
+
+    rows = iter(rows)
+    row_n = 0
+
+    while True:
+        chunk = list(islice(rows, batch_size))
+
+        if not chunk:
+            break
+
+        batch = record_batch(chunk, headers, types, errors, row_n)
+
+        # Fix the types after the first batch, so every batch has the same schema
+        types = list(batch.schema.types)
+        row_n += len(chunk)
+
+        yield batch
+
+
+def column_kind(datatype, dtype=None):
+    """Return the ColumnBuffer kind for a Metatab schema datatype, or for a dtype to load the column with,
+    as from compact.compact_dtypes()"""
+
+    if dtype == 'string[pyarrow]':
+        return 'string'
+    elif datatype in ('integer', 'int'):
+        return 'int'
+    elif datatype in ('number', 'float'):
+        return 'float'
+    else:
+        return 'object'
+
+
+def _object_array(values):
+    """Return a 1D object array of values, without numpy trying to broadcast values that are sequences"""
+    import numpy as np
+
+    a = np.empty(len(values), dtype=object)
+
+    for i, v in enumerate(values):
+        a[i] = v
+
+    return a
+
+
+def _exact_float_int(v):
+    """Return True if v is an integer that a float holds exactly"""
+    return isinstance(v, int) and not isinstance(v, bool) and -2 ** 53 <= v <= 2 ** 53
+
+
+class ColumnBuffer(object):
+    """A preallocated numpy buffer for one column, which grows by doubling. Integer columns
+    have a mask for nulls, float columns use NaN, string columns hold a list of Arrow arrays, one per
+    chunk, and all others hold python objects, which pandas converts to a better type if it can. If
+    a chunk has values that the buffer's type can't hold exactly, such as a float in an integer column,
+    the buffer is converted to objects."""
+
+    def __init__(self, kind='object', capacity=DEFAULT_BATCH_SIZE):
+        import numpy as np
+
+        self.kind = kind if kind in ('int', 'float', 'string') else 'object'
+        self.length = 0
+
+        dtypes = {'int': np.int64, 'float': np.float64, 'object': object}
+
+        self.values = np.empty(capacity if self.kind != 'string' else 0, dtype=dtypes.get(self.kind, object))
+        self.mask = np.zeros(capacity, dtype=bool) if self.kind == 'int' else None
+        self.chunks = [] if self.kind == 'string' else None
+
+    def _grow(self, n):
+        import numpy as np
+
+        capacity = len(self.values)
+
+        if self.length + n <= capacity:
+            return
+
+        while capacity < self.length + n:
+            capacity = max(capacity * 2, 1)
+
+        values = np.empty(capacity, dtype=self.values.dtype)
+        values[:self.length] = self.values[:self.length]
+        self.values = values
+
+        if self.mask is not None:
+            mask = np.zeros(capacity, dtype=bool)
+            mask[:self.length] = self.mask[:self.length]
+            self.mask = mask
+
+    def _to_object(self):
+        """Convert the buffer to an object buffer, when values don't fit the numeric type"""
+        import numpy as np
+
+        if self.kind == 'string':
+            self.values = _object_array([v for c in self.chunks for v in c.to_pylist()])
+            self.chunks = None
+            self.kind = 'object'
+            return
+
+        values = np.empty(len(self.values), dtype=object)
+        values[:self.length] = self.values[:self.length].tolist()
+
+        if self.mask is not None:
+            values[:self.length][self.mask[:self.length]] = None
+
+        self.values = values
+        self.mask = None
+        self.kind = 'object'
+
+    def extend(self, col):
+        import numpy as np
+
+        n = len(col)
+
+        if self.kind == 'string':
+            if all(v is None or isinstance(v, str) for v in col):
+                import pyarrow as pa
+
+                self.chunks.append(pa.array(col, type=pa.string()))
+                self.length += n
+                return
+
+            self._to_object()
+
+        self._grow(n)
+        s = slice(self.length, self.length + n)
+
+        # Values that the numeric types would change, such as floats in an integer column, strings, or
+        # integers too large for a float, make the buffer hold objects
+        if self.kind == 'int' and not all(v is None or (isinstance(v, int) and not isinstance(v, bool))
+                                          for v in col):
+            self._to_object()
+        elif self.kind == 'float' and not all(v is None or type(v) is float or _exact_float_int(v) for v in col):
+            self._to_object()
+
+        try:
+            if self.kind == 'int':
+                mask = np.fromiter((v is None for v in col), dtype=bool, count=n)
+                self.values[s] = np.array([0 if v is None else v for v in col], dtype=np.int64)
+                self.mask[s] = mask
+            elif self.kind == 'float':
+                self.values[s] = np.array(col, dtype=np.float64)
+        except (TypeError, ValueError, OverflowError):
+            self._to_object()
+
+        if self.kind == 'object':
+            self.values[s] = _object_array(col)
+
+        self.length += n
+
+    def series(self):
+        """Return a pandas Series of the buffer contents"""
+        import pandas as pd
+
+        if self.kind == 'string':
+            import pyarrow as pa
+
+            return pd.Series(pd.arrays.ArrowStringArray(pa.chunked_array(self.chunks, type=pa.string())))
+
+        values = self.values[:self.length]
+
+        if self.kind == 'int':
+            return pd.Series(pd.arrays.IntegerArray(values, self.mask[:self.length]))
+
+        if self.kind == 'float':
+            return pd.Series(values)
+
+        return pd.Series(values).infer_objects()
+
+
+class FrameBuilder(object):
+    """Build a pandas DataFrame in one pass from chunks of rows, appending each column into
+    a typed ColumnBuffer"""
+
+    def __init__(self, headers, kinds=None, capacity=DEFAULT_BATCH_SIZE):
+        self.headers = list(headers)
+        kinds = kinds or ['object'] * len(self.headers)
+        self.buffers = [ColumnBuffer(k, capacity) for k in kinds]
+
+    @property
+    def rows(self):
+        return self.buffers[0].length if self.buffers else 0
+
+    def append(self, rows):
+        """Append a list of rows"""
+
+        for b, col in zip(self.buffers, transpose_rows(rows, len(self.buffers))):
+            b.extend(col)
+
+    def dataframe(self):
+        """Return the rows appended so far as a DataFrame"""
+        import pandas as pd
+
+        df = pd.DataFrame({i: b.series() for i, b in enumerate(self.buffers)})
+        df.columns = self.headers
+
+        return df
@@ -0,0 +1,184 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Memory-compact dataframes.
+
+Resource.dataframe() gives every integer column an Int64 dtype, every number
+column float64, and text columns Python string objects. With compact=True,
+the dtypes that the schema alone determines, from compact_dtypes(), are given
+to the loaders, so text columns are read into Arrow strings a batch at a time
+rather than into Python strings. compact_frame() then converts the columns
+of the dataframe to smaller dtypes, using hints from the schema where they
+exist:
+
+* Integers get the narrowest integer dtype that holds the range of the
+  column's values.
+* Floats become float32 when that loses no precision.
+* Text columns with few distinct values, from the ``nuniques`` property or
+  from the data, become categories. Other text columns become Arrow strings,
+  if pyarrow is installed.
+* Date and datetime columns are parsed with the column's ``format`` property,
+  if it has one, rather than by inferring the format, and become datetime64.
+"""
+
+DEFAULT_CATEGORY_RATIO = 0.5  # Largest ratio of distinct values to rows for a category column
+
+INT_DTYPES = [('Int8', 2 ** 7), ('Int16', 2 ** 15), ('Int32', 2 ** 31), ('Int64', 2 ** 63)]
+
+
+def _number(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def int_dtype(min_value, max_value, nullable=True):
+    """Return the name of the narrowest integer dtype for a range of values, a pandas nullable integer
+    dtype if nullable is True, or a numpy dtype otherwise"""
+
+    name = 'Int64'
+
+    for n, limit in INT_DTYPES:
+        if -limit <= min_value and max_value < limit:
+            name = n
+            break
+
+    return name if nullable else name.lower()
+
+
+def compact_integer(s, column):
+    import pandas as pd
+
+    if not pd.api.types.is_integer_dtype(s):
+        try:
+            s = pd.Series(pd.array(s, dtype='Int64'), index=s.index, name=s.name)
+        except (TypeError, ValueError):  # Not all integers
+            return s
+
+    if s.isna().all():
+        return s.astype('Int8')
+
+    # Columns without nulls may have a numpy dtype, which stays a numpy dtype
+    nullable = isinstance(s.dtype, pd.api.extensions.ExtensionDtype)
+
+    # The range comes from the data, not the min and max of the schema, which may be out of date,
+    # because integer casts silently wrap values that are out of range
+    return s.astype(int_dtype(s.min(), s.max(), nullable))
+
+
+def compact_float(s, column):
+    import numpy as np
+    import pandas as pd
+
+    if not pd.api.types.is_float_dtype(s):
+        try:
+            s = pd.to_numeric(s)
+        except (TypeError, ValueError):
+            return s
+
+        if not pd.api.types.is_float_dtype(s):
+            return s
+
+    f32 = s.astype('float32')
+
+    if np.array_equal(f32.to_numpy(dtype='float64'), s.to_numpy(dtype='float64'), equal_nan=True):
+        return f32
+
+    return s
+
+
+def _string_dtype():
+    try:
+        import pyarrow  # noqa: F401
+        return 'string[pyarrow]'
+    except ImportError:
+        return None
+
+
+def compact_dtypes(columns):
+    """Return a dict of headers to the dtypes that columns can be loaded with before their values are
+    known. Only text columns are in it, as Arrow strings, if pyarrow is installed; the ranges of numbers
+    and the number of distinct values come from the data, in compact_frame()
+
+    :param columns: Column dicts, as from Resource.columns()
+    """
+
+    string_dtype = _string_dtype()
+
+    if not string_dtype:
+        return {}
+
+    return {c.get('header'): string_dtype for c in columns if c.get('datatype') in ('string', 'text')}
+
+
+def compact_string(s, column, category_ratio=DEFAULT_CATEGORY_RATIO):
+    import pandas as pd
+
+    if isinstance(s.dtype, pd.CategoricalDtype) or len(s) == 0:
+        return s
+
+    nuniques = _number(column.get('nuniques'))
+
+    if nuniques is None:
+        nuniques = s.nunique(dropna=True)
+
+    if nuniques <= max(1, len(s) * category_ratio):
+        return s.astype('category')
+
+    string_dtype = _string_dtype()
+
+    if string_dtype and pd.api.types.infer_dtype(s, skipna=True) in ('string', 'empty'):
+        return s.astype(string_dtype)
+
+    return s
+
+
+def compact_datetime(s, column):
+    import pandas as pd
+
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+
+    fmt = column.get('format')
+
+    if fmt and '%' in fmt:
+        return pd.to_datetime(s, format=fmt, errors='coerce')
+
+    try:
+        return pd.to_datetime(s, format='ISO8601', errors='coerce')
+    except (TypeError, ValueError):  # Older pandas, without the ISO8601 format
+        return pd.to_datetime(s, errors='coerce')
+
+
+def compact_frame(df, columns, category_ratio=DEFAULT_CATEGORY_RATIO):
+    """Return a copy of a dataframe with smaller dtypes for its columns.
+
+    :param df: A dataframe
+    :param columns: Column dicts, as from Resource.columns(), for the datatypes and hints
+    :param category_ratio: Text columns with at most this ratio of distinct values to rows become categories
+    """
+    import pandas as pd
+
+    schema = {str(c.get('header')): c for c in columns}
+
+    out = {}
+
+    for name in df.columns:
+        s = df[name]
+        c = schema.get(str(name), {})
+        datatype = c.get('datatype')
+
+        if datatype in ('integer', 'int') or (datatype is None and pd.api.types.is_integer_dtype(s)):
+            s = compact_integer(s, c)
+        elif datatype in ('number', 'float') or (datatype is None and pd.api.types.is_float_dtype(s)):
+            s = compact_float(s, c)
+        elif datatype in ('date', 'datetime'):
+            s = compact_datetime(s, c)
+        elif datatype in (None, 'string', 'text', 'unknown') and not pd.api.types.is_numeric_dtype(s):
+            s = compact_string(s, c, category_ratio)
+
+        out[name] = s
+
+    return pd.DataFrame(out, index=df.index)
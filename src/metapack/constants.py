@@ -3,3 +3,6 @@
 
 PACKAGE_PREFIX = '_packages'
 MATERIALIZED_DATA_PREFIX='_materialized_data'
+MATERIALIZED_PARQUET_PREFIX = '_materialized_parquet'
+ROW_INDEX_PREFIX = '_row_index'
+PARSED_DOC_PREFIX = '_parsed_docs'
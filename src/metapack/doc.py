@@ -5,6 +5,7 @@
 Extensions to the MetatabDoc, Resources and References, etc.
 """
 
+import threading
 from pathlib import Path
 
 from metatab import MetatabDoc, WebResolver
@@ -19,6 +20,9 @@ from metapack.util import datetime_now
 
 EMPTY_SOURCE_HEADER = '_NONE_'  # Marker for a column that is in the destination table but not in the source
 
+# Guards sys.path and sys.modules while package libraries are imported, which is process-wide state
+_import_lock = threading.RLock()
+
 
 class Resolver(WebResolver):
     def get_row_generator(self, ref, cache=None):
@@ -32,8 +36,24 @@ class Resolver(WebResolver):
 class MetapackDoc(MetatabDoc):
     lib_dir_names = ('lib', 'pylib')  # Names of subdirs to look for to find a loadable module
 
+    # If True, parsed metadata files are cached, and loaded from the cache when the file has not changed
+    parse_cache = True
+
     def __init__(self, ref=None, decl=None, cache=None, resolver=None, package_url=None, clean_cache=False,
-                 downloader=None):
+                 downloader=None, lazy=False):
+
+        self._lock = threading.RLock()  # Guards the cached environment and the loading of deferred sections
+
+        self._version = 0  # Incremented when terms are added, removed or changed, to invalidate cached values
+        self._term_index = None
+
+        self._env = None  # Cached execution context, and the fingerprint of the library files it was built from
+        self._env_fingerprint = None
+        self._doc_dir = None
+
+        self._lazy = lazy  # If True, parse only the Root, Resources and References sections until others are needed
+        self._deferred = None  # DeferredSections, the unparsed rows of the other sections
+        self._loading_deferred = False
 
         if downloader:
             self.downloader = downloader
@@ -71,6 +91,250 @@ class MetapackDoc(MetatabDoc):
 
         self.default_resource = None  # Set externally in open_package when the URL has a resource.
 
+    def load_terms(self, terms):
+        """Load terms from a TermParser or other sequence of terms. When loading from the document's own
+        parser, the parsed state is loaded from the parse cache if the metadata file hasn't changed, and
+        written to it otherwise"""
+        from metapack.doccache import load_parsed, parsed_cache_key, parsed_cache_path, save_parsed
+
+        if terms is not getattr(self, '_term_parser', None):
+            return super().load_terms(terms)
+
+        key = parsed_cache_key(self, terms) if self.parse_cache else None
+
+        if key is None:
+            return self._parse_terms(terms)
+
+        path = parsed_cache_path(self, terms._ref)
+
+        if not load_parsed(self, path, key):
+            self._parse_terms(terms)
+            save_parsed(self, path, key)
+
+        return self
+
+    def _parse_terms(self, term_parser):
+        """Parse the metadata file. Lazy documents parse the eager sections, and keep the rows of the others"""
+        from rowgenerators import get_generator
+        from metapack.lazydoc import RowsTermParser, split_rows
+
+        if self._lazy:
+            try:
+                target = term_parser._ref.get_resource().get_target()
+            except AttributeError:  # A generator, not a URL
+                target = None
+
+            split = split_rows(str(target.path), get_generator(target)) if target is not None else None
+
+            if split is not None:
+                rows, line_numbers, self._deferred = split
+                return super().load_terms(RowsTermParser(str(target.path), rows, line_numbers, self))
+
+        return super().load_terms(term_parser)
+
+    def load_deferred(self):
+        """Parse the sections that a lazy document has not loaded yet. They are loaded automatically when
+        they are needed, so this is only required before using the sections or terms attributes directly"""
+
+        from metapack.lazydoc import merge_terms
+
+        with self._lock:
+            # Parsing searches the document, which would load the sections again
+            if self._deferred is None or self._loading_deferred:
+                return self
+
+            deferred = self._deferred
+            self._loading_deferred = True
+
+            try:
+                errors = list(self.errors)
+                section_order = deferred.merged_section_order(list(self.sections))
+                n_terms = len(self.terms)
+
+                parser = deferred.parser(self)
+                super().load_terms(parser)
+
+                self.errors = errors + list(self.errors)
+
+                # Restore the order of the file
+                self.terms = merge_terms(self.terms[:n_terms], self.terms[n_terms:], parser.file_name)
+                self.sort_sections(section_order)
+                self._term_index = None  # The terms are in a new order
+
+                # Other threads see the sections as deferred until they are completely loaded
+                self._deferred = None
+            finally:
+                self._loading_deferred = False
+
+        return self
+
+    def _load_deferred_section(self, name):
+        if self._deferred is not None and self._deferred.has_section(name):
+            self.load_deferred()
+
+    def get_section(self, name, default=False):
+        self._load_deferred_section(name)
+        return super().get_section(name, default)
+
+    def __contains__(self, item):
+        self._load_deferred_section(item)
+        return super().__contains__(item)
+
+    def __iter__(self):
+        self.load_deferred()
+        return super().__iter__()
+
+    @property
+    def rows(self):
+        self.load_deferred()
+        return super().rows
+
+    @property
+    def lines(self):
+        self.load_deferred()
+        return super().lines
+
+    @property
+    def all_terms(self):
+        self.load_deferred()
+        return super().all_terms
+
+    def add_term(self, t, add_section=True):
+        from metapack.termindex import track
+
+        track(t)
+        self._version += 1
+
+        r = super().add_term(t, add_section)
+
+        if self._term_index is not None and t in self.terms:
+            self._term_index.add(t)
+
+        return r
+
+    def remove_term(self, t):
+        self._version += 1
+
+        r = super().remove_term(t)
+
+        if self._term_index is not None:
+            if t in self._term_index:
+                self._term_index.remove(t)
+            elif t.record_term_lc == 'name' and t.parent is not None:
+                self._term_index.update(t.parent)
+
+        return r
+
+    def __delitem__(self, item):
+        self._load_deferred_section(item)
+        self._version += 1
+
+        terms = list(self.sections[item]) if item in self.sections else []
+
+        r = super().__delitem__(item)
+
+        if self._term_index is not None:
+            for t in terms:
+                self._term_index.remove(t)
+
+        return r
+
+    def get_term_class(self, term_name):
+        from metatab import Term
+        from metapack.termindex import TrackedTerm
+
+        tc = super().get_term_class(term_name)
+
+        return TrackedTerm if tc is Term else tc
+
+    def _term_changed(self, t):
+        """Called by a TrackedTerm when its value changes or a child is added. Terms that are in the index
+        are moved to their new keys, as are the parents of Name properties"""
+
+        self._version += 1
+
+        index = self._term_index
+
+        if index is not None:
+            if t in index:
+                index.update(t)
+            elif t.parent is not None and t.parent in index and t.record_term_lc == 'name':
+                index.update(t.parent)
+
+    def invalidate(self):
+        """Discard cached lookups, such as the term index, the resolution plans of resources and the execution
+        context. Changes made through terms are tracked, so this is only needed after changing the terms
+        list directly, or modules in subpackages of the library"""
+        self._version += 1
+        self._term_index = None
+        self._env = None
+
+    @property
+    def term_index(self):
+        """Return the TermIndex of the root level terms, building it on the first use"""
+        from metapack.termindex import TermIndex
+
+        if self._term_index is None:
+            self._term_index = TermIndex(self.terms)
+
+        return self._term_index
+
+    def find(self, term, value=False, section=None, _expand_derived=True, **kwargs):
+        """Like MetatabDoc.find(), but searches for root level terms by term name, value, name property
+        and section use the term index. Other searches, such as for child terms or with wildcards, are
+        passed on to MetatabDoc.find()"""
+
+        if self._deferred is not None and self._deferred.matches(term, section, self.derived_terms):
+            self.load_deferred()
+
+        def super_find():
+            return super(MetapackDoc, self).find(term, value, section, _expand_derived, **kwargs)
+
+        if (not isinstance(term, str) or (section is not None and not isinstance(section, str))
+                or set(kwargs) - {'name'}):
+            return super_find()
+
+        terms = [term]
+
+        if _expand_derived:
+            terms = list(self.derived_terms.get(term.lower(), [])) + terms
+
+        index = self.term_index
+
+        found = []
+
+        for e in terms:
+            e = e.lower()
+
+            if '.' not in e:
+                e = 'root.' + e
+
+            try:
+                if e == 'root.*' and section:
+                    candidates = index.section_terms(section)
+                elif e.startswith('root.') and '*' not in e:
+                    candidates = index.candidates(e, value, kwargs.get('name', False))
+                else:
+                    return super_find()
+            except TypeError:  # Unhashable value
+                return super_find()
+
+            for t in candidates:
+
+                # Section candidates aren't selected by value or name
+                if value is not False and t.value != value:
+                    continue
+
+                if 'name' in kwargs and t.get_value('name') != kwargs['name']:
+                    continue
+
+                if section is not None and (t.section is None or t.section.name.lower() != section.lower()):
+                    continue
+
+                found.append(t)
+
+        return found
+
     def __enter__(self):
         """Context Management entry. Does nothing"""
         return self
@@ -159,73 +423,142 @@ class MetapackDoc(MetatabDoc):
 
     @property
     def env(self):
-        """Return the module associated with a package's python library"""
+        """Return the execution context: the contents of the module associated with a package's python
+        library, and the functions from metapack.env. The context is cached, and rebuilt when the library
+        directories or the modules at their top level change, which is checked without walking the
+        library. Changes to modules in subpackages of the library require a call to invalidate().
+        Returns a copy, which the caller may alter. """
         import importlib
 
-        try:
-            r = self.get_lib_module_dict()
-        except ImportError:
-            r = {}
+        fp = self._lib_stamp()
 
-        m = importlib.import_module('metapack.env')
+        with self._lock:
+            if self._env is None or fp != self._env_fingerprint:
 
-        for f in m.__all__:
-            r[f.__name__] = f
+                # If the library was loaded before, it has changed, so it must be imported again
+                reload = self._env_fingerprint is not None
 
-        return r
+                try:
+                    r = self.get_lib_module_dict(reload=reload)
+                except ImportError:
+                    r = {}
+
+                m = importlib.import_module('metapack.env')
+
+                for f in m.__all__:
+                    r[f.__name__] = f
+
+                self._env = r
+                self._env_fingerprint = fp
+
+            return dict(self._env)
+
+    def _lib_dirs(self):
+        """Return the paths to the package's library directories that exist"""
+        from os.path import join, isdir
+
+        if not self.ref:
+            return []
+
+        if self._doc_dir is None:
+            from os.path import dirname, abspath
+            self._doc_dir = dirname(abspath(parse_app_url(self.ref).path))
+
+        return [join(self._doc_dir, e) for e in self.lib_dir_names if isdir(join(self._doc_dir, e))]
+
+    def _lib_stamp(self):
+        """Return the modification times of the library directories and of the python files at their top
+        level, a quick check for changes to the library"""
+        import os
+
+        entries = []
+
+        for lib_dir in self._lib_dirs():
+            with os.scandir(lib_dir) as it:
+                files = sorted((e.name, e.stat().st_mtime_ns) for e in it if e.name.endswith('.py'))
+
+            entries.append((lib_dir, os.stat(lib_dir).st_mtime_ns, tuple(files)))
+
+        return tuple(entries)
+
+    def _lib_fingerprint(self):
+        """Return the paths, sizes and modification times of the python files in the library directories"""
+        import os
+        from os.path import join
+
+        entries = []
+
+        for lib_dir in self._lib_dirs():
+            for root, dirs, files in os.walk(lib_dir):
+                dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+
+                for f in sorted(files):
+                    if f.endswith('.py'):
+                        st = os.stat(join(root, f))
+                        entries.append((join(root, f), st.st_size, st.st_mtime_ns))
+
+        return tuple(entries)
 
     def set_sys_path(self):
-        from os.path import join, isdir, dirname, abspath
         import sys
 
-        if not self.ref:
+        lib_dirs = self._lib_dirs()
+
+        if not lib_dirs:
             return False
 
-        u = parse_app_url(self.ref)
-        doc_dir = dirname(abspath(u.path))
         # Add the dir with the metatab file to the system path
+        with _import_lock:
+            if self._doc_dir not in sys.path:
+                sys.path.insert(0, self._doc_dir)
 
-        for lib_dir_name in self.lib_dir_names:
-            if isdir(join(doc_dir, lib_dir_name)):
-                if 'docdir' not in sys.path:
-                    sys.path.insert(0, doc_dir)
-                return True
+        return True
 
-        return False
-
-    def get_lib_module_dict(self):
+    def get_lib_module_dict(self, reload=False):
         """Load the 'lib' directory as a python module, so it can be used to provide functions
-        for rowpipe transforms. This only works filesystem packages"""
-
-        from importlib import import_module
+        for rowpipe transforms. This only works filesystem packages. If reload is True, the module and
+        its submodules are removed from sys.modules first, so they are loaded from the current files. Imports
+        are serialized, since the module path and the loaded modules are shared by the whole process"""
 
         if not self.ref:
             return {}
 
         u = parse_app_url(self.ref)
 
-        if u.scheme == 'file':
+        if u.scheme != 'file':
+            return {}
 
-            if not self.set_sys_path():
-                return {}
+        with _import_lock:
+            return self._import_lib_module(reload)
 
-            for module_name in self.lib_dir_names:
+    def _import_lib_module(self, reload):
+        import sys
+        from importlib import import_module, invalidate_caches
 
-                try:
-                    m = import_module(module_name)
-                    d = {k: v for k, v in m.__dict__.items() if not k.startswith('__')}
-                    return d
+        if not self.set_sys_path():
+            return {}
 
-                except ModuleNotFoundError as e:
+        for module_name in self.lib_dir_names:
 
-                    # We need to know if it is the datapackage's module that is missing
-                    # or if it is a module that it imported
-                    if module_name not in str(e):
-                        raise  # If not our module, it's a real error.
+            if reload:
+                for k in [k for k in sys.modules if k == module_name or k.startswith(module_name + '.')]:
+                    del sys.modules[k]
 
-                    continue
-        else:
-            return {}
+                invalidate_caches()
+
+            try:
+                m = import_module(module_name)
+                d = {k: v for k, v in m.__dict__.items() if not k.startswith('__')}
+                return d
+
+            except ModuleNotFoundError as e:
+
+                # We need to know if it is the datapackage's module that is missing
+                # or if it is a module that it imported
+                if module_name not in str(e):
+                    raise  # If not our module, it's a real error.
+
+                continue
 
         assert False, "Should not get here. No idea why we did. Maybe errors in pylib/__init__.py?"
 
@@ -245,6 +578,25 @@ class MetapackDoc(MetatabDoc):
     def reference(self, name=None, term='Root.Reference', section='References'):
         return self.find_first(term=term, name=name, section=section)
 
+    def prefetch(self, workers=None, include_references=True, per_host=None):
+        """Download the remote files of the resources and, if include_references is True, the references,
+        concurrently, into the downloader's cache. Files used by several terms are downloaded once. Returns
+        an ordered dict of the URLs to the paths of the local copies, or to the exceptions for files that
+        could not be downloaded
+
+        :param workers: Number of concurrent downloads
+        :param include_references: If True, also download the files of the references
+        :param per_host: Number of concurrent downloads from one host
+        """
+        from metapack.prefetch import DEFAULT_PER_HOST, DEFAULT_WORKERS, prefetch_terms
+
+        terms = list(self.resources())
+
+        if include_references:
+            terms += list(self.references())
+
+        return prefetch_terms(terms, self.downloader, workers or DEFAULT_WORKERS, per_host or DEFAULT_PER_HOST)
+
     def _repr_html_(self, **kwargs):
         """Produce HTML for Jupyter Notebook"""
         from markdown import markdown as convert_markdown
@@ -0,0 +1,139 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Persistent cache of parsed Metatab documents.
+
+Parsing a metadata file builds every term through the metatab row parser,
+which is slow for documents with large schemas. After a document is parsed,
+its term tree, sections and declarations are pickled to a file in the
+metapack cache, and the next time the same metadata file is opened the tree
+is loaded from that file instead of being parsed.
+
+The cache file for a document is named for its URL, and holds a key built
+from the path, size and modification time of the local copy of the metadata
+file, the declarations, the registered term classes and whether the document
+is lazy, so the document is parsed again when any of them change. Lazy
+documents are cached with the unparsed rows of their deferred sections.
+Documents that include other files, and documents that are not read from
+files, are not cached.
+"""
+
+import hashlib
+import pickle
+from os import remove, replace, stat
+from os.path import exists, join
+
+from metapack.constants import PARSED_DOC_PREFIX
+from metapack.util import ensure_dir, temp_path
+
+CACHE_VERSION = 2  # Increment when the format of the cached state changes
+
+# Attributes of the document that hold the results of parsing
+DOC_STATE = ('terms', 'sections', 'decl_terms', 'decl_sections', 'super_terms', 'derived_terms', 'errors',
+             '_deferred')
+
+
+def parsed_cache_path(doc, url):
+    """Return the path to the cache file for a document URL"""
+
+    dr = doc._cache.getsyspath(PARSED_DOC_PREFIX)
+
+    ensure_dir(dr)
+
+    return join(dr, '{}.pickle'.format(hashlib.md5(str(url).encode('utf8')).hexdigest()))
+
+
+def parsed_cache_key(doc, term_parser):
+    """Return the cache key for the document that a TermParser will parse, or None if the document
+    can't be cached because it is not read from a local file"""
+    import metatab
+    from metatab.parser import TermParser
+
+    try:
+        target = term_parser._ref.get_resource().get_target()
+    except AttributeError:  # A generator, not a URL
+        return None
+
+    if target.scheme != 'file':
+        return None
+
+    try:
+        path = str(target.fspath)
+        st = stat(path)
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    classes = sorted((k, str(v)) for k, v in TermParser.term_classes.items())
+
+    return repr((CACHE_VERSION, metatab.__version__, path, st.st_size, st.st_mtime_ns,
+                 [str(d) for d in doc.decls], classes, doc._lazy))
+
+
+class _DocPickler(pickle.Pickler):
+    """Pickle terms with references to the document and its root section stored by name, since the
+    document that loads them has its own"""
+
+    def __init__(self, f, doc):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self._refs = {id(doc): 'doc', id(doc.root): 'root'}
+
+    def persistent_id(self, obj):
+        return self._refs.get(id(obj))
+
+
+class _DocUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, doc):
+        super().__init__(f)
+        self._refs = {'doc': doc, 'root': doc.root}
+
+    def persistent_load(self, pid):
+        return self._refs[pid]
+
+
+def save_parsed(doc, path, key):
+    """Write the parsed state of a document to a cache file. Returns True if the file was written.
+    Documents with Include terms aren't written, because their state depends on other files"""
+
+    if any(t.term_is('root.include') for t in doc.terms):
+        return False
+
+    state = {k: getattr(doc, k) for k in DOC_STATE}
+    state['root'] = dict(doc.root.__dict__)
+
+    tmp_path = temp_path(path)
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            _DocPickler(f, doc).dump(state)
+    except Exception:  # Terms with values that can't be pickled; just don't cache the document
+        if exists(tmp_path):
+            remove(tmp_path)
+        return False
+
+    replace(tmp_path, path)
+
+    return True
+
+
+def load_parsed(doc, path, key):
+    """Load the parsed state of a document from a cache file, if the file exists and has the same key.
+    Returns True if the state was loaded"""
+
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != key:
+                return False
+
+            state = _DocUnpickler(f, doc).load()
+    except Exception:  # Missing, or a damaged or incompatible file, which will be replaced
+        return False
+
+    doc.root.__dict__.update(state.pop('root'))
+
+    for k, v in state.items():
+        setattr(doc, k, v)
+
+    return True
@@ -0,0 +1,219 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Block reader for fixed-width files.
+
+The rowgenerators FixedSource reads a whole fixed-width file into memory with
+readlines(), and slices each line with a lambda generated from the column
+widths. The reader in this module memory maps the file and reads it in large
+blocks of whole lines, so memory use is bounded by the block size.
+
+Rows are sliced from each line as the FixedSource does. Columns, for Arrow
+and dataframes, are sliced for a whole block at a time: when all of the lines
+in a block are ASCII and have the same length, which is the usual case for
+fixed-width files, the block is viewed as a numpy record array with one
+bytes field per column, at the offsets computed from the schema widths, and
+each field becomes an Arrow string array that is trimmed, and later cast,
+with Arrow compute functions. Other blocks are sliced a line at a time.
+"""
+
+import mmap
+
+from metapack.exc import ResourceError
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024  # Bytes per block
+
+
+class FixedWidthLayout(object):
+    """Names, widths and byte offsets of the columns of a fixed-width file"""
+
+    def __init__(self, names, widths):
+
+        self.names = list(names)
+        self.widths = []
+
+        for n, w in zip(self.names, widths):
+            try:
+                self.widths.append(int(w))
+            except (TypeError, ValueError):
+                raise ResourceError("Fixed-width column '{}' must have an integer width; got '{}'".format(n, w))
+
+        self.offsets = []
+
+        pos = 0
+        for w in self.widths:
+            self.offsets.append(pos)
+            pos += w
+
+        self.record_width = pos
+
+        # Generated like the FixedSource's parser, which is faster than a loop over slices
+        self.parse_line = eval('lambda row: [{}]'.format(
+            ', '.join('row[{}:{}].strip()'.format(o, o + w) for o, w in zip(self.offsets, self.widths))))
+
+    @classmethod
+    def from_table(cls, table):
+        """Return the layout for a rowgenerators Table, such as the resource's row processor table"""
+        return cls([c.name for c in table.columns], [c.width for c in table.columns])
+
+    def __len__(self):
+        return len(self.names)
+
+    def record_dtype(self, line_length):
+        """Return a numpy structured dtype that views lines of line_length bytes, including the line
+        ending, as records with one bytes field per column"""
+        import numpy as np
+
+        return np.dtype({'names': ['f{}'.format(i) for i in range(len(self))],
+                         'formats': ['S{}'.format(w) for w in self.widths],
+                         'offsets': self.offsets,
+                         'itemsize': line_length})
+
+
+class FixedWidthReader(object):
+    """Read the lines of a fixed-width file in blocks, as columns or as rows of stripped strings
+
+    :param path: Path to the file
+    :param layout: A FixedWidthLayout
+    :param encoding: Text encoding of the file, for blocks that are not all ASCII
+    :param block_size: Approximate size of each block, in bytes
+    """
+
+    def __init__(self, path, layout, encoding=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self.layout = layout
+        self.encoding = encoding or 'utf8'
+        self.block_size = block_size
+
+        self._dtypes = {}
+
+    def iter_blocks(self, start=0, stop=None, offset=0, first_row=0):
+        """Yield (row number, bytes) for blocks of whole lines, for the rows from start up to stop. Reading
+        begins at byte offset, which must be the start of row first_row, such as an offset from a
+        RowIndex."""
+
+        row = first_row
+
+        with open(self.path, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                return
+
+            try:
+                size = len(mm)
+                pos = offset
+
+                while pos < size and (stop is None or row < stop):
+
+                    end = mm.rfind(b'\n', pos, min(pos + self.block_size, size)) + 1
+
+                    if end <= pos:  # A line longer than the block, or the last line
+                        end = mm.find(b'\n', pos) + 1 or size
+
+                    block = mm[pos:end]
+                    pos = end
+
+                    if not block.endswith(b'\n'):
+                        block += b'\n'
+
+                    n = block.count(b'\n')
+
+                    if row + n <= start:  # Entirely before start
+                        row += n
+                        continue
+
+                    if row < start:
+                        cut = 0
+                        for _ in range(start - row):
+                            cut = block.index(b'\n', cut) + 1
+                        block = block[cut:]
+                        n -= start - row
+                        row = start
+
+                    if stop is not None and row + n > stop:
+                        cut = 0
+                        for _ in range(stop - row):
+                            cut = block.index(b'\n', cut) + 1
+                        block = block[:cut]
+                        n = stop - row
+
+                    yield row, block
+
+                    row += n
+            finally:
+                mm.close()
+
+    def _uniform_length(self, block):
+        """Return the length of the lines in a block, including the line ending, if all lines have the
+        same length, are ASCII and hold all of the columns, or None"""
+        import numpy as np
+
+        line_length = block.index(b'\n') + 1
+
+        if (len(block) % line_length or line_length - 1 < self.layout.record_width or not block.isascii()):
+            return None
+
+        ends = np.frombuffer(block, dtype=np.uint8)[line_length - 1::line_length]
+
+        if not (ends == ord('\n')).all():
+            return None
+
+        return line_length
+
+    def _block_lines(self, block):
+        return block.decode(self.encoding).split('\n')[:-1]
+
+    def arrow_columns(self, block):
+        """Return a list of Arrow string arrays of the stripped values of each column of a block of lines.
+        Empty values are nulls"""
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        line_length = self._uniform_length(block)
+
+        if line_length is not None:
+            dtype = self._dtypes.get(line_length)
+
+            if dtype is None:
+                dtype = self._dtypes[line_length] = self.layout.record_dtype(line_length)
+
+            records = np.frombuffer(block, dtype=dtype)
+
+            columns = [pc.utf8_trim_whitespace(pa.array(records[name]).cast(pa.string())) for name in dtype.names]
+        else:
+            rows = [self.layout.parse_line(line) for line in self._block_lines(block)]
+
+            columns = [pa.array([r[i] for r in rows], type=pa.string()) for i in range(len(self.layout))]
+
+        null = pa.scalar(None, pa.string())
+
+        return [pc.if_else(pc.equal(c, ''), null, c) for c in columns]
+
+    def iter_arrow_columns(self, start=0, stop=None, offset=0, first_row=0):
+        """Yield (row number, columns) for each block, where columns is a list of Arrow string arrays"""
+
+        for row, block in self.iter_blocks(start, stop, offset, first_row):
+            yield row, self.arrow_columns(block)
+
+    def iter_rows(self, start=0, stop=None, offset=0, first_row=0):
+        """Yield rows, as lists of stripped strings, like the FixedSource"""
+
+        parse = self.layout.parse_line
+
+        for _, block in self.iter_blocks(start, stop, offset, first_row):
+            yield from map(parse, self._block_lines(block))
+
+
+def fixed_width_reader(row_gen, block_size=DEFAULT_BLOCK_SIZE):
+    """Return a FixedWidthReader for a rowgenerators FixedSource with a local file, or None"""
+    from rowgenerators.generator.fixed import FixedSource
+
+    if not isinstance(row_gen, FixedSource) or row_gen.ref.scheme != 'file':
+        return None
+
+    layout = FixedWidthLayout.from_table(row_gen.table)
+
+    return FixedWidthReader(str(row_gen.ref.fspath), layout, getattr(row_gen.ref, 'encoding', None), block_size)
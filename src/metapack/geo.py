@@ -0,0 +1,310 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Decoding and encoding geometry columns.
+
+Geometry columns arrive as WKT strings, WKB bytes, shapely geometries or
+rowgenerators ShapeValues. decode_geometry() converts a whole column to an
+array of shapely geometries, in batches, with the shapely 2 array functions
+from_wkt() and from_wkb(), so there is no python call per value except to
+sort the values by kind. Values that can't be decoded become None.
+
+Materialized geo resources store the geometry column as WKB in a Parquet
+file with GeoParquet metadata, so later loads only need from_wkb().
+"""
+
+import json
+
+from metapack.columnar import DEFAULT_BATCH_SIZE, _object_array
+
+GEOMETRY_COLUMN = 'geometry'
+DEFAULT_CRS = 'epsg:4326'
+
+
+def _shapely2():
+    """Return the shapely module if it has the vectorized functions of shapely 2, or None"""
+    import shapely
+
+    return shapely if hasattr(shapely, 'from_wkt') else None
+
+
+def _raw_value(v):
+    """Return the WKT, WKB or geometry in a value, unwrapping ShapeValues"""
+    from shapely.geometry.base import BaseGeometry
+
+    if isinstance(v, (str, bytes, BaseGeometry)) or v is None:
+        return v
+
+    if isinstance(v, tuple) and len(v) == 1 and hasattr(v, 'shape'):  # A ShapeValue
+        return v[0]
+
+    try:
+        return v.shape
+    except Exception:
+        return None
+
+
+def _decode_values(values):
+    """Decode a sequence of values one at a time, for shapely before version 2"""
+    from shapely import wkb, wkt
+    from shapely.geometry.base import BaseGeometry
+
+    def _decode(v):
+        try:
+            if isinstance(v, str):
+                return wkt.loads(v)
+            elif isinstance(v, bytes):
+                return wkb.loads(v)
+            elif isinstance(v, BaseGeometry):
+                return v
+        except Exception:
+            pass
+
+        return None
+
+    return [_decode(v) for v in values]
+
+
+def _decode_batch(values):
+    import numpy as np
+    import pandas as pd
+    from shapely.geometry.base import BaseGeometry
+
+    shapely = _shapely2()
+
+    values = np.asarray(values, dtype=object)
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+
+    if kind not in ('string', 'bytes', 'empty'):
+        values = _object_array([_raw_value(v) for v in values])
+        kind = pd.api.types.infer_dtype(values, skipna=True)
+
+    values = np.where(pd.isna(values), None, values)
+
+    if kind == 'empty':
+        return np.full(len(values), None, dtype=object)
+
+    if shapely is None:
+        return _decode_values(values)
+
+    if kind == 'string':
+        return shapely.from_wkt(values, on_invalid='ignore')
+    elif kind == 'bytes':
+        return shapely.from_wkb(values, on_invalid='ignore')
+
+    # Mixed strings, bytes and geometries, decoded by kind
+    out = np.full(len(values), None, dtype=object)
+
+    is_str = np.array([isinstance(v, str) for v in values], dtype=bool)
+    is_bytes = np.array([isinstance(v, bytes) for v in values], dtype=bool)
+    is_geom = np.array([isinstance(v, BaseGeometry) for v in values], dtype=bool)
+
+    out[is_str] = shapely.from_wkt(values[is_str], on_invalid='ignore')
+    out[is_bytes] = shapely.from_wkb(values[is_bytes], on_invalid='ignore')
+    out[is_geom] = values[is_geom]
+
+    return out
+
+
+def decode_geometry(values, batch_size=DEFAULT_BATCH_SIZE):
+    """Return a numpy object array of shapely geometries decoded from a sequence of WKT strings, WKB bytes,
+    geometries or ShapeValues, such as the geometry column of a dataframe. Values that are null or
+    can't be decoded are None. """
+    import numpy as np
+
+    try:
+        values = values.to_numpy(dtype=object)  # pandas Series
+    except AttributeError:
+        values = _object_array(list(values))
+
+    out = np.full(len(values), None, dtype=object)
+
+    for start in range(0, len(values), batch_size):
+        out[start:start + batch_size] = _decode_batch(values[start:start + batch_size])
+
+    return out
+
+
+def encode_wkb(geometries):
+    """Return a list of WKB bytes for an array of shapely geometries, with None for missing geometries"""
+
+    shapely = _shapely2()
+
+    if shapely is not None:
+        return list(shapely.to_wkb(geometries))
+
+    return [g.wkb if g is not None else None for g in geometries]
+
+
+def geometry_bounds(geometries):
+    """Return an array of shape (n, 4) of the bounds of an array of geometries, with NaN for missing
+    geometries"""
+    import numpy as np
+
+    shapely = _shapely2()
+
+    if shapely is not None:
+        return shapely.bounds(geometries).reshape(-1, 4)
+
+    nan = (np.nan,) * 4
+
+    return np.array([g.bounds if g is not None and not g.is_empty else nan for g in geometries],
+                    dtype=float).reshape(-1, 4)
+
+
+def geoparquet_metadata(column=GEOMETRY_COLUMN, crs=DEFAULT_CRS):
+    """Return the GeoParquet schema metadata for a file with one WKB geometry column"""
+
+    return {b'geo': json.dumps({
+        'version': '1.0.0',
+        'primary_column': column,
+        'columns': {column: {'encoding': 'WKB', 'geometry_types': [], 'crs_name': crs}}
+    }).encode('utf8')}
+
+
+def geoparquet_crs(schema):
+    """Return the CRS of the geometry column recorded in the GeoParquet metadata of an Arrow schema,
+    or DEFAULT_CRS if there is none"""
+
+    try:
+        geo = json.loads((schema.metadata or {})[b'geo'])
+        crs = geo['columns'][geo['primary_column']].get('crs_name')
+    except (KeyError, TypeError, ValueError):
+        crs = None
+
+    return crs or DEFAULT_CRS
+
+
+def row_generator_crs(rg):
+    """Return the CRS of the geometries that a row generator yields. Shapefile sources reproject their
+    rows to a target projection, which is only known after the source is opened if it is '<source>';
+    rows from other sources are assumed to be in DEFAULT_CRS"""
+
+    crs = getattr(rg, 'target_projection', None)
+
+    if crs == '<source>':
+        itr = iter(rg)
+        try:
+            next(itr, None)  # Opening the source sets the projection
+        finally:
+            itr.close()
+
+        crs = getattr(rg, 'projection', None)
+
+    return crs or DEFAULT_CRS
+
+
+def _column_values(column):
+    """Return the values of an Arrow array or chunked array as a numpy array"""
+    try:
+        return column.to_numpy(zero_copy_only=False)
+    except TypeError:  # ChunkedArray in older pyarrow
+        return column.to_pandas().to_numpy(dtype=object)
+
+
+def wkb_batch(batch, column=GEOMETRY_COLUMN):
+    """Return an Arrow record batch with the geometry column converted to WKB"""
+    import pyarrow as pa
+
+    i = batch.schema.get_field_index(column)
+
+    geometries = decode_geometry(_column_values(batch.column(i)))
+
+    arrays = list(batch.columns)
+    arrays[i] = pa.array(encode_wkb(geometries), type=pa.binary())
+
+    names = list(batch.schema.names)
+
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def wkb_schema(schema, column=GEOMETRY_COLUMN, crs=DEFAULT_CRS):
+    """Return a schema with the geometry column as binary, and GeoParquet metadata"""
+    import pyarrow as pa
+
+    i = schema.get_field_index(column)
+
+    return schema.set(i, pa.field(column, pa.binary())).with_metadata(geoparquet_metadata(column, crs))
+
+
+def geoframe_from_batches(batches, schema, columns=None, crs=DEFAULT_CRS):
+    """Build a GeoDataFrame from Arrow record batches or tables with a WKB geometry column, decoding the
+    geometries one batch at a time. The schema gives the order of the columns"""
+    import numpy as np
+    import pandas as pd
+    from geopandas import GeoDataFrame, GeoSeries
+
+    frames = []
+    geometries = []
+
+    for batch in batches:
+        i = batch.schema.get_field_index(GEOMETRY_COLUMN)
+
+        geometries.append(decode_geometry(_column_values(batch.column(i))))
+        frames.append(batch.drop_columns([GEOMETRY_COLUMN]).to_pandas() if hasattr(batch, 'drop_columns')
+                      else batch.to_pandas().drop(columns=[GEOMETRY_COLUMN]))
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+        geometry = np.concatenate(geometries)
+    else:
+        df = schema.empty_table().to_pandas().drop(columns=[GEOMETRY_COLUMN])
+        geometry = np.array([], dtype=object)
+
+    df[GEOMETRY_COLUMN] = GeoSeries(geometry, index=df.index)
+
+    names = [n for n in schema.names if columns is None or n in columns]
+
+    return GeoDataFrame(df[names], geometry=GEOMETRY_COLUMN, crs=crs)
+
+
+def _geo_columns(columns):
+    if columns is not None and GEOMETRY_COLUMN not in columns:
+        columns = list(columns) + [GEOMETRY_COLUMN]
+
+    return columns
+
+
+def read_geoparquet(path, columns=None, batch_size=DEFAULT_BATCH_SIZE, crs=None):
+    """Read a Parquet file with a WKB geometry column into a GeoDataFrame, decoding the geometries
+    one batch at a time. The CRS is the one in the file's GeoParquet metadata, unless crs is set"""
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+
+    columns = _geo_columns(columns)
+
+    return geoframe_from_batches(pf.iter_batches(batch_size=batch_size, columns=columns), pf.schema_arrow,
+                                 columns, crs or geoparquet_crs(pf.schema_arrow))
+
+
+def read_geoparquet_rows(path, rows, columns=None, crs=None):
+    """Read some rows of a Parquet file with a WKB geometry column into a GeoDataFrame. rows is a sorted
+    array of row numbers. Only the row groups that hold those rows are read, and only the geometries of
+    those rows are decoded. The CRS is the one in the file's GeoParquet metadata, unless crs is set"""
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+
+    columns = _geo_columns(columns)
+
+    rows = np.asarray(rows, dtype=np.int64)
+
+    def _tables():
+        start = 0
+
+        for i in range(pf.metadata.num_row_groups):
+            end = start + pf.metadata.row_group(i).num_rows
+
+            lo, hi = np.searchsorted(rows, [start, end])
+
+            if hi > lo:
+                t = pf.read_row_group(i, columns=columns)
+                yield t.take(pa.array(rows[lo:hi] - start))
+
+            start = end
+
+    return geoframe_from_batches(_tables(), pf.schema_arrow, columns, crs or geoparquet_crs(pf.schema_arrow))
@@ -0,0 +1,186 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Building and encoding JSON structures from rows.
+
+Resource.iterstruct builds a data structure for each row from the JSON paths of
+the columns, such as ``a.b`` or ``a[].b``, with rowgenerators' add_to_struct(),
+which parses every path again for every value. compile_struct_builder()
+parses the paths once and generates a function that builds the structure for
+a row with the same result. When the paths only have object keys, the
+function is a single nested dict expression.
+
+write_ndjson() writes the structures as JSON lines in large chunks, with one
+encoder for all of the rows, or with orjson, if it is installed and the fast
+encoder is requested.
+"""
+
+from rowgenerators.rowpipe.json import parse_path
+
+DEFAULT_NDJSON_CHUNK = 2000  # Rows per write
+
+
+def _is_object_path(parts):
+    return all(t == 'o' for _, t, _ in parts)
+
+
+def _object_template(paths):
+    """Return a nested dict of keys to row positions, for paths with only object keys, or None if a key is both
+    a value and an object, so the result would depend on the order of the columns"""
+
+    template = {}
+
+    for pos, parts in paths:
+        node = template
+
+        for key, _, is_terminal in parts:
+            if is_terminal:
+                if isinstance(node.get(key), dict):
+                    return None
+                node[key] = pos
+            else:
+                if key in node and not isinstance(node[key], dict):
+                    return None
+                node = node.setdefault(key, {})
+
+    return template
+
+
+def _template_code(template):
+    items = ('{!r}: {}'.format(k, _template_code(v) if isinstance(v, dict) else 'row[{}]'.format(v))
+             for k, v in template.items())
+
+    return '{' + ', '.join(items) + '}'
+
+
+def _path_code(pos, path, parts):
+    """Return statements that add the value at row[pos] to d, as add_to_struct() would"""
+
+    lines = ['o = d']
+
+    for key, t, is_terminal in parts:
+        k = repr(key)
+
+        if not is_terminal:
+            if t == 'an':
+                lines.append('n = {{}}; o.setdefault({}, []).append(n); o = n'.format(k))
+            elif t == 'al':
+                lines.append('if {k} not in o: raise Exception("Expected list {k} to exist in {p}")'
+                             .format(k=k.replace('"', '\\"'), p=repr(path).replace('"', '\\"')))
+                lines.append('o = o[{}][-1]'.format(k))
+            else:
+                lines.append('o = o.setdefault({}, {{}})'.format(k))
+        else:
+            if t == 'an':
+                lines.append('o.setdefault({}, []).append(row[{}])'.format(k, pos))
+            elif t == 'o':
+                lines.append('o[{}] = row[{}]'.format(k, pos))
+            # add_to_struct() ignores a terminal '[-]'
+
+    return lines
+
+
+def struct_builder_code(json_headers):
+    """Return the code for a ``build(row)`` function for a list of (position, JSON path) tuples"""
+
+    paths = [(pos, parse_path(path)) for pos, path in json_headers]
+
+    template = _object_template(paths) if all(_is_object_path(parts) for _, parts in paths) else None
+
+    if template is not None:
+        return 'def build(row):\n    return {}\n'.format(_template_code(template))
+
+    body = ['d = {}']
+
+    for (pos, path), (_, parts) in zip(json_headers, paths):
+        body.extend(_path_code(pos, path, parts))
+
+    body.append('return d')
+
+    return 'def build(row):\n' + ''.join('    {}\n'.format(l) for l in body)
+
+
+def compile_struct_builder(json_headers):
+    """Return a function that takes a row and returns the data structure that add_to_struct() builds from the
+    values of the row, for a list of (position, JSON path) tuples, as from Resource.json_headers"""
+
+    ns = {}
+
+    exec(compile(struct_builder_code(json_headers), '<struct builder>', 'exec'), ns)
+
+    return ns['build']
+
+
+def json_encoder(**kwargs):
+    """Return the encode() method of a JSON encoder, by default a VTEncoder, with json.dumps() arguments """
+    from rowgenerators.rowpipe.json import VTEncoder
+
+    cls = kwargs.pop('cls', None) or VTEncoder
+
+    return cls(**kwargs).encode
+
+
+def _orjson_encoder():
+    """Return a function that encodes a structure to bytes with orjson, converting dates and times to
+    strings as the VTEncoder does, or None if orjson is not installed"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    from rowgenerators.rowpipe.json import VTEncoder
+
+    default = VTEncoder().default
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def _encode(o):
+        return orjson.dumps(o, default=default, option=option)
+
+    return _encode
+
+
+def write_ndjson(structs, f, fast=False, chunk_size=DEFAULT_NDJSON_CHUNK):
+    """Write data structures to a text file as JSON lines, joining chunk_size lines for each write.
+    If fast is True and orjson is installed, it encodes the structures, and writes bytes to the file's
+    binary buffer, if it has one. orjson output is compact and not ASCII escaped, so it is not byte for byte
+    the same as json.dumps(). Returns the number of lines written.
+    """
+    from itertools import islice
+
+    encode = _orjson_encoder() if fast else None
+    buffer = None
+
+    if encode is not None:
+        buffer = getattr(f, 'buffer', None)
+
+        if buffer is not None:
+            f.flush()
+    else:
+        encode = json_encoder()
+
+    structs = iter(structs)
+    n = 0
+
+    while True:
+        lines = [encode(s) for s in islice(structs, chunk_size)]
+
+        if not lines:
+            break
+
+        n += len(lines)
+
+        if isinstance(lines[0], bytes):
+            chunk = b'\n'.join(lines) + b'\n'
+
+            if buffer is not None:
+                buffer.write(chunk)
+            else:
+                f.write(chunk.decode('utf8'))
+        else:
+            f.write('\n'.join(lines) + '\n')
+
+    if buffer is not None:
+        buffer.flush()
+
+    return n
@@ -0,0 +1,199 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Deferred parsing of metadata sections, for lazily loaded documents.
+
+A document opened with lazy=True parses only the Root, Resources and
+References sections when it is opened. The rows of the other sections,
+usually dominated by the Table.Column rows of the Schema section, are kept
+unparsed until the document needs them: when a search could match one of
+their terms, when one of the sections is requested by name, or when the whole
+document is iterated or written. Then they are parsed into the document, with
+the declarations of the first parse.
+"""
+
+from os.path import basename
+
+from metatab.parser import TermParser
+from metatab.util import slugify
+from rowgenerators import Source
+
+EAGER_SECTIONS = ('root', 'resources', 'references')  # Sections that lazy documents parse when they are opened
+
+
+class _RowSource(Source):
+    """A Source for rows that were already read from a file"""
+
+    def __init__(self, ref, rows):
+        super().__init__(ref)
+        self._rows = rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+
+class RowsTermParser(TermParser):
+    """A TermParser for a subset of the rows of a metadata file. Terms get the name of the file and the
+    line numbers of the rows in the file, as they would from parsing the whole file"""
+
+    def __init__(self, path, rows, line_numbers, doc):
+        super().__init__(_RowSource(path, rows), doc=doc)
+
+        self.file_name = slugify(basename(path))
+        self._line_numbers = line_numbers
+
+    def generate_terms(self, ref, root, file_type=None):
+
+        located = set()
+
+        for t in super().generate_terms(ref, root, file_type):
+            # Terms from declaration documents have file types, and sections can be yielded more than once
+            if t.file_type is None and t.row and id(t) not in located:
+                t.file_name = self.file_name
+                t.row = self._line_numbers[t.row - 1]
+                located.add(id(t))
+
+            yield t
+
+
+def is_root_term(term):
+    return '.' not in term or term.startswith('root.')
+
+
+def record_term(term):
+    return term.rpartition('.')[2]
+
+
+class DeferredSections(object):
+    """The unparsed rows of the sections of a metadata file that a lazy document has not loaded yet"""
+
+    def __init__(self, path, rows, line_numbers, section_names, root_terms, child_terms, section_order):
+        self.path = path
+        self.rows = rows
+        self.line_numbers = line_numbers
+        self.section_names = section_names  # Lowercased names of the deferred sections
+        self.root_terms = root_terms  # Lowercased record terms of the root level terms in the deferred rows
+        self.child_terms = child_terms  # Lowercased record terms of other terms, and the section arguments
+        self.section_order = section_order  # Names of all of the sections, in the order of the file
+
+    def __len__(self):
+        return len(self.rows)
+
+    def has_section(self, name):
+        return isinstance(name, str) and name.lower() in self.section_names
+
+    def matches(self, term, section=None, derived_terms=None):
+        """Return True if a search for terms could match terms in the deferred rows"""
+
+        if section is not None:
+            sections = [section] if isinstance(section, str) else section
+            return any(self.has_section(s) for s in sections)
+
+        terms = [term] if isinstance(term, str) else list(term)
+
+        for e in list(terms):
+            terms.extend((derived_terms or {}).get(str(e).lower(), []))
+
+        for e in terms:
+            e = str(e).lower()
+
+            if '*' in e:
+                return True
+
+            if record_term(e) in (self.root_terms if is_root_term(e) else self.child_terms):
+                return True
+
+        return False
+
+    def merged_section_order(self, loaded):
+        """Return the order of all of the sections, given the names of the loaded sections, which may include
+        sections that aren't in the file, such as those from declaration documents"""
+
+        position = {}
+        for i, name in enumerate(self.section_order):
+            position.setdefault(name, i)
+
+        pending = sorted(self.section_names, key=lambda n: position[n])
+        order = []
+
+        for name in loaded:
+            while name in position and pending and position[pending[0]] < position[name]:
+                order.append(pending.pop(0))
+
+            order.append(name)
+
+        return order + pending
+
+    def parser(self, doc):
+        """Return a parser for the deferred rows, with the declarations that the document already has"""
+
+        p = RowsTermParser(self.path, self.rows, self.line_numbers, doc)
+
+        p._declared_terms.update(doc.decl_terms)
+        p._declared_sections.update(doc.decl_sections)
+
+        return p
+
+
+def merge_terms(loaded, parsed, file_name):
+    """Merge terms parsed from deferred rows into a list of terms that were loaded before, in the order of
+    their rows in the file. Loaded terms from other files, or without rows, keep their places"""
+
+    parsed = list(parsed)
+    merged = []
+
+    for t in loaded:
+        if t.row and t.file_name == file_name:
+            while parsed and parsed[0].row < t.row:
+                merged.append(parsed.pop(0))
+
+        merged.append(t)
+
+    return merged + parsed
+
+
+def split_rows(path, rows, eager_sections=EAGER_SECTIONS):
+    """Split the rows of a metadata file into the rows of the eager sections, which are returned with their
+    line numbers, and a DeferredSections for the rest, or None if there are no other sections. Returns
+    None if the file includes other files, which must be parsed with it"""
+
+    eager, eager_lines = [], []
+    deferred, deferred_lines = [], []
+    section_names, root_terms, child_terms = set(), set(), set()
+    section_order = ['root']
+
+    in_deferred = False
+
+    for line_n, row in enumerate(rows, 1):
+
+        if not row or not row[0] or not str(row[0]).strip() or str(row[0]).strip().startswith('#'):
+            continue
+
+        term = str(row[0]).strip().lower()
+
+        if term in ('include', 'root.include'):
+            return None
+
+        if term in ('section', 'root.section'):
+            name = str(row[1]).strip().lower() if len(row) > 1 else ''
+            section_order.append(name)
+            in_deferred = name not in eager_sections
+
+            if in_deferred:
+                section_names.add(name)
+                child_terms.update(str(a).strip().lower() for a in row[2:] if str(a).strip())
+
+        if in_deferred:
+            deferred.append(row)
+            deferred_lines.append(line_n)
+            (root_terms if is_root_term(term) else child_terms).add(record_term(term))
+        else:
+            eager.append(row)
+            eager_lines.append(line_n)
+
+    if not deferred:
+        return eager, eager_lines, None
+
+    return eager, eager_lines, DeferredSections(path, deferred, deferred_lines, section_names, root_terms,
+                                                child_terms, section_order)
@@ -0,0 +1,168 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Persistent Parquet copies of processed resource data.
+
+The first time a resource is materialized, its processed rows are written to a
+Parquet file in the metapack cache. The file name includes a key built from the
+resolved URL, a fingerprint of the source file, a fingerprint of the
+schema and a fingerprint of the package's python library, which can define
+transforms and generators, so a change to any of them causes the file to be
+rebuilt.
+
+Geo resources can also be materialized with the geometry column as WKB, in a
+separate file with GeoParquet metadata, for Resource.geoframe().
+"""
+
+import hashlib
+import json
+from glob import glob
+from os import remove, replace, stat
+from os.path import exists, join
+
+from metatab.util import slugify
+
+from metapack.constants import MATERIALIZED_PARQUET_PREFIX
+from metapack.util import ensure_dir, path_lock, temp_path
+
+
+def materialized_cache_dir(doc):
+    """Return the cache directory for a document's materialized Parquet files"""
+
+    dr = doc._cache.getsyspath(join(MATERIALIZED_PARQUET_PREFIX, slugify(doc.name)))
+
+    ensure_dir(dr)
+
+    return dr
+
+
+def schema_fingerprint(resource):
+    """Return a hash of the parts of the schema that affect the processed data"""
+
+    keys = ('header', 'name', 'datatype', 'valuetype', 'transform', 'width')
+
+    schema = [[str(c.get(k)) for k in keys] for c in resource.schema_columns]
+
+    return hashlib.md5(json.dumps(schema).encode('utf8')).hexdigest()
+
+
+def source_fingerprint(resource):
+    """Return a fingerprint for the resource's source file, from the size and modification time of the
+    local copy of the target, or None if the source is not a file, such as a python: generator. """
+
+    try:
+        t = resource.plan.target
+    except AttributeError:
+        return None
+
+    if t.scheme != 'file':
+        return None
+
+    try:
+        st = stat(str(t.fspath))
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    return '{}:{}:{}'.format(t.fspath, st.st_size, st.st_mtime_ns)
+
+
+def materialized_key(resource):
+    """Return the cache key for a resource, or None if the resource can't be materialized"""
+
+    source_fp = source_fingerprint(resource)
+
+    if source_fp is None:
+        return None
+
+    k = '\n'.join([str(resource.resolved_url), source_fp, schema_fingerprint(resource),
+                   repr(resource.doc._lib_fingerprint())])
+
+    return hashlib.md5(k.encode('utf8')).hexdigest()
+
+
+def _suffix(geo):
+    return '.wkb.parquet' if geo else '.parquet'
+
+
+def materialized_path(resource, geo=False):
+    """Return the path to the Parquet file for a resource, which may not exist yet, or None if the
+    resource can't be materialized. If geo is True, the path is for the file with WKB geometries"""
+
+    key = materialized_key(resource)
+
+    if key is None:
+        return None
+
+    return join(materialized_cache_dir(resource.doc), '{}-{}{}'.format(slugify(resource.name), key, _suffix(geo)))
+
+
+def write_parquet(resource, path, batch_size=None, geo=False):
+    """Write the processed data of a resource to a Parquet file. The file is written to a temporary
+    name and moved into place, so a failed write never leaves a partial file at the final path. If geo
+    is True, the geometry column is written as WKB, with GeoParquet metadata that records the CRS of
+    the geometries the resource's row generator yields"""
+    import pyarrow.parquet as pq
+
+    tmp_path = temp_path(path)
+
+    reader = resource.arrow_reader(batch_size)
+
+    schema = reader.schema
+
+    if geo:
+        from metapack.geo import row_generator_crs, wkb_batch, wkb_schema
+
+        schema = wkb_schema(schema, crs=row_generator_crs(resource.row_generator))
+    else:
+        wkb_batch = None
+
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for batch in reader:
+                writer.write_batch(wkb_batch(batch) if wkb_batch else batch)
+    except Exception:
+        if exists(tmp_path):
+            remove(tmp_path)
+        raise
+
+    replace(tmp_path, path)
+
+    return path
+
+
+def materialize(resource, force=False, batch_size=None, geo=False):
+    """Return the path to an up to date Parquet copy of the resource, writing it if necessary.
+    Returns None if the resource can't be materialized. Copies made for old versions of the
+    source or schema are removed. If geo is True, the copy has the geometry column as WKB"""
+
+    path = materialized_path(resource, geo)
+
+    if path is None:
+        return None
+
+    # Other threads that want the same file wait for this one to write it
+    with path_lock(path):
+        if exists(path) and not force:
+            return path
+
+        return _materialize(resource, path, batch_size, geo)
+
+
+def _materialize(resource, path, batch_size, geo):
+
+    pattern = '{}-{}{}'.format(slugify(resource.name), '[0-9a-f]' * 32, _suffix(geo))
+
+    for old_path in glob(join(materialized_cache_dir(resource.doc), pattern)):
+        if old_path != path and exists(old_path):
+            remove(old_path)
+
+    if geo:
+        # The spatial index envelopes of old or rewritten copies are out of date
+        from metapack.spatial import ENVELOPES_SUFFIX
+
+        for old_path in glob(join(materialized_cache_dir(resource.doc),
+                                  '{}-{}{}'.format(slugify(resource.name), '[0-9a-f]' * 32, ENVELOPES_SUFFIX))):
+            remove(old_path)
+
+    return write_parquet(resource, path, batch_size, geo)
@@ -3,6 +3,8 @@
 
 """ """
 
+from threading import Lock
+
 from rowgenerators import Downloader as _Downloader
 from rowgenerators import parse_app_url
 
@@ -16,6 +18,8 @@ class Downloader(_Downloader):
 
     ok = True
 
+    _instance_lock = Lock()  # So threads that open documents at the same time share one singleton
+
     def __init__(self, cache=None, account_accessor=None, logger=None, working_dir='', callback=None):
         from rowgenerators import get_cache
         super().__init__(cache or get_cache('metapack'),
@@ -24,15 +28,36 @@ class Downloader(_Downloader):
     def download(self, url):
         return super().download(url)
 
+    @staticmethod
+    def get_instance(cache=None, account_accessor=None, logger=None, working_dir='', callback=None):
+        """Return the memoized singleton, creating it if it doesn't exist yet"""
+
+        with Downloader._instance_lock:
+            return _Downloader.get_instance(cache, account_accessor, logger, working_dir, callback)
+
 
-def open_package(ref, downloader=None):
+def open_package(ref, downloader=None, lazy=False, shared=False):
+    """Open a package from a path or URL, which may have a resource name fragment. If lazy is True, the
+    package parses only its Root, Resources and References sections until others are needed.
+
+    If shared is True, the document is shared through the document registry, so opening the same package
+    again returns the same document, unless its metadata file has changed. Changes to a shared document
+    are seen by all of its users. References with a resource name fragment, and calls with a downloader
+    other than the one the shared document has, always get their own document"""
     from metapack.doc import MetapackDoc
+    from metapack.registry import DocumentRegistry
+
+    shared_downloader = downloader
 
     if downloader is None:
         downloader = Downloader()
 
     if isinstance(ref, MetapackUrl):
-        p = MetapackDoc(ref, downloader=downloader)
+        if shared:
+            p = DocumentRegistry.get_instance().get(ref, shared_downloader, lazy)
+        else:
+            p = MetapackDoc(ref, downloader=downloader, lazy=lazy)
+
         p.default_resource = None
         return p
 
@@ -47,7 +72,12 @@ def open_package(ref, downloader=None):
 
         u = MetapackUrl(ref, downloader=downloader)
 
-        p = MetapackDoc(u, downloader=downloader)
+        # The default resource is set on the document, so documents opened for a resource aren't shared
+        if shared and not u.resource_name:
+            p = DocumentRegistry.get_instance().get(u, shared_downloader, lazy)
+        else:
+            p = MetapackDoc(u, downloader=downloader, lazy=lazy)
+
         p.default_resource = u.resource_name
         return p
 
@@ -0,0 +1,134 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Process-pool row processing.
+
+Row processor transforms are Python expressions, so processing is bound to
+one core. For large resources, the source rows can instead be read in chunks
+in the main process and sent to a pool of worker processes. Each worker opens
+the package itself, builds the row processors for the resource once, and
+returns the processed rows and casting errors for each chunk. Chunks are
+returned in order, and only a few chunks per worker are in flight at a time.
+
+Because each worker has its own row processors, the scratch and accumulator
+dicts that transforms can use to keep state from row to row only see the rows
+of the chunks that went to that worker. Resources with transforms that name
+them can't be processed in workers; functions that use them can't be detected,
+so they must not be used with workers.
+"""
+
+import re
+from collections import deque
+
+from metapack.casterrors import ErrorSummary
+
+# The selection processor of the current worker process, and the key it was built for
+_worker_selection = None
+
+_row_state = re.compile(r'\b(scratch|accumulator)\b')
+
+
+def stateful_columns(rptable):
+    """Return the names of the columns of a row processor table with transforms that use the scratch or
+    accumulator dicts, which hold state across rows"""
+
+    return [c.name for c in rptable.columns if c.transform and _row_state.search(str(c.transform))]
+
+
+def _selection_for(ref, name, columns, where, summarize=False):
+    """Return the SelectionProcessor for a resource in a worker process, building it on the first call"""
+    global _worker_selection
+
+    key = (ref, name, tuple(columns), summarize)
+
+    if _worker_selection is None or _worker_selection[0] != key:
+        from metapack import open_package
+        from metapack.processor import SelectionProcessor
+
+        doc = open_package(ref)
+        r = doc.resource(name) or doc.reference(name)
+        r.summarize_errors = summarize
+
+        base_row_gen = r.row_generator
+
+        sp = SelectionProcessor(r.plan.rptable, columns, where,
+                                make_processor=lambda t: r._row_processor(base_row_gen, t),
+                                source_headers=r.source_headers, env=r.env)
+
+        _worker_selection = (key, sp)
+
+    return _worker_selection[1]
+
+
+def process_chunk_worker(ref, name, columns, where, rows, row_n, summarize=False):
+    """Process one chunk of source rows in a worker process. Returns the processed rows and the casting
+    errors for the chunk, as a dict of lists of messages or, if summarize is True, an ErrorSummary"""
+
+    sp = _selection_for(ref, name, columns, where, summarize)
+
+    sp.clear_errors()
+
+    rows = sp.process_chunk(rows, row_n)
+
+    if summarize:
+        return rows, sp.errors
+    else:
+        return rows, {k: list(v) for k, v in sp.errors.items()}
+
+
+def iter_parallel(chunks, ref, name, columns, where=None, workers=2, errors=None):
+    """Process chunks of source rows in a pool of worker processes, and yield the processed rows in
+    order. Casting errors are added to errors, if it is given. Each worker only sees the errors of its
+    own chunk, so unless the errors are summarized, the errors from all of the chunks are counted here,
+    and TooManyCastingErrors is raised at the same count as for serial processing. Each worker also has
+    its own scratch and accumulator dicts, so transforms that keep state across rows must not be used;
+    see stateful_columns()
+
+    :param chunks: Iterable of (rows, row numbers) tuples
+    :param ref: Reference to the package, which the workers open
+    :param name: Name of the resource or reference
+    :param columns: Names of the columns to return
+    :param where: Row selection, which must be picklable, so it is usually a dict of column names to values
+    :param workers: Number of worker processes
+    :param errors: Dict of column names to sets of error messages, or an ErrorSummary, which the workers
+        then also use
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from rowgenerators.valuetype.core import count_errors
+
+    pending = deque()
+
+    summarize = isinstance(errors, ErrorSummary)
+
+    if errors is None:
+        errors = {}
+
+    def _results(future):
+        rows, chunk_errors = future.result()
+
+        if summarize:
+            errors.merge(chunk_errors)
+        else:
+            for k, v in chunk_errors.items():
+                errors.setdefault(k, set()).update(v)
+
+            if chunk_errors:
+                count_errors(errors)
+
+        return rows
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for rows, row_n in chunks:
+                pending.append(executor.submit(process_chunk_worker, ref, name, columns, where, rows, row_n,
+                                               summarize))
+
+                if len(pending) >= workers * 2:
+                    yield from _results(pending.popleft())
+
+            while pending:
+                yield from _results(pending.popleft())
+        finally:
+            for f in pending:
+                f.cancel()
@@ -0,0 +1,80 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Cached resolution of a resource's URL, schema and headers.
+
+Resolving a resource involves parsing and joining URLs, searching the document
+for the schema and building a row processor table, and all of that was
+repeated on every property access. A ResolutionPlan holds those results for
+one version of the resource's document; the resource replaces it when the
+document's change counter shows that any of its terms have changed.
+"""
+
+
+class ResolutionPlan(object):
+    """The resolved URL, target, start, end and header lines, schema term, headers and row processor table
+    for a resource. Each value is computed by the resource the first time it is requested and is not
+    recomputed for the life of the plan. """
+
+    def __init__(self, resource, key):
+        self._resource = resource
+        self._values = {}
+        self.key = key
+
+    def _get(self, name, f):
+        try:
+            return self._values[name]
+        except KeyError:
+            v = self._values[name] = f()
+            return v
+
+    @property
+    def expanded_url(self):
+        return self._get('expanded_url', self._resource._make_expanded_url)
+
+    @property
+    def resolved_url(self):
+        return self._get('resolved_url', self._resource._make_resolved_url)
+
+    @property
+    def target(self):
+        """The target of the resolved URL, or None if the URL has no resource"""
+
+        def f():
+            rur = self.resolved_url.get_resource()
+            return rur.get_target() if rur else None
+
+        return self._get('target', f)
+
+    @property
+    def start_end_header(self):
+        return self._get('start_end_header', self._resource._make_start_end_header)
+
+    @property
+    def header_lines(self):
+        return self.start_end_header[0]
+
+    @property
+    def start(self):
+        return self.start_end_header[1]
+
+    @property
+    def end(self):
+        return self.start_end_header[2]
+
+    @property
+    def schema_term(self):
+        return self._get('schema_term', self._resource._find_schema_term)
+
+    @property
+    def headers(self):
+        return self._get('headers', self._resource._make_headers)
+
+    @property
+    def source_headers(self):
+        return self._get('source_headers', self._resource._make_source_headers)
+
+    @property
+    def rptable(self):
+        return self._get('rptable', self._resource.row_processor_table)
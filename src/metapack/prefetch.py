@@ -0,0 +1,100 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Concurrent download of the remote files of a package.
+
+Resources are downloaded when their rows are first requested, one at a time,
+so building a package that references many remote files spends most of its
+time waiting on each download in turn. Prefetching resolves the URLs of the
+resources and references first, removes duplicates, such as several resources
+that are files in the same ZIP archive, and downloads the files into the
+Downloader cache from a pool of threads. Each host gets only a few concurrent
+downloads. When the resources are read later, their files are found in the
+cache.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8  # Number of concurrent downloads
+DEFAULT_PER_HOST = 4  # Number of concurrent downloads from one host
+
+
+def download_url(term):
+    """Return the URL that must be downloaded to read a resource or reference, or None if the term has no URL,
+    or if its URL is a local file or isn't a file, such as a Python or SQL URL"""
+    from rowgenerators.appurl.web.web import WebUrl
+
+    try:
+        u = term.resolved_url.inner
+    except Exception:  # Terms that can't be resolved report the error when they are used
+        return None
+
+    return u if isinstance(u, WebUrl) else None
+
+
+def host_of(url):
+    """Return the host that a URL is downloaded from"""
+    from urllib.parse import urlparse
+
+    return urlparse(str(url.resource_url)).netloc.lower()
+
+
+def prefetch_terms(terms, downloader, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST):
+    """Download the files for resource and reference terms into the cache of a downloader. Returns an ordered
+    dict of the URLs of the files to the paths of the local copies, or, for files that could not be downloaded,
+    the exceptions. Download errors are not raised, since they are raised again when the terms are used
+
+    :param terms: Resource or Reference terms
+    :param downloader: Downloader that the files are downloaded with
+    :param workers: Number of concurrent downloads
+    :param per_host: Number of concurrent downloads from one host
+    """
+
+    urls = OrderedDict()
+
+    for t in terms:
+        u = download_url(t)
+
+        if u is not None:
+            urls.setdefault(str(u.resource_url), u)
+
+    if not urls:
+        return OrderedDict()
+
+    host_locks = {host_of(u): threading.BoundedSemaphore(per_host) for u in urls.values()}
+
+    def fetch(u):
+        with host_locks[host_of(u)]:
+            try:
+                return downloader.download(u).sys_path
+            except Exception as e:
+                return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as executor:
+        # Alternate hosts, so the pool isn't filled with threads that wait for one of them
+        futures = OrderedDict((k, executor.submit(fetch, urls[k])) for k in _interleave_hosts(urls))
+
+        results = {k: f.result() for k, f in futures.items()}
+
+    return OrderedDict((k, results[k]) for k in urls)
+
+
+def _interleave_hosts(urls):
+    """Return the keys of an ordered dict of URLs, ordered to take one URL from each host in turn"""
+
+    by_host = OrderedDict()
+
+    for k, u in urls.items():
+        by_host.setdefault(host_of(u), []).append(k)
+
+    queues = list(by_host.values())
+    keys = []
+
+    while queues:
+        keys.extend(q.pop(0) for q in queues)
+        queues = [q for q in queues if q]
+
+    return keys
@@ -0,0 +1,537 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Chunked row processing.
+
+The rowgenerators RowProcessor runs every cell of every row through generated
+per-column functions. For columns whose only processing is a datatype cast, that
+per-cell work can be done on a whole chunk of the column at once with pandas.
+The ChunkedRowProcessor splits a row processor table into those cast-only
+columns and the columns with transforms, casts the first group column-wise and
+runs the second through a RowProcessor. The CompiledRowProcessor runs rows
+through a single function generated for the whole table by metapack.codegen.
+"""
+
+from collections import defaultdict
+from datetime import date, datetime
+from itertools import islice
+
+from metapack.casterrors import ErrorSummary
+from metapack.columnar import transpose_rows
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# Python datatypes of row processor columns that can be cast column-wise, and the
+# name used for the type in casting error messages.
+vector_cast_types = {
+    int: 'int',
+    float: 'float',
+    str: 'str',
+    date: 'date',
+    datetime: 'datetime'
+}
+
+# Source strings that the column-wise casts convert to exactly the values that the row processor's value
+# types and cast functions produce. Other values are cast one at a time, the way the row processor does.
+_fast_patterns = {
+    int: r'[+-]?\d{1,15}',  # Short enough that IntValue's conversion through float is exact
+    float: r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?',
+    date: r'\d{4}-\d{2}-\d{2}',
+    # The row processor drops fractional seconds, so those are left to the slow path
+    datetime: r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2})?)?'
+}
+
+
+def _plain_valuetypes():
+    """Return the value types that the row processor uses for the plain datatypes. Columns with other value
+    types, such as a year, have their own conversions"""
+    from rowgenerators.valuetype import resolve_value_type
+
+    return tuple(resolve_value_type(n) for n in ('int', 'float', 'str', 'text', 'date', 'datetime'))
+
+
+def is_vector_column(c):
+    """Return True if the only processing for a row processor table column is a datatype cast, with the value
+    type for the datatype"""
+    return (not c.transform and any(c.datatype is t for t in vector_cast_types)
+            and c.valuetype in _plain_valuetypes())
+
+
+def cast_value(v, valuetype, datatype, header, errors, row_n=None):
+    """Cast one source value the way the row processor does, with the column's value type and then the
+    cast function for the datatype, recording a failure in errors. The row processor raises an exception
+    for values that the value type itself can't handle; here, they are recorded as casting errors"""
+    import rowgenerators.valuetype as vt
+    from rowgenerators.valuetype.core import count_errors
+    from metapack import casterrors
+
+    type_name = vector_cast_types[datatype]
+
+    try:
+        v = valuetype(v)
+    except Exception as e:
+        if isinstance(errors, ErrorSummary):
+            errors.add(header, v, row_n)
+        else:
+            errors[header].add(u"Failed to cast '{}' ( {} ) to {} in '{}': {}".format(v, type(v), type_name,
+                                                                                      header, e))
+            count_errors(errors)
+        return None
+
+    if isinstance(errors, ErrorSummary):
+        if datatype in (int, float, str):
+            return getattr(casterrors, 'cast_' + type_name)(v, header, errors, row_n)
+        else:
+            return casterrors.cast_other(getattr(vt, 'cast_' + type_name), v, header, errors, row_n)
+
+    return getattr(vt, 'cast_' + type_name)(v, header, errors)
+
+
+def _fast_mask(s, datatype):
+    """Return a boolean array of the values of a series that the column-wise cast handles"""
+    import numpy as np
+
+    is_str = np.fromiter((type(v) is str for v in s), dtype=bool, count=len(s))
+
+    if datatype is str:
+        return is_str
+
+    fast = np.zeros(len(s), dtype=bool)
+
+    if is_str.any():
+        fast[is_str] = s[is_str].str.fullmatch(_fast_patterns[datatype]).to_numpy(dtype=bool)
+
+    if datatype is float:  # Python numbers convert directly
+        fast |= np.fromiter((type(v) in (int, float) for v in s), dtype=bool, count=len(s))
+    elif datatype is int:
+        fast |= np.fromiter((type(v) is int and -2 ** 53 < v < 2 ** 53 for v in s), dtype=bool, count=len(s))
+
+    return fast
+
+
+def cast_column(values, datatype, header, errors, row_numbers=None, valuetype=None):
+    """Cast a sequence of source values to a python datatype, all at once, with the same results as the
+    per-cell casts in the row processor. Empty values become None, and values that can't be cast become
+    None and are recorded in errors, with their row numbers if errors is an ErrorSummary. Values in forms
+    that the column-wise casts don't handle exactly are cast one at a time with cast_value(), using the
+    column's value type, or the one for the datatype. Returns a list. """
+    import numpy as np
+    import pandas as pd
+
+    if valuetype is None:
+        from rowgenerators.valuetype import resolve_value_type
+        valuetype = resolve_value_type(vector_cast_types[datatype])
+
+    s = pd.Series(values, dtype=object)
+
+    empty = np.fromiter((v is None or (type(v) is str and v == '') for v in s), dtype=bool, count=len(s))
+
+    fast = _fast_mask(s, datatype) & ~empty
+
+    out = np.full(len(s), None, dtype=object)
+
+    if fast.any():
+        f = s[fast]
+
+        if datatype is str:
+            converted = f.to_numpy()
+        elif datatype is int:
+            converted = f.astype('int64').to_numpy()
+        elif datatype is float:
+            converted = f.astype('float64').to_numpy()
+        else:
+            dt = pd.to_datetime(f, errors='coerce', format='ISO8601')
+
+            # Out of range or impossible dates, like 2020-13-01, are left to the slow path
+            bad = dt.isna().to_numpy()
+            fast[fast.nonzero()[0][bad]] = False
+            dt = dt[~bad]
+
+            # The value types make the same DateVT and DateTimeVT objects as the row processor
+            converted = np.array([valuetype(d) for d in (dt.dt.date if datatype is date
+                                                         else dt.dt.to_pydatetime())], dtype=object)
+
+        if len(converted):
+            out[fast] = converted.tolist()
+
+    for i in (~(fast | empty)).nonzero()[0]:
+        out[i] = cast_value(s.iat[i], valuetype, datatype, header, errors,
+                            row_numbers[i] if row_numbers is not None else None)
+
+    return out.tolist()
+
+
+def row_numbers(rows, row_n):
+    """Return the row numbers for a list of rows, given either the number of the first row or a
+    sequence of numbers, one per row"""
+
+    if isinstance(row_n, int):
+        return range(row_n, row_n + len(rows))
+    else:
+        return row_n
+
+
+def process_rows(rp, rows, row_n=0):
+    """Run the compiled row processors of a rowgenerators RowProcessor over a list of rows, numbering the
+    rows from row_n, or with the row numbers in row_n, if it is a sequence. This is the inner loop
+    of RowProcessor.__iter__(), for callers that supply rows in chunks."""
+    from rowgenerators.rowproxy import RowProxy
+    from rowgenerators.rowpipe.exceptions import RowProcessorError
+
+    pipe = rp.env['pipe']
+
+    rp1 = RowProxy(rp.source_headers)  # The first processor step uses the source row structure
+    rp2 = RowProxy(rp.dest_table.headers)  # Subsequent steps use the dest table
+
+    out = []
+
+    for i, row in zip(row_numbers(rows, row_n), rows):
+
+        try:
+            proxy = rp1
+
+            for proc in rp.procs:
+                row = proc(proxy.set_row(row), i, rp.errors, rp.scratch, rp.accumulator,
+                           pipe, rp.manager, rp.source)
+
+                proxy = rp2
+
+            out.append(row)
+        except Exception as e:
+            raise RowProcessorError("Exception at source ({}) row {}: {}".format(type(rp.source), i, str(e))) from e
+
+    return out
+
+
+class CompiledRowProcessor(object):
+    """A replacement for the rowgenerators RowProcessor that reads the source in chunks and runs each chunk
+    through a function compiled for the whole row processor table. Like the RowProcessor, it yields
+    processed rows, without a header, and collects casting errors in the errors property.
+
+    The generated code is saved next to code_path, and code_key is any other value that the code
+    depends on, such as a fingerprint of the transform functions. If errors is an ErrorSummary, casting
+    errors are recorded in it, rather than as messages, and TooManyCastingErrors is never raised. """
+
+    def __init__(self, source, dest_table, source_headers=None, env=None, manager=None, code_path=None,
+                 code_key=None, chunk_size=DEFAULT_CHUNK_SIZE, errors=None):
+        from rowgenerators.rowpipe.exceptions import RowProcessorError
+        from metapack.codegen import compile_row_function
+
+        if not dest_table:
+            raise RowProcessorError("No destination row processor table")
+
+        self.source = source
+        self.dest_table = dest_table
+        self.source_headers = source_headers if source_headers is not None else source.headers
+        self.manager = manager
+        self.chunk_size = chunk_size
+
+        self.scratch = {}
+        self.accumulator = {}
+        self.errors = errors if errors is not None else defaultdict(set)
+
+        self.process_rows = compile_row_function(self.source_headers, dest_table, env, code_path, code_key,
+                                                 summary=isinstance(self.errors, ErrorSummary))
+
+    @property
+    def headers(self):
+        return self.dest_table.headers
+
+    @property
+    def meta(self):
+        return {}
+
+    def process_chunk(self, rows, row_n=0):
+        """Process a list of source rows, with row numbers starting at row_n, or with the row numbers in
+        row_n, if it is a sequence, and return a list of rows"""
+
+        return self.process_rows(rows, row_numbers(rows, row_n), self.errors, self.scratch, self.accumulator,
+                                 None, self.manager, self.source)
+
+    def __iter__(self):
+
+        source = iter(self.source)
+        row_n = 0
+
+        while True:
+            rows = list(islice(source, self.chunk_size))
+
+            if not rows:
+                break
+
+            yield from self.process_chunk(rows, row_n)
+
+            row_n += len(rows)
+
+
+class ChunkedRowProcessor(object):
+    """A replacement for the rowgenerators RowProcessor that reads the source in chunks, casts
+    cast-only columns column-wise and sends only the columns with transforms, and the columns that
+    transforms refer to, through a RowProcessor, or a CompiledRowProcessor if compiled is True.
+    Like the RowProcessor, it yields processed rows, without a header, and collects casting
+    errors in the errors property. If errors is an ErrorSummary, casting errors are recorded in it,
+    and the transformed columns always go through a CompiledRowProcessor. """
+
+    def __init__(self, source, dest_table, source_headers=None, env=None, manager=None, code_path=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, compiled=False, code_key=None, errors=None):
+        from rowgenerators.rowpipe import RowProcessor
+        from rowgenerators.rowpipe import Table
+        from metapack.codegen import table_references, transform_env
+
+        self.source = source
+        self.dest_table = dest_table
+        self.source_headers = source_headers if source_headers is not None else source.headers
+        self.chunk_size = chunk_size
+
+        self.errors = errors if errors is not None else defaultdict(set)
+
+        # Each entry is (dest position, source position or None, python datatype, header, value type)
+        self.vector_columns = []
+
+        transform_columns = []
+
+        # Columns that transforms refer to must be processed with them. None means that some transform
+        # uses the whole row, so all columns are.
+        referenced = table_references(dest_table, transform_env(env))
+
+        for i_d, c in enumerate(dest_table):
+            if is_vector_column(c) and referenced is not None and c.name not in referenced:
+                i_s = self.source_headers.index(c.name) if c.name in self.source_headers else None
+                self.vector_columns.append((i_d, i_s, c.datatype, c.name, c.valuetype))
+            else:
+                transform_columns.append((i_d, c))
+
+        self.rp = None
+        self.rp_map = []  # Dest positions for the columns of the rows from self.rp
+
+        if transform_columns:
+            t = Table(dest_table.name)
+
+            # The row processor gives the first column the row number if it isn't in the source,
+            # so the first dest column always stays first.
+            if transform_columns[0][0] != 0:
+                transform_columns.insert(0, (None, dest_table.columns[0]))
+
+            for i_d, c in transform_columns:
+                t.columns.append(c)
+                self.rp_map.append(i_d)
+
+            if compiled or isinstance(self.errors, ErrorSummary):
+                self.rp = CompiledRowProcessor(source, t, source_headers=self.source_headers, manager=manager,
+                                               env=env, code_path=code_path, code_key=code_key,
+                                               errors=self.errors)
+            else:
+                self.rp = RowProcessor(source, t, source_headers=self.source_headers, manager=manager,
+                                       env=env, code_path=code_path)
+
+            # Share the errors, so casting errors from both halves are in one place
+            self.rp.errors = self.errors
+
+    @classmethod
+    def can_process(cls, dest_table):
+        """Return True if the table has columns that would be cast column-wise, and all of the transforms
+        are single stage, so they don't refer to values of other processed columns."""
+
+        try:
+            import pandas  # noqa: F401
+        except ImportError:
+            return False
+
+        columns = list(dest_table)
+
+        return (any(is_vector_column(c) for c in columns)
+                and not any(';' in (c.transform or '') for c in columns))
+
+    @property
+    def headers(self):
+        return self.dest_table.headers
+
+    @property
+    def meta(self):
+        return {}
+
+    def process_chunk(self, rows, row_n=0):
+        """Process a list of source rows, with row numbers starting at row_n, or with the row numbers in
+        row_n, if it is a sequence, and return a list of rows"""
+
+        n = len(rows)
+
+        numbers = row_numbers(rows, row_n)
+
+        src_cols = transpose_rows(rows, len(self.source_headers))
+
+        out_cols = [None] * len(self.dest_table.columns)
+
+        for i_d, i_s, datatype, header, valuetype in self.vector_columns:
+            if i_s is not None:
+                out_cols[i_d] = cast_column(src_cols[i_s], datatype, header, self.errors, numbers, valuetype)
+            elif i_d == 0:
+                out_cols[i_d] = numbers
+            else:
+                out_cols[i_d] = (None,) * n
+
+        if self.rp:
+            rp_cols = transpose_rows(process_chunk(self.rp, rows, row_n), len(self.rp_map))
+
+            for i_d, col in zip(self.rp_map, rp_cols):
+                if i_d is not None:
+                    out_cols[i_d] = col
+
+        return [list(r) for r in zip(*out_cols)]
+
+    def __iter__(self):
+
+        source = iter(self.source)
+        row_n = 0
+
+        while True:
+            rows = list(islice(source, self.chunk_size))
+
+            if not rows:
+                break
+
+            yield from self.process_chunk(rows, row_n)
+
+            row_n += len(rows)
+
+
+def process_chunk(processor, rows, row_n=0):
+    """Process a list of source rows with a ChunkedRowProcessor, a CompiledRowProcessor or a rowgenerators
+    RowProcessor"""
+
+    if isinstance(processor, (ChunkedRowProcessor, CompiledRowProcessor)):
+        return processor.process_chunk(rows, row_n)
+    else:
+        return process_rows(processor, rows, row_n)
+
+
+def project_table(table, columns, env=None):
+    """Return a row processor table with only the named columns, and the columns that transforms refer
+    to, and the positions of the named columns in the rows it produces. The first column of the table is
+    always kept, because the row processor gives it the row number if it is not in the source. Tables
+    with multi-stage transforms, or with transforms that use the whole row, are returned whole. env is
+    the transform environment. """
+    from rowgenerators.rowpipe import Table
+    from metapack.codegen import table_references, transform_env
+
+    referenced = None
+
+    if not any(';' in (c.transform or '') for c in table.columns):
+        referenced = table_references(table, transform_env(env))
+
+    if referenced is None:
+        t = table
+    else:
+        by_name = {c.name: c for c in table.columns}
+
+        t = Table(table.name)
+        t.columns.append(table.columns[0])
+
+        for name in list(columns) + sorted(referenced):
+            if name != table.columns[0].name and by_name[name] not in t.columns:
+                t.columns.append(by_name[name])
+
+    headers = list(t.headers)
+
+    return t, [headers.index(name) for name in columns]
+
+
+def row_filter(where):
+    """Return a function that takes a list of values for the keys of the where dict, in order, and
+    returns True if each value is equal to the dict value, or, for dict values that are functions,
+    if the function returns True for the value"""
+
+    tests = [v if callable(v) else (lambda x, v=v: x == v) for v in where.values()]
+
+    def _f(values):
+        return all(f(v) for f, v in zip(tests, values))
+
+    return _f
+
+
+class SelectionProcessor(object):
+    """Processes chunks of source rows for a selection of columns and rows. Rows are selected with
+    a where argument, as for Resource.iterate(): either a function of a RowProxy of the source row, or a
+    dict of column names to values or functions of the processed value. For a dict, the filter columns
+    are processed first, and the selected columns only for the rows that pass.
+
+    :param rptable: The resource's row processor table
+    :param columns: Names of the columns to return, in order
+    :param where: Row selection
+    :param make_processor: A function that takes a row processor table and returns a row processor
+    :param source_headers: Headers of the source rows, for the RowProxy given to a where function
+    :param env: The transform environment
+    """
+
+    def __init__(self, rptable, columns, where=None, make_processor=None, source_headers=None, env=None):
+        from rowgenerators.rowproxy import RowProxy
+
+        self.columns = list(columns)
+        self.where = where
+
+        table, self.positions = project_table(rptable, self.columns, env)
+        self.proc = make_processor(table)
+        self.processors = [self.proc]
+
+        if isinstance(where, dict):
+            f_table, self.f_positions = project_table(rptable, list(where), env)
+            self.f_proc = make_processor(f_table)
+            self.processors.append(self.f_proc)
+            self.test = row_filter(where)
+        elif where is not None:
+            self.proxy = RowProxy(source_headers)
+
+    @property
+    def errors(self):
+        """Casting errors from all of the processors, merged. Errors in columns that both processors
+        cast are only taken from the processor for the selected columns. """
+
+        summary = isinstance(self.proc.errors, ErrorSummary)
+
+        errors = ErrorSummary() if summary else {}
+
+        headers = set(self.proc.dest_table.headers)
+
+        for p in self.processors:
+            if summary:
+                part = ErrorSummary()
+                part.columns = {k: c for k, c in p.errors.items() if p is self.proc or k not in headers}
+                errors.merge(part)
+            else:
+                for k, v in p.errors.items():
+                    if p is self.proc or k not in headers:
+                        errors.setdefault(k, set()).update(v)
+
+        return errors
+
+    def clear_errors(self):
+        for p in self.processors:
+            p.errors.clear()
+
+    def select_rows(self, rows, row_n=0):
+        """Return the source rows that the where argument selects, and their row numbers"""
+
+        numbers = row_numbers(rows, row_n)
+
+        if self.where is None:
+            return rows, numbers
+
+        if isinstance(self.where, dict):
+            keep = [self.test([row[i] for i in self.f_positions])
+                    for row in process_chunk(self.f_proc, rows, numbers)]
+        else:
+            keep = [self.where(self.proxy.set_row(row)) for row in rows]
+
+        return [row for row, k in zip(rows, keep) if k], [n for n, k in zip(numbers, keep) if k]
+
+    def process_chunk(self, rows, row_n=0):
+        """Process a list of source rows, with row numbers starting at row_n, or with the row numbers in
+        row_n, if it is a sequence, and return a list of the selected rows, with the selected columns"""
+
+        rows, numbers = self.select_rows(rows, row_n)
+
+        if not rows:
+            return []
+
+        return [[row[i] for i in self.positions] for row in process_chunk(self.proc, rows, numbers)]
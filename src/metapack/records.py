@@ -0,0 +1,73 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Immutable row records.
+
+Resource.iterdict builds a new OrderedDict for each row, which is several times
+the size of the row, and Resource.iterrows yields the same RowProxy for every
+row, so rows must be copied to be kept. The record classes made here are
+named tuples, with no per-instance dict, so they are about the size of a
+tuple of the values, can be kept in lists, and allow access to the values by
+attribute, by position and by header.
+"""
+
+import re
+from collections import OrderedDict, namedtuple
+
+
+def _class_name(name):
+    name = re.sub(r'\W', '_', name or '')
+
+    if not name or name[0].isdigit() or name[0] == '_':
+        name = 'Record_' + name
+
+    return name
+
+
+def record_class(name, headers):
+    """Return a named tuple class for rows with the given headers. Headers that are not valid identifiers,
+    or that are repeated, are renamed to the position of the column, as with namedtuple(rename=True),
+    so ``_3`` is the fourth column, but records can always be indexed by the original header.
+
+    As with named tuples, the other attributes of records start with an underscore, so they can't conflict
+    with the column attributes: ``_asdict()`` returns an OrderedDict of the original headers and values,
+    ``_get()`` returns the value for a header or position, or a default, and ``_headers`` is the tuple of
+    the original headers
+
+    :param name: Name of the class, usually the name of the resource
+    :param headers: List of column headers
+    """
+
+    headers = tuple(str(h) for h in headers)
+
+    positions = {}
+
+    for i, h in enumerate(headers):
+        positions.setdefault(h, i)
+
+    base = namedtuple(_class_name(name), headers, rename=True)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, positions[key])
+        else:
+            return tuple.__getitem__(self, key)
+
+    def _get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def _asdict(self):
+        return OrderedDict(zip(headers, self))
+
+    return type(base.__name__, (base,), {
+        '__slots__': (),
+        '__doc__': 'Record of a row of {}'.format(name),
+        '__getitem__': __getitem__,
+        '_get': _get,
+        '_asdict': _asdict,
+        '_headers': headers,
+    })
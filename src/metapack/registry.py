@@ -0,0 +1,170 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Process-wide registry of open Metapack documents.
+
+The doc properties of the Metapack URLs and the resource property of
+MetapackResourceUrl, which references use to reach other packages, get
+documents from the registry, so every reference to the same package shares one
+MetapackDoc, rather than opening a new one each time. open_package() uses the
+registry only when it is called with shared=True. Documents are keyed by their metadata URL, and before a
+document is returned, the size and modification time of the local copy of its
+metadata file are checked, so a document whose file has changed is opened
+again. The least recently used documents are dropped when the registry is
+full.
+
+Documents in the registry are shared, so changes to one, such as added
+terms, are seen by every other user of the package until it is invalidated.
+Code that changes a document should open its own, with open_package() or
+MetapackDoc.
+The registry can be used from several threads; threads that ask for the same
+package at the same time wait for one of them to open it.
+"""
+
+import threading
+from collections import OrderedDict
+from os import stat
+
+DEFAULT_MAX_DOCS = 256  # Number of documents kept in the registry
+
+
+def source_fingerprint(url):
+    """Return (path, size, mtime) for the local copy of the file for a URL, or None if it isn't a
+    local file"""
+
+    t = url.get_resource().get_target()
+
+    if t.scheme != 'file':
+        return None
+
+    try:
+        path = str(t.fspath)
+        st = stat(path)
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+class DocumentRegistry(object):
+    """An LRU cache of MetapackDocs, keyed by metadata URL
+
+    :param max_docs: Number of documents to keep. When the registry is full, adding a document removes
+        the least recently used one
+    """
+
+    singleton = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_docs=DEFAULT_MAX_DOCS):
+        self.max_docs = max_docs
+        self._docs = OrderedDict()  # Key -> (source fingerprint, doc)
+        self._lock = threading.Lock()  # Guards _docs and _opening
+        self._opening = {}  # Key -> lock held by the thread that is opening the document
+
+    @staticmethod
+    def get_instance():
+        """Return the process-wide registry"""
+
+        with DocumentRegistry._instance_lock:
+            if DocumentRegistry.singleton is None:
+                DocumentRegistry.singleton = DocumentRegistry()
+
+        return DocumentRegistry.singleton
+
+    @staticmethod
+    def key(url):
+        """Return the registry key for a Metapack URL, its metadata URL without a fragment"""
+        return str(url.metadata_url)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, url):
+        return self.key(url) in self._docs
+
+    def get(self, url, downloader=None, lazy=False, ref=None):
+        """Return the document for a Metapack URL, opening it if it isn't in the registry, or if
+        its metadata file has changed since it was opened. If lazy is True, a document that is opened
+        parses its other sections only when they are needed
+
+        :param url: Metapack URL of the package
+        :param downloader: Downloader for the document. If it isn't the downloader of the registered
+            document, a new document is opened for the caller, and not registered
+        :param lazy: If True, a document that is opened parses only its eager sections at first
+        :param ref: Reference to open the document from, if not the metadata URL, such as the local
+            copy of the metadata file
+        """
+        from metapack.doc import MetapackDoc
+
+        mu = url.metadata_url
+        key = str(mu)
+
+        def open_doc():
+            return MetapackDoc(ref if ref is not None else mu, downloader=downloader or mu.downloader,
+                               package_url=url.package_url, lazy=lazy)
+
+        fingerprint = source_fingerprint(mu)
+
+        with self._lock:
+            entry = self._docs.get(key)
+
+        if downloader is not None and entry is not None and entry[1].downloader is not downloader:
+            return open_doc()
+
+        with self._lock:
+            doc = self._lookup(key, fingerprint)
+
+            if doc is not None:
+                return doc
+
+            opening = self._opening.setdefault(key, threading.Lock())
+
+        with opening:
+            # Another thread may have opened it while this one waited
+            with self._lock:
+                doc = self._lookup(key, fingerprint)
+
+            if doc is not None:
+                return doc
+
+            try:
+                doc = open_doc()
+            finally:
+                with self._lock:
+                    self._opening.pop(key, None)
+
+            with self._lock:
+                if fingerprint is None:  # Can't be validated, so it isn't shared
+                    self._docs.pop(key, None)
+                    return doc
+
+                self._docs[key] = (fingerprint, doc)
+                self._docs.move_to_end(key)
+
+                while len(self._docs) > self.max_docs:
+                    self._docs.popitem(last=False)
+
+        return doc
+
+    def _lookup(self, key, fingerprint):
+        """Return the registered document for a key if its file is unchanged. Call with the lock held"""
+
+        entry = self._docs.get(key)
+
+        if entry is not None and fingerprint is not None and entry[0] == fingerprint:
+            self._docs.move_to_end(key)
+            return entry[1]
+
+        return None
+
+    def invalidate(self, url=None):
+        """Remove the document for a URL from the registry, so the next request for it opens it
+        again. With no URL, remove all documents"""
+
+        with self._lock:
+            if url is None:
+                self._docs.clear()
+            else:
+                self._docs.pop(self.key(url), None)
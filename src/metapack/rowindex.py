@@ -0,0 +1,174 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Sparse byte-offset indexes of the rows in CSV and fixed-width files.
+
+A row index records the byte offset of every Nth row of a file, so reading
+rows from the middle of the file can start with a seek to the closest
+indexed row rather than a scan from the top. CSV rows can span lines when
+a quoted value has a newline, so the index tracks quotes while it scans.
+Indexes are saved as JSON in the metapack cache, with the size and
+modification time of the file, and are rebuilt when the file changes.
+"""
+
+import hashlib
+import json
+from io import TextIOWrapper
+from itertools import islice
+from os import replace, stat
+from os.path import exists, join
+
+from metatab.util import slugify
+
+from metapack.constants import ROW_INDEX_PREFIX
+from metapack.util import ensure_dir, path_lock, temp_path
+
+DEFAULT_STRIDE = 1000
+
+
+class RowIndex(object):
+    """Byte offsets of every stride'th row of a CSV or fixed-width file. Row numbers count
+    every row in the file, including headers"""
+
+    def __init__(self, path, kind='csv', stride=DEFAULT_STRIDE, offsets=None, count=0, size=None,
+                 mtime_ns=None, encoding=None, delimiter=','):
+        self.path = path
+        self.kind = kind
+        self.stride = stride
+        self.offsets = offsets or []
+        self.count = count
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+    @classmethod
+    def build(cls, path, kind='csv', stride=DEFAULT_STRIDE, encoding=None, delimiter=','):
+        """Scan a file and return an index of it"""
+
+        st = stat(path)
+
+        offsets = []
+        count = 0
+        pos = 0
+        in_quotes = False
+
+        with open(path, 'rb') as f:
+            for line in f:
+                if not in_quotes:
+                    if count % stride == 0:
+                        offsets.append(pos)
+                    count += 1
+
+                # An odd number of quotes opens or closes a quoted value that continues on the next line.
+                if kind == 'csv' and line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+
+                pos += len(line)
+
+        return cls(path, kind, stride, offsets, count, st.st_size, st.st_mtime_ns, encoding, delimiter)
+
+    @property
+    def valid(self):
+        """True if the file has not changed since the index was built"""
+        try:
+            st = stat(self.path)
+        except OSError:
+            return False
+
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in ('path', 'kind', 'stride', 'offsets', 'count', 'size',
+                                               'mtime_ns', 'encoding', 'delimiter')}
+
+    def save(self, index_path):
+        """Write the index to a JSON file. The file is written to a temporary name and moved into place"""
+
+        tmp_path = temp_path(index_path)
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+        replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path) as f:
+            return cls(**json.load(f))
+
+    def iter_rows(self, start=0, stop=None, parse=None):
+        """Yield the rows of the file from row start up to row stop. CSV rows are lists of values;
+        fixed-width rows are the lines of the file, or the result of parse(line) if parse is given"""
+        import csv
+
+        start = max(start, 0)
+
+        if start >= self.count or (stop is not None and stop <= start):
+            return
+
+        block = start // self.stride
+
+        with open(self.path, 'rb') as bf:
+            bf.seek(self.offsets[block])
+
+            f = TextIOWrapper(bf, encoding=self.encoding or ('utf8' if self.kind == 'csv' else None))
+
+            if self.kind == 'csv':
+                rows = csv.reader(f, delimiter=self.delimiter)
+            elif parse:
+                rows = (parse(line) for line in f)
+            else:
+                rows = iter(f)
+
+            skip = start - block * self.stride
+            n = None if stop is None else stop - start
+
+            yield from islice(rows, skip, None if n is None else skip + n)
+
+
+def row_index_path(doc, target_path):
+    """Return the path to the cache file for the index of a file"""
+
+    dr = doc._cache.getsyspath(join(ROW_INDEX_PREFIX, slugify(doc.name)))
+
+    ensure_dir(dr)
+
+    key = hashlib.md5(str(target_path).encode('utf8')).hexdigest()
+
+    return join(dr, '{}.json'.format(key))
+
+
+def get_row_index(doc, target_path, kind='csv', encoding=None, delimiter=',', build=True):
+    """Return an up to date index of a file, loading it from the cache or, if build is True, building it.
+    Returns None if there is no current index and build is False"""
+
+    index_path = row_index_path(doc, target_path)
+
+    def load():
+        if exists(index_path):
+            try:
+                idx = RowIndex.load(index_path)
+
+                if idx.valid and idx.kind == kind and idx.delimiter == delimiter and idx.encoding == encoding:
+                    return idx
+            except (ValueError, TypeError, OSError):
+                pass
+
+        return None
+
+    idx = load()
+
+    if idx is not None or not build:
+        return idx
+
+    with path_lock(index_path):
+        # Another thread may have built it while this one waited
+        idx = load()
+
+        if idx is None:
+            idx = RowIndex.build(str(target_path), kind, encoding=encoding, delimiter=delimiter)
+            idx.save(index_path)
+
+    return idx
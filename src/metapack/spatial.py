@@ -0,0 +1,126 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Spatial index for geo resources.
+
+A spatial query on a geo resource would otherwise decode every geometry in the
+resource. The index is built from the resource's materialized WKB Parquet
+file: the envelope (minx, miny, maxx, maxy) of each row is computed once and
+saved in a .npy file next to it, and an STRtree of the envelopes is built in
+memory from that file. A query finds the rows whose envelopes intersect the
+query geometry, reads only the row groups that hold them, decodes only their
+geometries, and then tests those for an exact intersection.
+"""
+
+from os import replace
+from os.path import exists
+
+from metapack.columnar import DEFAULT_BATCH_SIZE
+from metapack.util import path_lock, temp_path
+
+ENVELOPES_SUFFIX = '.envelopes.npy'
+
+
+def envelopes_path(geo_path):
+    """Return the path of the envelopes file for a materialized WKB Parquet file"""
+    from metapack.materialize import _suffix
+
+    return geo_path[:-len(_suffix(True))] + ENVELOPES_SUFFIX
+
+
+def build_envelopes(geo_path, batch_size=DEFAULT_BATCH_SIZE):
+    """Compute the envelope of each row of a WKB Parquet file and save them to the envelopes file, as
+    an array of shape (rows, 4). Rows without a geometry have NaN envelopes. Returns the path"""
+    import numpy as np
+    import pyarrow.parquet as pq
+    from metapack.geo import GEOMETRY_COLUMN, _column_values, decode_geometry, geometry_bounds
+
+    pf = pq.ParquetFile(geo_path)
+
+    parts = [geometry_bounds(decode_geometry(_column_values(b.column(0))))
+             for b in pf.iter_batches(batch_size=batch_size, columns=[GEOMETRY_COLUMN])]
+
+    envelopes = np.concatenate(parts) if parts else np.empty((0, 4))
+
+    path = envelopes_path(geo_path)
+    tmp = temp_path(path)
+
+    with open(tmp, 'wb') as f:
+        np.save(f, envelopes)
+
+    replace(tmp, path)
+
+    return path
+
+
+class SpatialIndex(object):
+    """An index of the envelopes of the rows of a materialized WKB Parquet file"""
+
+    def __init__(self, geo_path):
+        import numpy as np
+
+        self.geo_path = geo_path
+
+        path = envelopes_path(geo_path)
+
+        with path_lock(path):
+            if not exists(path):
+                build_envelopes(geo_path)
+
+        self.envelopes = np.load(path, mmap_mode='r')
+        self._tree = None
+
+    def __len__(self):
+        return len(self.envelopes)
+
+    @property
+    def crs(self):
+        """The CRS of the geometries, from the GeoParquet metadata of the file"""
+        import pyarrow.parquet as pq
+        from metapack.geo import geoparquet_crs
+
+        return geoparquet_crs(pq.read_schema(self.geo_path))
+
+    @property
+    def tree(self):
+        """An STRtree of the envelopes, or None if shapely doesn't have the shapely 2 STRtree"""
+        import numpy as np
+        from metapack.geo import _shapely2
+
+        shapely = _shapely2()
+
+        if self._tree is None and shapely is not None:
+            env = np.asarray(self.envelopes)
+            boxes = shapely.box(env[:, 0], env[:, 1], env[:, 2], env[:, 3])
+            boxes[np.isnan(env).any(axis=1)] = None
+
+            self._tree = shapely.STRtree(boxes)
+
+        return self._tree
+
+    def candidates(self, geometry):
+        """Return a sorted array of the numbers of the rows whose envelopes intersect the envelope of
+        the geometry"""
+        import numpy as np
+
+        tree = self.tree
+
+        if tree is not None:
+            return np.sort(tree.query(geometry))
+
+        minx, miny, maxx, maxy = geometry.bounds
+        env = self.envelopes
+
+        # NaN comparisons are False, so rows without geometries are never candidates
+        return np.nonzero((env[:, 0] <= maxx) & (env[:, 2] >= minx) &
+                          (env[:, 1] <= maxy) & (env[:, 3] >= miny))[0]
+
+    def intersects(self, geometry, columns=None, crs=None):
+        """Return a GeoDataFrame of the rows with geometries that intersect the geometry, which must be in
+        the CRS of the file. The frame has the file's CRS, unless crs is set"""
+        from metapack.geo import read_geoparquet_rows
+
+        gdf = read_geoparquet_rows(self.geo_path, self.candidates(geometry), columns, crs)
+
+        return gdf[gdf.intersects(geometry)].reset_index(drop=True)
@@ -0,0 +1,174 @@
+# Copyright (c) 2020 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+An index of the root level terms of a document.
+
+MetatabDoc.find() compares every root level term to the search term, so
+looking up each resource, reference or schema by name is linear in the size
+of the document. The TermIndex groups the terms by their fully qualified
+name, value and Name property, and by section, keeping document order, so
+those lookups only look at matching terms.
+
+The document keeps the index up to date as terms change. Terms in a
+MetapackDoc are TrackedTerms, which tell the document when their values
+change or children are added, and the document moves the changed terms to
+their new keys in the index.
+"""
+
+from collections import defaultdict
+
+from metatab import Term
+
+
+class TrackedTerm(Term):
+    """A term that tells its document when its value changes or a child is added, so a MetapackDoc can update
+    its term index and discard cached values. Plain terms added to a MetapackDoc are converted to this class"""
+
+    def __setattr__(self, item, value):
+        super().__setattr__(item, value)
+
+        if '_Term__initialised' in self.__dict__ and (item == 'value' or
+                                                      item.lower() == self.term_value_name.lower()):
+            self._term_changed(self)
+
+    def _term_changed(self, t):
+        f = getattr(self.__dict__.get('doc'), '_term_changed', None)
+
+        if f is not None:
+            f(t)
+
+    def add_child(self, child):
+        super().add_child(child)
+        track(child)
+        self._term_changed(child)
+
+    def new_child(self, term, value, **kwargs):
+        c = super().new_child(term, value, **kwargs)
+        self._term_changed(c)
+        return c
+
+    def get_or_new_child(self, term, value=False, **kwargs):
+        c = super().get_or_new_child(term, value, **kwargs)
+        self._term_changed(c)
+        return c
+
+
+def track(t):
+    """Convert a plain term and its children to TrackedTerms. Terms of other classes are left as they are"""
+
+    if type(t) is Term:
+        t.__class__ = TrackedTerm
+
+    for c in t.children:
+        track(c)
+
+    return t
+
+
+class TermIndex(object):
+    """Root level terms of a document, grouped for lookups, in document order. The document updates the
+    index when terms are added, removed or changed"""
+
+    def __init__(self, terms):
+
+        self.by_term = defaultdict(list)  # join_lc -> terms
+        self.by_value = defaultdict(list)  # (join_lc, value) -> terms
+        self.by_name = defaultdict(list)  # (join_lc, name property) -> terms
+        self.by_section = defaultdict(list)  # section name, lowercased -> terms
+
+        self._keys = {}  # id of each term -> its position in the document, and the keys it is indexed under
+        self._n = 0
+
+        for t in terms:
+            self.add(t)
+
+    @staticmethod
+    def _term_keys(t):
+        return (t.join_lc, (t.join_lc, t.value), (t.join_lc, t.get_value('name')),
+                t.section.name.lower() if t.section is not None else None)
+
+    def _maps(self):
+        return self.by_term, self.by_value, self.by_name, self.by_section
+
+    def _insert(self, terms, t, pos):
+        """Insert a term into a list of terms, in document order"""
+        lo, hi = 0, len(terms)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._keys[id(terms[mid])][0] < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        terms.insert(lo, t)
+
+    def __contains__(self, t):
+        return id(t) in self._keys
+
+    def add(self, t):
+        """Add a term after all of the other terms"""
+
+        if t.join_lc == 'root.root' or t in self:
+            return
+
+        keys = self._term_keys(t)
+        self._keys[id(t)] = (self._n,) + keys
+        self._n += 1
+
+        for m, k in zip(self._maps(), keys):
+            if k is not None:
+                m[k].append(t)
+
+    def remove(self, t):
+        """Remove a term"""
+
+        entry = self._keys.pop(id(t), None)
+
+        if entry is None:
+            return
+
+        for m, k in zip(self._maps(), entry[1:]):
+            if k is not None:
+                terms = m[k]
+                del terms[next(i for i, e in enumerate(terms) if e is t)]
+
+                if not terms:
+                    del m[k]
+
+    def update(self, t):
+        """Move a term whose value, Name property or section has changed to its new keys"""
+
+        entry = self._keys.get(id(t))
+
+        if entry is None:
+            return
+
+        keys = self._term_keys(t)
+
+        if keys == entry[1:]:
+            return
+
+        self.remove(t)
+        self._keys[id(t)] = (entry[0],) + keys
+
+        for m, k in zip(self._maps(), keys):
+            if k is not None:
+                self._insert(m[k], t, entry[0])
+
+    def candidates(self, term_lc, value=False, name=False):
+        """Return the terms with a lowercased, fully qualified term name, and optionally with a given
+        value or Name property"""
+
+        if value is not False:
+            return self.by_value.get((term_lc, value), [])
+        elif name is not False:
+            return self.by_name.get((term_lc, name), [])
+        else:
+            return self.by_term.get(term_lc, [])
+
+    def section_terms(self, section):
+        """Return all of the terms in a section"""
+        return self.by_section.get(section.lower(), [])
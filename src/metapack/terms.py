@@ -1,13 +1,14 @@
 from itertools import islice
 from os.path import join
+from threading import Lock
 
-from metatab import Term
 from rowgenerators import parse_app_url
 from rowgenerators.exceptions import DownloadError
 from rowgenerators.rowpipe import RowProcessor
 from rowgenerators.rowproxy import RowProxy
 
 from metapack.appurl import MetapackPackageUrl
+from metapack.casterrors import ErrorSummary
 from metapack.doc import EMPTY_SOURCE_HEADER
 from metapack.exc import (
     MetapackError,
@@ -16,6 +17,7 @@ from metapack.exc import (
     PackageError,
     ResourceError
 )
+from metapack.termindex import TrackedTerm
 
 
 def int_maybe(v):
@@ -32,21 +34,104 @@ def first_not_none(*a):
         return None
 
 
-class Resource(Term):
+class ResourceIterator(object):
+    """An iterator over the rows of a resource. When it finishes, the metadata from the source and the casting
+    errors of this iteration are in its meta and errors attributes. They are also copied to the post_iter_meta
+    and errors attributes of the resource, which hold the results of whichever iteration finished last, so
+    concurrent iterations of a resource should use the iterator's attributes"""
+
+    def __init__(self, resource, gen_func, *args):
+        self.resource = resource
+        self.meta = {}
+        self.errors = {}
+        self._itr = gen_func(self, *args)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._itr)
+
+    def finish(self, meta, errors=None):
+        """Record the source metadata and casting errors at the end of the iteration. An ErrorSummary is also
+        added to the metadata, as a dict, in the 'errors' key"""
+
+        self.meta, self.errors = _iteration_results(meta, errors)
+        self.resource._publish_iteration(self.meta, self.errors)
+
+    def update_meta(self, **kwargs):
+        """Add values to the metadata of a finished iteration"""
+
+        self.meta = dict(self.meta, **kwargs)
+        self.resource._publish_iteration(self.meta, self.errors)
+
+
+def _iteration_results(meta, errors):
+    meta = dict(meta or {})
+
+    if isinstance(errors, ErrorSummary):
+        meta['errors'] = errors.to_dict()
+        return meta, errors
+    else:
+        return meta, errors if errors else {}
+
+
+class Resource(TrackedTerm):
     # These property names should return null if they aren't actually set.
     _common_properties = 'url name description schema'.split()
 
+    # If True, cast columns that have no transforms a chunk at a time, rather than per cell.
+    vectorize = True
+
+    # If True, process rows with a function compiled for the whole row processor table, rather than
+    # with the per-column functions of the rowgenerators RowProcessor
+    compile_transforms = True
+
+    # If True, record casting errors in an ErrorSummary, with counts, sample values and row numbers for each
+    # column, rather than as messages, and don't raise TooManyCastingErrors.
+    summarize_errors = False
+
+    # If True, read local fixed-width files in memory mapped blocks with metapack.fixedwidth, rather than a
+    # line at a time with the rowgenerators FixedSource
+    fixed_width_engine = True
+
+    # Guards setting post_iter_meta and errors together, when iterations finish
+    _iteration_lock = Lock()
+
     def __init__(self, term, value, term_args=False, row=None, col=None, file_name=None, file_type=None,
                  parent=None, doc=None, section=None,
                  ):
 
         self.errors = {}  # Typecasting errors
+        self._record_classes = {}  # Record classes for iterrecords(), by headers
+        self._spatial_index = None  # SpatialIndex for intersects()
 
         # Metadata returned by the iteratator, available after iteration
         self.post_iter_meta = {}
 
+        self._plan = None  # Cached ResolutionPlan
+
         super().__init__(term, value, term_args, row, col, file_name, file_type, parent, doc, section)
 
+    @property
+    def plan(self):
+        """Return the ResolutionPlan for the resource, which caches the resolved URL, schema and headers. In
+        a MetapackDoc, the plan is rebuilt after any term of the document, including the resource's
+        properties and the columns of its schema, is added, removed or changed. In other documents, the plan
+        is kept until invalidate() is called"""
+        from .plan import ResolutionPlan
+
+        key = getattr(self.doc, '_version', None)
+
+        if self._plan is None or self._plan.key != key:
+            self._plan = ResolutionPlan(self, key)
+
+        return self._plan
+
+    def invalidate(self):
+        """Discard the cached ResolutionPlan"""
+        self._plan = None
+
     @property
     def base_url(self):
         """Base URL for resolving resource URLs"""
@@ -74,9 +159,8 @@ class Resource(Term):
     @property
     def env(self):
         """The execution context for rowprocessors and row-generating notebooks and functions. """
-        from copy import copy
 
-        env = copy(self.doc.env)
+        env = self.doc.env  # A copy of the document's cached context
 
         assert env is not None, 'Got a null execution context'
 
@@ -105,6 +189,9 @@ class Resource(Term):
 
     @property
     def expanded_url(self):
+        return self.plan.expanded_url
+
+    def _make_expanded_url(self):
 
         from os.path import normpath
 
@@ -127,6 +214,9 @@ class Resource(Term):
 
     @property
     def resolved_url(self):
+        return self.plan.resolved_url
+
+    def _make_resolved_url(self):
 
         ru = self._resolved_url()
 
@@ -193,7 +283,8 @@ class Resource(Term):
 
         if u.scheme == 'file':
 
-            return self.expanded_url
+            # A copy, because properties of the resource will be set on it
+            return self.expanded_url.clone()
 
         else:
             raise ResourceError('Unknown case for url {} '.format(self.url))
@@ -201,7 +292,7 @@ class Resource(Term):
     @property
     def inner(self):
         """For compatibility with the Appurl interface"""
-        return self.resolved_url.get_resource().get_target().inner
+        return self.plan.target.inner
 
     def _name_for_col_term(self, c, i):
 
@@ -228,6 +319,10 @@ class Resource(Term):
         """Return the Table term for this resource, which is referenced either by the `table` property or the
         `schema` property"""
 
+        return self.plan.schema_term
+
+    def _find_schema_term(self):
+
         if not self.name:
             raise MetapackError("Resource for url '{}' does not have name".format(self.url))
 
@@ -243,6 +338,10 @@ class Resource(Term):
         """"Returns the headers for the resource source. Specifically, does not include any header that is
         the EMPTY_SOURCE_HEADER value of _NONE_"""
 
+        return self.plan.source_headers
+
+    def _make_source_headers(self):
+
         t = self.schema_term
 
         if t:
@@ -288,6 +387,9 @@ class Resource(Term):
     def _get_start_end_header(self):
         """Identify the start row, end row and header rows from the url or resource"""
 
+        return self.plan.start_end_header
+
+    def _make_start_end_header(self):
         # There are several args for SelectiveRowGenerator, but only
         # start is really important.
         start = first_not_none(int_maybe(self.get_value('startline')),
@@ -321,6 +423,10 @@ class Resource(Term):
         are specifically applicable to the output table, and may not apply to the resource source. For those headers,
         use source_headers"""
 
+        return self.plan.headers
+
+    def _make_headers(self):
+
         t = self.schema_term
 
         if t:
@@ -404,6 +510,29 @@ class Resource(Term):
         else:
             return None
 
+    def _transform_key(self):
+        """A fingerprint of the transform environment, for the cache of compiled row processing code"""
+        env = self.env
+
+        return self.doc._lib_fingerprint(), sorted((k, callable(v)) for k, v in env.items())
+
+    def compile_row_processor_table(self, rptable=None):
+        """Return a function that applies all of the casts and transforms of a row processor table, by default
+        the one from row_processor_table(), to a list of source rows. The function is generated by
+        metapack.codegen, and its code is cached in the directory of code_path. It is called as:
+
+            f(rows, row_numbers, errors, scratch, accumulator, pipe, manager, source)
+
+        """
+        from .codegen import compile_row_function
+
+        rptable = rptable or self.plan.rptable
+
+        if not rptable:
+            raise NoRowProcessor("No row processor for resource {}".format(self.name))
+
+        return compile_row_function(self.source_headers, rptable, self.env, self.code_path, self._transform_key())
+
     @property
     def row_generator(self):
         return self._row_generator()
@@ -438,15 +567,13 @@ class Resource(Term):
         except AttributeError:
             pass
 
-        rur = ru.get_resource()
+        ut = self.plan.target
 
-        if not rur:
+        if not ut:
             raise NoResourceError("Failed to get resource for '{}' ".format(ru))
 
-        ut = rur.get_target()
-
         if rptable is True:
-            rptable = self.row_processor_table()
+            rptable = self.plan.rptable
         elif rptable is False:
             rptable = None
 
@@ -489,41 +616,170 @@ class Resource(Term):
                                   "\n Maybe need to add '#<resource_name>' to the end of the url '{}'".format(
                                       self.url)) from e
 
+    def row_index(self, build=True):
+        """Return a RowIndex of the byte offsets of the rows in the resource's source file, building it
+        if it doesn't exist or is out of date and build is True. Returns None for resources that are not
+        local CSV or fixed-width files. """
+        from .appurl import is_metapack_url
+
+        if not self.resolved_url or is_metapack_url(self.resolved_url):
+            return None
+
+        return self._row_index(self.row_generator, build)
+
+    def _row_index(self, base_row_gen, build=True):
+        from rowgenerators.generator.csv import CsvSource
+        from rowgenerators.generator.fixed import FixedSource
+        from .rowindex import get_row_index
+
+        if isinstance(base_row_gen, FixedSource):
+            kind, encoding, delimiter = 'fixed', None, ','
+        elif isinstance(base_row_gen, CsvSource):
+            kind, encoding, delimiter = 'csv', base_row_gen.url.encoding or 'utf8', base_row_gen.delimiter
+        else:
+            return None
+
+        if base_row_gen.ref.scheme != 'file':
+            return None
+
+        return get_row_index(self.doc, base_row_gen.ref.fspath, kind, encoding, delimiter, build)
+
+    def _source_rows(self, base_row_gen, start, end):
+        """Return an iterator of the source rows from start to end. If the source file already has a
+        row index, reading starts with a seek to the indexed row before start, rather than by
+        skipping rows from the top of the file."""
+        from .fixedwidth import fixed_width_reader
+        from .rowindex import DEFAULT_STRIDE
+
+        fwr = fixed_width_reader(base_row_gen) if self.fixed_width_engine else None
+
+        if start and start >= DEFAULT_STRIDE:
+            idx = self._row_index(base_row_gen, build=False)
+
+            if idx is not None and fwr is not None:
+                block = min(start // idx.stride, len(idx.offsets) - 1)
+
+                if block >= 0:
+                    return fwr.iter_rows(start, end, idx.offsets[block], block * idx.stride)
+
+            elif idx is not None:
+                parse = base_row_gen.table.make_fw_row_parser() if idx.kind == 'fixed' else None
+                return idx.iter_rows(start, end, parse)
+
+        if fwr is not None:
+            return fwr.iter_rows(start, end)
+
+        return islice(base_row_gen, start, end)
+
+    def rows(self, start=0, stop=None):
+        """Return a list of processed rows, from row start up to row stop, where row 0 is the first row
+        after the header. For CSV and fixed-width files, the rows are read through the row index,
+        which is built the first time, so only the requested rows are read. """
+        from .processor import process_chunk
+
+        idx = self.row_index()
+
+        if idx is None:
+            return list(islice(self, start + 1, None if stop is None else stop + 1))
+
+        _, data_start, end = self._get_start_end_header()
+
+        base_row_gen = self.row_generator
+
+        s = data_start + start
+        e = data_start + stop if stop is not None else None
+
+        if end is not None:
+            e = end if e is None else min(e, end)
+
+        parse = base_row_gen.table.make_fw_row_parser() if idx.kind == 'fixed' else None
+
+        rows = list(idx.iter_rows(s, e, parse))
+
+        rptable = self.plan.rptable
+
+        if not rptable or not rows:
+            return rows
+
+        proc = self._row_processor(base_row_gen, rptable)
+
+        rows = process_chunk(proc, rows, range(start, start + len(rows)))
+
+        self._publish_iteration(*_iteration_results(self.post_iter_meta, proc.errors))
+
+        return rows
+
+    def row_count(self):
+        """Return the number of data rows, from the row index for CSV and fixed-width files, or
+        by iterating the resource"""
+
+        idx = self.row_index()
+
+        if idx is None:
+            return sum(1 for _ in self) - 1
+
+        _, data_start, end = self._get_start_end_header()
+
+        n = idx.count if end is None else min(idx.count, end)
+
+        return max(n - data_start, 0)
+
+    def _row_processor(self, source, rptable):
+        """Return a row processor that applies the row processor table to the source rows. If the table has
+        columns that only need a datatype cast, and pandas is available, use a ChunkedRowProcessor, which
+        casts those columns a chunk at a time. Otherwise, use a CompiledRowProcessor, or the rowgenerators
+        RowProcessor if compile_transforms is False. If summarize_errors is True, the row processor records
+        errors in an ErrorSummary, which requires compiled row processing. """
+        from .processor import ChunkedRowProcessor, CompiledRowProcessor
+
+        kwargs = dict(source_headers=self.source_headers,
+                      manager=self,
+                      env=self.env,
+                      code_path=self.code_path)
+
+        errors = ErrorSummary() if self.summarize_errors else None
+        compiled = self.compile_transforms or errors is not None
+
+        if self.vectorize and ChunkedRowProcessor.can_process(rptable):
+            return ChunkedRowProcessor(source, rptable, compiled=compiled,
+                                       code_key=self._transform_key() if compiled else None,
+                                       errors=errors, **kwargs)
+        elif compiled:
+            return CompiledRowProcessor(source, rptable, code_key=self._transform_key(), errors=errors, **kwargs)
+        else:
+            return RowProcessor(source, rptable, **kwargs)
+
     @property
     def iterprocessedrows(self):
         """Iterate using a row processor table, which requires a schema"""
+        return ResourceIterator(self, self._iterprocessedrows)
+
+    def _iterprocessedrows(self, itr):
 
         assert type(self.env) == dict
 
         _, start, end = self._get_start_end_header()
 
-        rptable = self.row_processor_table()  # Requires a schema term
+        rptable = self.plan.rptable  # Requires a schema term
 
         if not rptable:
             raise NoRowProcessor("No row processor for resource (")
 
         base_row_gen = self.row_generator
 
-        rg = RowProcessor(islice(base_row_gen, start, end),
-                          rptable,
-                          source_headers=self.source_headers,
-                          manager=self,
-                          env=self.env,
-                          code_path=self.code_path)
+        rg = self._row_processor(self._source_rows(base_row_gen, start, end), rptable)
 
         yield self.headers
         yield from rg
 
-        self.post_iter_meta = base_row_gen.meta
-
-        try:
-            self.errors = rg.errors if rg.errors else {}
-        except AttributeError:
-            self.errors = {}
+        itr.finish(base_row_gen.meta, getattr(rg, 'errors', None))
 
     @property
     def iterrawrows(self):
         """Iterate without a row processor table"""
+        return ResourceIterator(self, self._iterrawrows)
+
+    def _iterrawrows(self, itr):
         try:
             yield from self.itermetatabrows
 
@@ -537,25 +793,26 @@ class Resource(Term):
 
             base_row_gen = self.row_generator
 
-            yield from islice(base_row_gen, start, end)
+            yield from self._source_rows(base_row_gen, start, end)
 
-            self.post_iter_meta = base_row_gen.meta
+            itr.finish(base_row_gen.meta)
 
     def __iter__(self):
         """General data iterator. Tries to iterate as a Metatab package, then with
-        a row processor ( schema ) and finally, raw rows. """
+        a row processor ( schema ) and finally, raw rows. Returns a ResourceIterator"""
+        return ResourceIterator(self, self._iter_rows)
+
+    def _iter_rows(self, itr):
         #
         # Maybe it is a metatab resource
         from rowgenerators.source import SelectiveRowGenerator
 
         headers = None
-        base_row_gen = None
 
         try:
-            yield from self.resolved_url.resource
-            return
+            rows = iter(self.resolved_url.resource)
         except AttributeError:
-            base_row_gen = self.row_generator
+            rows = None
 
         except TypeError as e:  # resource is None:
             # The URL type has a resource property, so it should be iterable, but
@@ -564,32 +821,181 @@ class Resource(Term):
                                   "\n Maybe need to add '#<resource_name>' to the end of the url '{}'".format(
                                       self.url)) from e
 
+        if rows is not None:
+            yield from rows
+
+            if isinstance(rows, ResourceIterator):
+                itr.finish(rows.meta, rows.errors)
+
+            return
+
+        base_row_gen = self.row_generator
+
         header_lines, start, end = self._get_start_end_header()
 
-        rptable = self.row_processor_table()  # Requires a schema term
+        rptable = self.plan.rptable  # Requires a schema term
 
         if rptable:
-
-            rg = iter(RowProcessor(islice(base_row_gen, start, end),
-                                   rptable,
-                                   source_headers=self.source_headers,
-                                   manager=self,
-                                   env=self.env,
-                                   code_path=self.code_path))
+            rg = self._row_processor(self._source_rows(base_row_gen, start, end), rptable)
+            rows = iter(rg)
             headers = self.headers
         else:
-            rg = iter(SelectiveRowGenerator(base_row_gen, header_lines=header_lines, start=start, end=end))
-            headers = next(rg)
+            rg = SelectiveRowGenerator(base_row_gen, header_lines=header_lines, start=start, end=end)
+            rows = iter(rg)
+            headers = next(rows)
 
         yield headers
-        yield from rg
+        yield from rows
 
-        self.post_iter_meta = base_row_gen.meta
+        itr.finish(base_row_gen.meta, getattr(rg, 'errors', None))
 
-        try:
-            self.errors = rg.errors if rg.errors else {}
-        except AttributeError:
-            self.errors = {}
+    def _check_columns(self, headers, columns):
+        """Raise a ResourceError if any of the columns are not in the headers"""
+
+        missing = [c for c in columns if c not in headers]
+
+        if missing:
+            raise ResourceError("Resource '{}' has no columns named: {}".format(self.name, ', '.join(missing)))
+
+    def iterate(self, columns=None, where=None, workers=None):
+        """Iterate over the resource, like __iter__(), yielding the header and then the rows, but with only
+        some columns and some rows.
+
+        :param columns: List of column names. Only these columns are cast and transformed, and the
+            rows have the columns in this order.
+        :param where: Selects the rows. Either a function that takes a RowProxy of the source row, before any
+            processing, and returns True for rows to keep, or a dict that maps column names to a value or
+            to a function of the value. The columns in the dict are processed first, and the remaining
+            columns are processed only for the rows that are kept.
+        :param workers: If greater than 1, process the rows in a pool of this many processes, which open the
+            package from its file. A where dict must then be picklable, so it can't have lambdas. Each process
+            has its own row processors, so a ResourceError is raised if transforms use the scratch or
+            accumulator dicts, which would only hold the state of some of the rows. Functions called from
+            transforms that use them aren't detected, and must not be used with workers.
+
+        Returns a ResourceIterator.
+        """
+        return ResourceIterator(self, self._iterate, columns, where, workers)
+
+    def _iterate(self, itr, columns, where, workers):
+        from .appurl import is_metapack_url
+        from .processor import DEFAULT_CHUNK_SIZE, SelectionProcessor
+
+        if columns is None and where is None and not (workers and workers > 1):
+            rows = iter(self)
+            yield from rows
+            itr.finish(rows.meta, rows.errors)
+            return
+
+        rptable = self.plan.rptable
+
+        if not rptable or is_metapack_url(self.resolved_url):
+            # No row processor, so select from the rows as they are produced
+            yield from self._iterate_rows(itr, columns, where)
+            return
+
+        headers = self.headers
+        columns = list(columns) if columns is not None else list(headers)
+
+        self._check_columns(headers, columns + (list(where) if isinstance(where, dict) else []))
+
+        _, start, end = self._get_start_end_header()
+
+        base_row_gen = self.row_generator
+        source = self._source_rows(base_row_gen, start, end)
+
+        sp = SelectionProcessor(rptable, columns, where,
+                                make_processor=lambda t: self._row_processor(base_row_gen, t),
+                                source_headers=self.source_headers, env=self.env)
+
+        def _chunks():
+            row_n = 0
+
+            while True:
+                rows = list(islice(source, DEFAULT_CHUNK_SIZE))
+
+                if not rows:
+                    break
+
+                yield rows, row_n
+
+                row_n += len(rows)
+
+        parallel = workers and workers > 1 and self.doc.ref
+
+        if parallel:
+            from .parallel import stateful_columns
+
+            stateful = stateful_columns(rptable)
+
+            if stateful:
+                raise ResourceError("Can't process resource '{}' with workers: the transforms of columns {} use "
+                                    "scratch or accumulator state across rows"
+                                    .format(self.name, ', '.join(stateful)))
+
+        yield columns
+
+        if parallel:
+            from .parallel import iter_parallel
+
+            errors = ErrorSummary() if self.summarize_errors else {}
+
+            if callable(where):
+                # Functions of the source row are applied here, so they don't have to be pickled
+                chunks = (sp.select_rows(rows, row_n) for rows, row_n in _chunks())
+                where = None
+            else:
+                chunks = _chunks()
+
+            yield from iter_parallel(chunks, str(self.doc.ref), self.name, columns, where, workers, errors)
+        else:
+            for rows, row_n in _chunks():
+                yield from sp.process_chunk(rows, row_n)
+
+            errors = sp.errors
+
+        itr.finish(base_row_gen.meta, errors)
+
+    def _publish_iteration(self, meta, errors):
+        """Set post_iter_meta and errors from the results of an iteration"""
+
+        with self._iteration_lock:
+            self.post_iter_meta = meta
+            self.errors = errors
+
+    def _iterate_rows(self, itr, columns=None, where=None):
+        """Implementation of iterate() for resources without a row processor table, which selects
+        columns and rows from the output of __iter__()"""
+        from .processor import row_filter
+
+        rows = iter(self)
+
+        headers = list(next(rows))
+
+        columns = list(columns) if columns is not None else headers
+
+        self._check_columns(headers, columns + (list(where) if isinstance(where, dict) else []))
+
+        positions = [headers.index(c) for c in columns]
+
+        if isinstance(where, dict):
+            f_positions = [headers.index(c) for c in where]
+            test = row_filter(where)
+        elif where is not None:
+            proxy = RowProxy(headers)
+
+        yield columns
+
+        for row in rows:
+            if isinstance(where, dict):
+                if not test([row[i] for i in f_positions]):
+                    continue
+            elif where is not None and not where(proxy.set_row(row)):
+                continue
+
+            yield [row[i] for i in positions]
+
+        itr.finish(rows.meta, rows.errors)
 
     @property
     def iterdict(self):
@@ -629,6 +1035,38 @@ class Resource(Term):
 
             yield row_proxy.set_row(row)
 
+    def record_class(self, headers=None):
+        """Return the class of the records from iterrecords(), a named tuple class for the resource's headers
+        or the given headers. The class is made once for each set of headers. """
+        from .records import record_class
+
+        headers = tuple(headers if headers is not None else self.headers)
+
+        cls = self._record_classes.get(headers)
+
+        if cls is None:
+            cls = self._record_classes[headers] = record_class(self.name, headers)
+
+        return cls
+
+    def iterrecords(self, columns=None, where=None):
+        """Iterate over the resource as immutable records, which allow accessing values by attribute, by
+        position or by header. Unlike the rows from iterrows, the records can be kept, and unlike the
+        dicts from iterdict, they are about the size of a tuple. The columns and where arguments
+        select columns and rows, as for iterate()"""
+
+        rows = self.iterate(columns, where)
+
+        try:
+            headers = next(rows)
+        except StopIteration:
+            return
+
+        make = self.record_class(headers)._make
+
+        for row in rows:
+            yield make(row)
+
     @property
     def json_headers(self):
         return [(c['pos'], c.get('json') or c['header']) for c in self.columns() if c.get('json')]
@@ -636,26 +1074,34 @@ class Resource(Term):
     @property
     def iterstruct(self):
         """Yield data structures built from the JSON header specifications in a table"""
-        from rowgenerators.rowpipe.json import add_to_struct
+        from .jsonstruct import compile_struct_builder
 
-        json_headers = self.json_headers
+        build = compile_struct_builder(self.json_headers)
 
         for row in islice(self, 1, None):  # islice skips header
-            d = {}
-            for pos, jh in json_headers:
-                add_to_struct(d, jh, row[pos])
-            yield d
+            yield build(row)
 
     def iterjson(self, *args, **kwargs):
-        """Yields the data structures from iterstruct as JSON strings"""
-        from rowgenerators.rowpipe.json import VTEncoder
-        import json
+        """Yields the data structures from iterstruct as JSON strings. Keyword arguments are
+        the same as for json.dumps()"""
+        from .jsonstruct import json_encoder
 
-        if 'cls' not in kwargs:
-            kwargs['cls'] = VTEncoder
+        encode = json_encoder(**kwargs)
 
         for s in self.iterstruct:
-            yield (json.dumps(s, *args, **kwargs))
+            yield encode(s)
+
+    def write_ndjson(self, f, limit=None, fast=False):
+        """Write the data structures from iterstruct to a file as JSON lines, in large buffered writes.
+
+        :param f: A writable text file
+        :param limit: If set, write only the first limit rows
+        :param fast: If True, encode with orjson, if it is installed
+        :return: The number of lines written
+        """
+        from .jsonstruct import write_ndjson
+
+        return write_ndjson(islice(self.iterstruct, limit), f, fast=fast)
 
     def iteryaml(self, *args, **kwargs):
         """Yields the data structures from iterstruct as YAML strings"""
@@ -668,19 +1114,385 @@ class Resource(Term):
         for s in self.iterstruct:
             yield (yaml.safe_dump(s))
 
-    def dataframe(self, dtype=True, parse_dates=True, *args, **kwargs):
-        """Return a pandas datafrome from the resource"""
+    def _arrow_types(self, headers):
+        """Return Arrow types for a list of headers, from the datatypes of the resource columns"""
+        from .columnar import arrow_type
 
-        import pandas as pd
+        datatypes = {c.get('header'): c.get('datatype') for c in self.columns()}
+
+        return [arrow_type(datatypes.get(h)) for h in headers]
+
+    def _arrow_cast_columns(self, headers):
+        """Return the row processor table columns for a list of headers, for casting them with
+        cast_source_array(), or None if some of them need more than a plain datatype cast"""
+        from .processor import is_vector_column
+
+        try:
+            rp_columns = {str(c.name): c for c in self.plan.rptable}
+        except Exception:  # Schemas the row processor table can't be built from
+            return None
+
+        if any(h not in rp_columns or not is_vector_column(rp_columns[h]) for h in headers):
+            return None
+
+        return [rp_columns[h] for h in headers]
+
+    def _arrow_cast_batches(self, blocks, schema, rp_columns, batch_size):
+        """Yield record batches of at most batch_size rows from an iterable of lists of source string arrays,
+        cast like the row processor casts them. Casting errors are recorded as they are for iteration"""
+        import pyarrow as pa
+        from collections import defaultdict
+        from .columnar import cast_source_array
+
+        errors = ErrorSummary() if self.summarize_errors else defaultdict(set)
+        row_n = 0
+
+        for arrays in blocks:
+            n = len(arrays[0]) if arrays else 0
+            numbers = range(row_n, row_n + n)
+
+            arrays = [cast_source_array(a, ty, c, errors, numbers)
+                      for a, ty, c in zip(arrays, schema.types, rp_columns)]
+
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+            for i in range(0, batch.num_rows, batch_size):
+                yield batch.slice(i, batch_size)
+
+            row_n += n
+
+        self._publish_iteration(*_iteration_results({'rows': row_n}, errors))
+
+    def iterbatches(self, batch_size=None, materialize=False, columns=None):
+        """Iterate over the resource as column-oriented Arrow record batches of at most batch_size rows.
+
+        Column types come from the datatypes of the schema. Columns without a declared type have their
+        types inferred from the first batch. Works for any resource that can be iterated, including
+        CSV files, python: generators and Metapack references.
+
+        Only CSV and fixed-width files whose schema only declares datatypes are read directly into
+        columns. Other resources, including Excel files, python: generators, references and schemas
+        with transforms, are iterated as rows by the row processor, then converted to columns, so
+        they are no faster than iterating over the rows.
+
+        If materialize is True, the batches are read from the resource's Parquet copy in the cache,
+        which is written first if it does not exist.
+
+        If columns is a list of column names, the batches have only those columns. Parquet and CSV
+        files read by Arrow only read those columns, and the row processor only processes them. """
+        from .columnar import iter_record_batches, DEFAULT_BATCH_SIZE
+
+        batch_size = batch_size or DEFAULT_BATCH_SIZE
+
+        if columns is not None:
+            self._check_columns(self.headers, columns)
+
+        if materialize:
+            import pyarrow.parquet as pq
+
+            path = self.materialize()
+
+            if path:
+                yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size,
+                                                             columns=[str(c) for c in columns] if columns else None)
+                return
+
+        csv_batches = self._arrow_csv_batches(batch_size, columns) or self._arrow_fixed_batches(batch_size, columns)
+
+        if csv_batches:
+            yield from csv_batches[1]
+            return
+
+        itr = self.iterate(columns)
+
+        try:
+            headers = next(itr)
+        except StopIteration:
+            return
+
+        # Values that don't fit the type inferred from the first batch are added to the casting errors
+        errors = ErrorSummary() if self.summarize_errors else {}
+
+        yield from iter_record_batches(itr, headers, self._arrow_types(headers), batch_size, errors)
+
+        if errors:
+            if isinstance(errors, ErrorSummary):
+                if isinstance(itr.errors, ErrorSummary):
+                    errors.merge(itr.errors)
+            else:
+                for k, v in itr.errors.items():
+                    errors.setdefault(k, set()).update(v)
+
+            itr.finish(itr.meta, errors)
+
+    def _arrow_csv_batches(self, batch_size, include_columns=None):
+        """For CSV resources whose schema only declares datatypes, read the file directly with the Arrow
+        CSV reader, skipping the row generator and row processor. Returns a tuple of the schema and a
+        generator of batches, or None if the resource must go through the row processor. If include_columns
+        is a list of column names, only those columns are parsed."""
+        import pyarrow as pa
+        from pyarrow import csv
+        from .appurl import is_metapack_url
+        from .columnar import arrow_schema, arrow_type, iter_record_batches
+
+        columns = self.schema_columns
+
+        if not columns:
+            return None
+
+        for c in columns:
+            if (c.get('transform') or c.get('valuetype') or c.get('name') == EMPTY_SOURCE_HEADER
+                    or (c.get('datatype') and not arrow_type(c.get('datatype')))):
+                return None
+
+        ru = self.resolved_url
+
+        if not ru or is_metapack_url(ru):
+            return None
+
+        _, start, end = self._get_start_end_header()
+
+        if end is not None:
+            return None
+
+        try:
+            t = self.plan.target
+        except AttributeError:
+            return None
+
+        if t is None or t.scheme != 'file' or t.target_format != 'csv':
+            return None
+
+        headers = [str(h) for h in self.headers]
+        types = [arrow_type(c.get('datatype')) for c in columns]
+
+        if include_columns is not None:
+            include_columns = [str(c) for c in include_columns]
+
+            if any(c not in headers for c in include_columns):
+                return None
+
+            types = [types[headers.index(c)] for c in include_columns]
+        else:
+            include_columns = headers
+
+        rp_columns = self._arrow_cast_columns(include_columns)
+
+        if rp_columns is None:
+            return None
+
+        # Rows with the wrong number of fields, which the row processor pads, stop the Arrow read
+        invalid_rows = []
+
+        def _invalid_row(row):
+            invalid_rows.append(row)
+            return 'skip'
+
+        # Read everything as strings, then cast, so bad values become nulls rather than
+        # stopping the read, like casting errors in the row processor.
+        read_options = csv.ReadOptions(column_names=headers, skip_rows=start, encoding=t.encoding or 'utf8')
+        parse_options = csv.ParseOptions(newlines_in_values=True, invalid_row_handler=_invalid_row)
+        convert_options = csv.ConvertOptions(column_types={h: pa.string() for h in include_columns},
+                                             include_columns=include_columns,
+                                             null_values=[''], strings_can_be_null=True,
+                                             quoted_strings_can_be_null=True)
+
+        try:
+            reader = csv.open_csv(str(t.fspath), read_options=read_options, parse_options=parse_options,
+                                  convert_options=convert_options)
+        except (pa.ArrowInvalid, OSError):
+            return None
+
+        schema = arrow_schema(include_columns, types)
+
+        def _blocks():
+            for b in reader:
+                if invalid_rows:
+                    return
+
+                yield b.columns
+
+        def _batches():
+            n = 0
+
+            for batch in self._arrow_cast_batches(_blocks(), schema, rp_columns, batch_size):
+                n += batch.num_rows
+                yield batch
+
+            if invalid_rows:
+                # Continue from the block with the bad row with the row processor, which also
+                # records the errors for the whole file
+                rows = islice(self.iterate(include_columns), n + 1, None)
+                yield from iter_record_batches(rows, include_columns, schema.types, batch_size)
+
+        return schema, _batches()
+
+    def _arrow_fixed_batches(self, batch_size, include_columns=None):
+        """For fixed-width resources whose schema only declares datatypes, slice and cast whole columns of
+        each block from the fixed-width reader, skipping the row processor. Returns a tuple of the schema and
+        a generator of batches, or None if the resource must go through the row processor."""
+        from .appurl import is_metapack_url
+        from .columnar import arrow_schema, arrow_type
+        from .fixedwidth import fixed_width_reader
+
+        columns = self.schema_columns
+
+        if not columns or not self.fixed_width_engine:
+            return None
+
+        for c in columns:
+            if (c.get('transform') or c.get('valuetype') or c.get('name') == EMPTY_SOURCE_HEADER
+                    or (c.get('datatype') and not arrow_type(c.get('datatype')))):
+                return None
+
+        ru = self.resolved_url
+
+        if not ru or is_metapack_url(ru):
+            return None
+
+        try:
+            reader = fixed_width_reader(self.row_generator)
+        except (AttributeError, ResourceError):
+            return None
+
+        if reader is None:
+            return None
+
+        headers = [str(h) for h in self.headers]
+
+        if len(headers) != len(reader.layout):
+            return None
+
+        types = [arrow_type(c.get('datatype')) for c in columns]
+
+        if include_columns is not None:
+            include_columns = [str(c) for c in include_columns]
+
+            if any(c not in headers for c in include_columns):
+                return None
+        else:
+            include_columns = headers
+
+        positions = [headers.index(c) for c in include_columns]
+        types = [types[i] for i in positions]
+
+        rp_columns = self._arrow_cast_columns(include_columns)
+
+        if rp_columns is None:
+            return None
+
+        _, start, end = self._get_start_end_header()
+
+        schema = arrow_schema(include_columns, types)
+
+        blocks = ([block_columns[i] for i in positions]
+                  for _, block_columns in reader.iter_arrow_columns(start, end))
+
+        return schema, self._arrow_cast_batches(blocks, schema, rp_columns, batch_size)
+
+    def arrow_reader(self, batch_size=None, columns=None):
+        """Return a pyarrow RecordBatchReader that streams the resource data. CSV resources that only
+        need type casting are read directly by Arrow; all others are streamed from the row iterator. """
+        import pyarrow as pa
+        from itertools import chain
+        from .columnar import arrow_schema
+
+        batches = self.iterbatches(batch_size, columns=columns)
+
+        try:
+            first = next(batches)
+        except StopIteration:
+            headers = columns or self.headers or []
+            return pa.RecordBatchReader.from_batches(arrow_schema(headers, self._arrow_types(headers)), [])
+
+        return pa.RecordBatchReader.from_batches(first.schema, chain([first], batches))
+
+    def arrow_table(self, batch_size=None, columns=None):
+        """Return the resource data as a pyarrow Table, which can be passed without copying to
+        pandas, polars or DuckDB"""
+
+        return self.arrow_reader(batch_size, columns).read_all()
+
+    def materialize(self, force=False, geo=False):
+        """Write the processed resource data to a Parquet file in the cache, if it is not already there, and
+        return the path. The file is rebuilt when the resolved URL, the source file or the schema changes.
+        Returns None for resources that don't have a local source file, such as python: generators.
+
+        If geo is True, the file is a separate copy with the geometry column stored as WKB, as geoframe()
+        reads it."""
+        from .materialize import materialize
+
+        return materialize(self, force=force, geo=geo)
+
+    def dataframe(self, dtype=True, parse_dates=True, *args, materialize=False, columns=None, filter=None,
+                  workers=None, compact=False, **kwargs):
+        """Return a pandas datafrome from the resource
+
+        If materialize is True, the dataframe is read from the resource's Parquet copy in the cache, which
+        is written first if it does not exist.
+
+        The columns and filter arguments select columns and rows, as the columns and where arguments
+        to iterate(), and only the selected columns are processed. If workers is greater than 1, rows
+        that go through the row processor are processed in a pool of that many processes, which can't be
+        used with transforms that keep state across rows. See iterate().
+
+        If compact is True, columns get the smallest dtypes that hold their values: narrow integers, float32,
+        categories for text with few distinct values and datetimes parsed with the format of the column.
+        Text columns are loaded as Arrow strings a batch at a time, and the others are narrowed once they
+        are loaded. The nuniques and format properties of the schema columns are used where they exist. See
+        metapack.compact """
+
+        df = self._load_dataframe(dtype, parse_dates, *args, materialize=materialize, columns=columns,
+                                  filter=filter, workers=workers, compact=compact, **kwargs)
+
+        if compact:
+            from .compact import compact_frame
+
+            return compact_frame(df, self.columns())
+
+        return df
+
+    def _load_dataframe(self, dtype=True, parse_dates=True, *args, materialize=False, columns=None, filter=None,
+                        workers=None, compact=False, **kwargs):
+        """Load the dataframe for dataframe(). If compact is True, text columns are loaded with the dtypes
+        from compact.compact_dtypes()"""
         import warnings
         from rowgenerators.exceptions import RowGeneratorConfigError, RowGeneratorError
+        from .fixedwidth import fixed_width_reader
+
+        if materialize and not callable(filter):
+            path = self.materialize()
+
+            if path:
+                return self._read_materialized(path, columns, filter, compact)
+
+        if columns is not None or filter is not None or (workers and workers > 1):
+            return self._select_dataframe(columns, filter, workers, compact)
+
+        if not args and not kwargs:
+            from .columnar import DEFAULT_BATCH_SIZE
+
+            try:
+                fixed_batches = self._arrow_fixed_batches(DEFAULT_BATCH_SIZE)
+            except ImportError:  # No pyarrow
+                fixed_batches = None
+
+            if fixed_batches:
+                import pyarrow as pa
+
+                schema, batches = fixed_batches
+                return self._arrow_to_pandas(pa.Table.from_batches(list(batches), schema=schema), compact)
 
         rg = self.row_generator
 
-        mod_kwargs = self._update_pandas_kwargs(dtype, parse_dates, kwargs)
+        if self.fixed_width_engine and fixed_width_reader(rg) is not None:
+            # The FixedSource's own dataframe() takes the first line as the header and skips the schema
+            return self._build_dataframe(*args, compact=compact, **kwargs)
+
+        mod_kwargs = self._update_pandas_kwargs(dtype, parse_dates, kwargs, compact)
 
         # Unecessary?
-        self.resolved_url.get_resource().get_target()
+        self.plan.target
 
         # Maybe generator has it's own Dataframe method()
         if not self.resolved_url.start and not self.resolved_url.headers:
@@ -717,12 +1529,129 @@ class Resource(Term):
 
         # Just normal data, so use the iterator in this object.
 
-        headers = next(islice(self, 0, 1))  # Why not using the schema?
-        data = islice(self, 1, None)
+        return self._build_dataframe(*args, compact=compact, **kwargs)
+
+    def _select_dataframe(self, columns=None, filter=None, workers=None, compact=False):
+        """Return a dataframe of some columns and rows of the resource. When there is no filter, CSV
+        files that Arrow can read have only the selected columns parsed"""
+        from .columnar import DEFAULT_BATCH_SIZE
+
+        if filter is None:
+            if columns is not None:
+                self._check_columns(self.headers, columns)
+
+            try:
+                csv_batches = (self._arrow_csv_batches(DEFAULT_BATCH_SIZE, columns)
+                               or self._arrow_fixed_batches(DEFAULT_BATCH_SIZE, columns))
+            except ImportError:  # No pyarrow
+                csv_batches = None
+
+            if csv_batches:
+                import pyarrow as pa
+
+                schema, batches = csv_batches
+                return self._arrow_to_pandas(pa.Table.from_batches(list(batches), schema=schema), compact)
+
+        return self._build_dataframe(rows=self.iterate(columns, filter, workers), compact=compact)
+
+    def _build_dataframe(self, *args, rows=None, compact=False, **kwargs):
+        """Build a dataframe from one pass of the resource's iterator, or of rows, an iterator that yields
+        a header and then rows, appending chunks of rows to column buffers typed from the schema. If
+        compact is True, text columns are buffered as Arrow strings. Sets 'rows' and 'bytes' in
+        post_iter_meta"""
+        import pandas as pd
+        from .columnar import DEFAULT_BATCH_SIZE, FrameBuilder, column_kind
+
+        itr = rows if rows is not None else iter(self)
+
+        headers = next(itr)
+
+        if args or kwargs:
+            # Extra DataFrame constructor arguments, so build it the way pandas does
+            df = pd.DataFrame(list(itr), columns=headers, *args, **kwargs)
+        else:
+            from .compact import compact_dtypes
+
+            datatypes = {c.get('header'): c.get('datatype') for c in self.columns()}
+            dtypes = compact_dtypes(self.columns()) if compact else {}
+
+            fb = FrameBuilder(headers, [column_kind(datatypes.get(h), dtypes.get(h)) for h in headers])
+
+            while True:
+                chunk = list(islice(itr, DEFAULT_BATCH_SIZE))
+
+                if not chunk:
+                    break
+
+                fb.append(chunk)
+
+            df = fb.dataframe()
+
+        size = dict(rows=len(df), bytes=int(df.memory_usage(index=True, deep=True).sum()))
+
+        if isinstance(itr, ResourceIterator):
+            itr.update_meta(**size)
+        else:
+            self._publish_iteration(dict(self.post_iter_meta or {}, **size), self.errors)
+
+        return df
+
+    def _arrow_to_pandas(self, t, compact=False):
+        """Convert an Arrow table to a dataframe, with nullable integers, as _update_pandas_kwargs()
+        uses for CSV files. If compact is True, strings stay in Arrow, rather than becoming Python strings"""
+        import pandas as pd
+        import pyarrow as pa
+
+        types = {pa.int64(): pd.Int64Dtype()}
 
-        df = pd.DataFrame(list(data), columns=headers, *args, **kwargs)
+        if compact:
+            types.update({pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')})
 
-        self.errors = rg.errors if hasattr(rg, 'errors') and rg.errors else {}
+        return t.to_pandas(types_mapper=types.get)
+
+    def _read_materialized(self, path, columns=None, filter=None, compact=False):
+        """Read a materialized Parquet file into a dataframe. Only the selected columns are read, and
+        the filter, a dict of column names to values or functions of the value, selects rows. Filters
+        with plain values are also given to the Parquet reader, so it can skip row groups. """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        filter = filter or {}
+
+        if columns is not None:
+            self._check_columns(self.headers, list(columns) + list(filter))
+            read_columns = [str(c) for c in columns] + [str(c) for c in filter if c not in columns]
+        else:
+            read_columns = None
+
+        filters = [(str(k), '==', v) for k, v in filter.items() if not callable(v) and v is not None]
+
+        try:
+            t = pq.read_table(path, columns=read_columns, filters=filters or None)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, TypeError):
+            t = pq.read_table(path, columns=read_columns)
+
+        df = self._arrow_to_pandas(t, compact)
+
+        if filter:
+            mask = None
+
+            for k, v in filter.items():
+                s = df[str(k)]
+
+                if callable(v):
+                    m = s.astype(object).where(s.notna(), None).map(v).astype(bool)
+                elif v is None:
+                    m = s.isna()
+                else:
+                    m = (s == v).fillna(False).astype(bool)
+
+                mask = m if mask is None else mask & m
+
+            df = df[mask].reset_index(drop=True)
+
+        if columns is not None:
+            df = df[[str(c) for c in columns]]
 
         return df
 
@@ -730,13 +1659,61 @@ class Resource(Term):
     def isgeo(self):
         return 'geometry' in [c['name'] for c in self.columns()]
 
-    def geoframe(self, *args, **kwargs):
-        """Return a Geo dataframe"""
+    def spatial_index(self):
+        """Return a SpatialIndex of the row envelopes of a geo resource, building it from the resource's
+        WKB Parquet copy in the cache on first use"""
+        from .spatial import SpatialIndex
+
+        if not self.isgeo:
+            raise ResourceError("Resource '{}' does not have a geometry column".format(self.name))
+
+        path = self.materialize(geo=True)
+
+        if path is None:
+            raise ResourceError("Can't build a spatial index for resource '{}', which has no local source file"
+                                .format(self.name))
+
+        if self._spatial_index is None or self._spatial_index.geo_path != path:
+            self._spatial_index = SpatialIndex(path)
+
+        return self._spatial_index
+
+    def intersects(self, geometry, columns=None):
+        """Return a GeoDataFrame of the rows of a geo resource with geometries that intersect a shapely
+        geometry. Only the geometries of rows with envelopes that intersect the geometry's envelope
+        are decoded.
+
+        :param geometry: A shapely geometry, in the CRS of the resource's materialized copy, which is the
+            projection of the rows from the row generator. The returned frame has the same CRS.
+        :param columns: If set, a list of the columns to return. The geometry column is always returned.
+        """
+
+        return self.spatial_index().intersects(geometry, columns)
+
+    def geoframe(self, *args, materialize=False, bbox=None, **kwargs):
+        """Return a Geo dataframe
+
+        If materialize is True, the dataframe is read from a Parquet copy of the resource in the cache, with
+        the geometries stored as WKB, which is written first if it does not exist. Its CRS is the one recorded
+        in the copy, which is the projection of the rows from the row generator.
+
+        If bbox is a (minx, miny, maxx, maxy) tuple, only the rows with geometries that intersect the box
+        are returned, using the spatial index, as with intersects(). """
 
         from geopandas import GeoDataFrame
         import geopandas as gpd
-        from shapely.geometry.polygon import BaseGeometry
-        from shapely.wkt import loads
+        from .geo import decode_geometry, read_geoparquet
+
+        if bbox is not None:
+            from shapely.geometry import box
+
+            return self.intersects(box(*bbox))
+
+        if materialize:
+            path = self.materialize(geo=True)
+
+            if path:
+                return read_geoparquet(path)
 
         gdf = None
         try:
@@ -759,35 +1736,14 @@ class Resource(Term):
         if gdf is None:
             try:
 
-                gdf = GeoDataFrame(self.dataframe(*args, **kwargs))
-
-                first = next(gdf.iterrows())[1]['geometry']
+                df = self.dataframe(*args, **kwargs)
 
-                if isinstance(first, str):
-                    # We have a GeoDataframe, but the geometry column is still strings, so
-                    # it must be converted
-
-                    def robust_loads(data):
-                        try:
-                            return loads(data)
-                        except AttributeError:  # 'float' object has no attribute 'encode' -> loads got a nan
-                            return None
-
-                    shapes = [robust_loads(row['geometry']) for i, row in gdf.iterrows()]
-
-                elif not isinstance(first, BaseGeometry):
-                    # If we are reading a metatab package, the geometry column's type should be
-                    # 'geometry' which will give the geometry values class type of
-                    # rowpipe.valuetype.geo.ShapeValue. However, there are other
-                    # types of objects that have a 'shape' property.
-
-                    shapes = [row['geometry'].shape for i, row in gdf.iterrows()]
-
-                else:
-                    shapes = gdf['geometry']
+                # The geometry column may have WKT strings, WKB, shapely geometries or, for
+                # metatab packages, rowpipe.valuetype.geo.ShapeValue objects, which are all decoded
+                # a batch at a time, with None for values that aren't valid geometries.
+                df['geometry'] = gpd.GeoSeries(decode_geometry(df['geometry']), index=df.index)
 
-                gdf['geometry'] = gpd.GeoSeries(shapes)
-                gdf.set_geometry('geometry')
+                gdf = GeoDataFrame(df, geometry='geometry')
 
                 # Wild guess. This case should be most often for Metatab processed geo files,
                 # which are all 4326
@@ -803,10 +1759,11 @@ class Resource(Term):
         assert gdf.crs is not None
         return gdf
 
-    def _update_pandas_kwargs(self, dtype=False, parse_dates=True, kwargs={}):
+    def _update_pandas_kwargs(self, dtype=False, parse_dates=True, kwargs={}, compact=False):
         """ Construct args suitable for pandas read_csv
         :param dtype: If true, create a dtype type map. Otherwise, pass argument value to read_csv
         :param parse_dates: If true, create a list of date/time columns for the parse_dates argument of read_csv
+        :param compact: If true, and dtype is true, text columns get the dtypes from compact.compact_dtypes()
         :param kwargs:
         :return:
         """
@@ -836,6 +1793,11 @@ class Resource(Term):
 
         if dtype is True:
             kwargs['dtype'] = {c['header']: type_map.get(c['datatype'], c['datatype']) for c in self.columns()}
+
+            if compact:
+                from .compact import compact_dtypes
+
+                kwargs['dtype'].update(compact_dtypes(self.columns()))
         elif dtype:
             kwargs['dtype'] = dtype
 
@@ -858,7 +1820,7 @@ class Resource(Term):
         import pandas
         from .exc import InternalError
 
-        t = self.resolved_url.get_resource().get_target()
+        t = self.plan.target
 
         kwargs = self._update_pandas_kwargs(dtype, parse_dates, kwargs)
 
@@ -888,22 +1850,46 @@ class Resource(Term):
         Don't provide the first argument of read_fwf(); it is supplied internally. """
         import pandas
 
-        t = self.resolved_url.get_resource().get_target()
+        t = self.plan.target
 
         return pandas.read_fwf(t.fspath, *args, **kwargs)
 
     def readlines(self):
-        """Load the target, open it, and return the result from readlines()"""
+        """Load the target, open it, and return the result from readlines(). For large files, use
+        iterlines() or buffer(), which don't read the whole file into memory"""
 
-        t = self.resolved_url.get_resource().get_target()
+        t = self.plan.target
         with open(t.fspath) as f:
             return f.readlines()
 
+    def iterlines(self, encoding=None, binary=False, decompress=True):
+        """Load the target and yield its lines, with their line endings, one at a time.
+
+        :param encoding: Text encoding. Defaults to the encoding of the target URL, or utf8
+        :param binary: If True, yield bytes rather than strings
+        :param decompress: If True, gzip, bz2, xz and zstd targets are decompressed as they are read
+        """
+        from .buffers import iter_lines
+
+        t = self.plan.target
+
+        yield from iter_lines(str(t.fspath), encoding or getattr(t, 'encoding', None) or 'utf8', binary, decompress)
+
+    def buffer(self):
+        """Load the target and return a read-only memory map of it, which can be sliced, searched, or
+        passed to memoryview() or numpy.frombuffer() without copying. Use it as a context manager
+        to unmap the file. Compressed targets can't be mapped; use iterlines() for those. """
+        from .buffers import map_file
+
+        t = self.plan.target
+
+        return map_file(str(t.fspath))
+
     def petl(self, *args, **kwargs):
         """Return a PETL source object"""
         import petl
 
-        t = self.resolved_url.get_resource().get_target()
+        t = self.plan.target
 
         if t.target_format == 'txt':
             return petl.fromtext(str(t.fspath), *args, **kwargs)
@@ -1019,8 +2005,7 @@ class SqlQuery(Resource):
             'ALL_COLUMNS': ', '.join(all_columns)
         }
 
-    @property
-    def resolved_url(self):
+    def _make_resolved_url(self):
 
         if not self.query:
             return None
@@ -1048,7 +2033,7 @@ class SqlQuery(Resource):
         return u
 
 
-class Distribution(Term):
+class Distribution(TrackedTerm):
 
     def __init__(self, term, value, term_args=False, row=None, col=None, file_name=None, file_type=None, parent=None,
                  doc=None, section=None):
@@ -6,6 +6,7 @@
 import mimetypes
 import os
 import shutil
+import threading
 from genericpath import exists
 from os import makedirs
 from os.path import join
@@ -276,7 +277,24 @@ def walk_up(bottom):
 
 def ensure_dir(path):
     if path and not exists(path):
-        makedirs(path)
+        makedirs(path, exist_ok=True)
+
+
+def temp_path(path):
+    """Return a temporary path to write a file to before moving it to path, unique to the process and
+    thread, so concurrent writers of the same file don't write to the same temporary file"""
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def path_lock(path):
+    """Return a lock for a path, for threads that build a file in the cache, so only one of them builds it"""
+
+    with _path_locks_lock:
+        return _path_locks.setdefault(str(path), threading.Lock())
 
 
 def copytree(src, dst, symlinks=False, ignore=None):
@@ -43,6 +43,1014 @@ class TestPackages(unittest.TestCase):
                 print(tabulate(data))
                 print(r.name, hash)
 
+    def test_iterbatches(self):
+        pkg = open_package('example.com-iterators')
+
+        for r in pkg.resources():
+            rows = list(r)
+
+            batches = list(r.iterbatches(batch_size=7))
+
+            self.assertEqual([str(h) for h in rows[0]], batches[0].schema.names)
+            self.assertEqual(len(rows) - 1, sum(b.num_rows for b in batches))
+
+        r = pkg.resource('data1')
+        b = next(r.iterbatches())
+        self.assertEqual('int64', str(b.schema.field('column1').type))
+        self.assertEqual('string', str(b.schema.field('value').type))
+
+        # Later values that don't fit the type inferred from the first batch are casting errors
+        from metapack.columnar import iter_record_batches
+        from metapack.casterrors import ErrorSummary
+
+        rows = [[i] for i in range(10)] + [['x'], [11]]
+
+        errors = {}
+        batches = list(iter_record_batches(rows, ['a'], batch_size=5, errors=errors))
+        self.assertEqual('int64', str(batches[-1].schema.field('a').type))
+        self.assertEqual([None, 11], batches[-1].column(0).to_pylist())
+        self.assertEqual(['a'], list(errors))
+
+        errors = ErrorSummary()
+        list(iter_record_batches(rows, ['a'], batch_size=5, errors=errors))
+        self.assertEqual([10], errors['a'].rows)
+        self.assertEqual(['x'], errors['a'].samples)
+
+    def test_arrow_table(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+            rows = list(r)
+
+            t = r.arrow_table()
+
+            self.assertEqual(len(rows) - 1, t.num_rows)
+            self.assertEqual([list(e) for e in rows[1:]], [list(e.values()) for e in t.to_pylist()])
+
+    def test_arrow_casting_errors(self):
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+
+        # Values that Arrow can't cast exactly, so they go through the row processor casts: the values
+        # are not integers, and the row processor parses '1' as a date, although it isn't an ISO date
+        for name, datatype in (('value', 'integer'), ('col_1', 'date')):
+            c = r.schema_term.find_first('Table.Column', value=name)
+            c['datatype'] = datatype
+        r.invalidate()
+
+        rows = list(r)
+        expected_errors = {k: set(v) for k, v in r.errors.items()}
+        self.assertEqual({'value'}, set(expected_errors))
+
+        t = r.arrow_table()
+
+        self.assertEqual([list(e) for e in rows[1:]], [list(e.values()) for e in t.to_pylist()])
+        self.assertEqual(expected_errors, {k: set(v) for k, v in r.errors.items()})
+
+        r.summarize_errors = True
+        r.arrow_table()
+
+        self.assertEqual(10, r.errors['value'].count)
+        self.assertEqual(list(range(10)), r.errors['value'].rows)
+
+        # Quoted newlines, and a short row after the first block that Arrow reads, which the row
+        # processor pads
+        import shutil
+        import tempfile
+        from os.path import join
+        from metapack import MetapackDoc
+
+        with tempfile.TemporaryDirectory() as d:
+            pkg_dir = join(d, 'pkg')
+            shutil.copytree(test_data('packages', 'example.com-iterators'), pkg_dir)
+
+            with open(join(pkg_dir, 'data', 'data.csv'), 'w') as f:
+                f.write('row_num,value,col_1,col_2,col_3,col_4,col_5\n')
+                f.write('0,"a\nb",1,2,3,4,5\n')
+                f.writelines('{0},v{0},1,2,3,4,5\n'.format(i) for i in range(1, 60000))
+                f.write('60000,short\n')
+                f.writelines('{0},v{0},1,2,3,4,5\n'.format(i) for i in range(60001, 60100))
+
+            r = MetapackDoc(join(pkg_dir, 'metadata.csv')).resource('data1')
+
+            rows = list(r)
+            t = r.arrow_table()
+
+            self.assertEqual(60100, t.num_rows)
+            self.assertEqual('a\nb', t.column('value')[0].as_py())
+            self.assertEqual([list(e) for e in rows[1:]], [list(e.values()) for e in t.to_pylist()])
+
+    def test_vectorized_casts(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+
+            r.vectorize = False
+            expected = list(r)
+
+            r.vectorize = True
+            self.assertEqual(expected, list(r))
+
+        # Values in forms that the column-wise casts don't handle are cast like the row processor casts them
+        from rowgenerators.rowpipe import RowProcessor, Table
+        from metapack.processor import ChunkedRowProcessor
+
+        t = Table('t')
+        t.add_column('id', datatype='int')
+
+        for name, datatype in (('i', 'int'), ('f', 'float'), ('d', 'date'), ('dt', 'datetime'), ('s', 'str')):
+            t.add_column(name, datatype=datatype)
+
+        rows = [['1', '1.5', '2020-01-02', '2020-01-02T03:04:05', 'a'],
+                ['1.0', 'nan', '01/02/2020', 'March 5, 2020', 3],
+                ['1e3', '1e3', 'March 5, 2020', '01/02/2020 10:00', ''],
+                ['1_000', 'abc', '', ' 2020-01-02 ', None],
+                ['abc', '', 'garbage', '', 'x'],
+                ['2', '2.5', '2020-01-03', '2020-01-02T03:04:05.123456', 'y'],
+                ['3', '3.5', '2020-01-04', '2020-01-02 03:04', 'z']]
+
+        rp = RowProcessor(rows, t, source_headers=['i', 'f', 'd', 'dt', 's'], env={})
+        expected = list(rp)
+
+        crp = ChunkedRowProcessor(rows, t, source_headers=['i', 'f', 'd', 'dt', 's'], env={})
+
+        self.assertEqual(repr(expected), repr(list(crp)))
+        self.assertEqual(sorted(rp.errors), sorted(crp.errors))
+
+    def test_materialize(self):
+        from os.path import exists
+
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data2')
+
+        path = r.materialize(force=True)
+        self.assertTrue(exists(path))
+        self.assertEqual(path, r.materialize())
+
+        df = r.dataframe(materialize=True)
+        self.assertEqual(len(list(r)) - 1, len(df))
+        self.assertEqual(r.headers, list(df.columns))
+
+        # A change to the package's python library changes the key, so the file is rebuilt
+        from unittest.mock import patch
+        from metapack.materialize import materialized_path
+
+        with patch.object(pkg, '_lib_fingerprint', return_value=(('pylib/__init__.py', 1, 1),)):
+            self.assertNotEqual(path, materialized_path(r))
+
+    def test_build_dataframe(self):
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+        rows = list(r)
+
+        df = r._build_dataframe()
+
+        self.assertEqual(rows[0], list(df.columns))
+        self.assertEqual(len(rows) - 1, len(df))
+        self.assertEqual('Int64', str(df['column1'].dtype))
+        self.assertEqual(rows[1], df.iloc[0].tolist())
+        self.assertEqual(len(df), r.post_iter_meta['rows'])
+        self.assertTrue(r.post_iter_meta['bytes'] > 0)
+
+        # Values that a typed buffer can't hold exactly aren't converted
+        from metapack.columnar import ColumnBuffer
+
+        b = ColumnBuffer('int')
+        b.extend([1, None])
+        b.extend([1.5, None, 2.9])
+        self.assertEqual([1, 1.5, 2.9], b.series().dropna().tolist())
+
+        b = ColumnBuffer('float')
+        b.extend(['1.5', 2.0])
+        self.assertEqual(['1.5', 2.0], b.series().tolist())
+
+        b = ColumnBuffer('string')
+        b.extend(['a', None])
+        self.assertEqual('string', str(b.series().dtype))
+        b.extend([3])
+        self.assertEqual(['a', None, 3], b.series().tolist())
+
+    def test_resolution_plan(self):
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+
+        p = r.plan
+        self.assertIs(p, r.plan)
+        self.assertIs(r.resolved_url, r.resolved_url)
+        self.assertEqual(r.headers, p.headers)
+
+        # Changing a property of the term makes a new plan
+        r['startline'] = 2
+        self.assertIsNot(p, r.plan)
+        self.assertEqual(2, r._get_start_end_header()[1])
+
+        # So does adding a column to the schema
+        p = r.plan
+        r.schema_term.new_child('Column', 'new_column')
+        self.assertIsNot(p, r.plan)
+        self.assertEqual('new_column', r.headers[-1])
+
+        # And changing a property of a column
+        p = r.plan
+        c = [c for c in r.schema_term.children if c.get_value('datatype')][0]
+        c['datatype'] = 'string' if c.get_value('datatype') != 'string' else 'integer'
+        self.assertIsNot(p, r.plan)
+
+        # Or setting the value of a column property term directly
+        p = r.plan
+        self.assertIs(p, r.plan)
+        prop = [e for e in c.children if e.record_term_lc == 'datatype'][0]
+        prop.value = 'integer' if prop.value == 'string' else 'string'
+        self.assertIsNot(p, r.plan)
+
+        p = r.plan
+        r.invalidate()
+        self.assertIsNot(p, r.plan)
+
+    def test_term_index(self):
+        from metatab import MetatabDoc
+
+        pkg = open_package('example.com-iterators')
+
+        def super_find(*args, **kwargs):
+            return MetatabDoc.find(pkg, *args, **kwargs)
+
+        queries = [
+            (('Root.Resource',), {'section': 'Resources'}),
+            (('Root.Datafile',), {}),
+            (('Root.Table',), {'value': 'data_schema_1'}),
+            (('Root.Resource',), {'section': 'Resources', 'name': 'data2'}),
+            (('Root.*',), {'section': 'References'}),
+            (('Root.Name',), {}),
+            (('Table.Column',), {}),
+        ]
+
+        for args, kwargs in queries:
+            self.assertEqual(super_find(*args, **kwargs), pkg.find(*args, **kwargs))
+
+        self.assertEqual('data2', pkg.resource('data2').name)
+
+        # The index is updated in place when a term is added, and misses don't search the whole document
+        from unittest.mock import patch
+
+        index = pkg.term_index
+
+        with patch.object(MetatabDoc, 'find', side_effect=AssertionError('searched')):
+            self.assertIsNone(pkg.resource('nothing'))
+            self.assertEqual([], pkg.find('Root.Table', value='nothing'))
+
+            t = pkg['Resources'].new_term('Root.Datafile', 'http://example.com/foo.csv', name='foobar')
+            self.assertIs(t, pkg.resource('foobar'))
+
+        self.assertIs(index, pkg.term_index)
+
+        # Changes to term values are noticed on lookup
+        t.value = 'http://example.com/bar.csv'
+        self.assertEqual([], pkg.find('Root.Datafile', value='http://example.com/foo.csv'))
+        self.assertEqual([t], pkg.find('Root.Datafile', value='http://example.com/bar.csv'))
+
+        # So are terms renamed in place, although the index has them under their old names
+        r = pkg.resource('data2')
+        r['name'] = 'renamed'
+        self.assertIs(r, pkg.resource('renamed'))
+
+        st = r.schema_term
+        st.value = 'renamed_schema'
+        self.assertEqual([st], pkg.find('Root.Table', value='renamed_schema'))
+
+        r.find_first('Datafile.Name').value = 'renamed_again'
+        self.assertIsNone(pkg.resource('renamed'))
+        self.assertIs(r, pkg.resource('renamed_again'))
+
+        pkg.remove_term(r)
+        self.assertIsNone(pkg.resource('renamed_again'))
+        self.assertEqual(super_find('Root.Datafile'), pkg.find('Root.Datafile'))
+
+    def test_env_cache(self):
+        import os
+        import sys
+
+        pkg = open_package('example.com-iterators')
+
+        env = pkg.env
+        cached = pkg._env
+
+        self.assertIn('colmap', env)
+        self.assertIsNot(env, pkg.env)
+        self.assertIs(cached, pkg._env)
+        self.assertEqual(1, sys.path.count(pkg._doc_dir))
+
+        # Changing a library file rebuilds the context
+        path = os.path.join(pkg._doc_dir, 'pylib', '__init__.py')
+        st = os.stat(path)
+
+        try:
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+            pkg.env
+            self.assertIsNot(cached, pkg._env)
+        finally:
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        # Checking the cache doesn't walk the library
+        from unittest.mock import patch
+
+        pkg.env
+        cached = pkg._env
+
+        with patch('os.walk', side_effect=AssertionError('walked')):
+            pkg.env
+            self.assertIs(cached, pkg._env)
+
+        pkg.invalidate()
+        pkg.env
+        self.assertIsNot(cached, pkg._env)
+
+    def test_iterate_columns_where(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+
+            rows = list(r.iterdict)
+            columns = list(r.headers[-2:]) + [r.headers[0]]
+
+            def select(where):
+                return [[row[c] for c in columns] for row in rows if where(row)]
+
+            self.assertEqual([columns] + select(lambda row: True), list(r.iterate(columns)))
+
+            value = rows[3][columns[0]]
+            self.assertEqual([columns] + select(lambda row: row[columns[0]] == value),
+                             list(r.iterate(columns, where={columns[0]: value})))
+
+            self.assertEqual([columns] + select(lambda row: row['row_num'] % 2 == 0),
+                             list(r.iterate(columns, where={'row_num': lambda v: v % 2 == 0})))
+
+        r = pkg.resource('data1')
+
+        df = r.dataframe(columns=['column2', 'value'], filter={'row_num': lambda v: v < 5})
+        self.assertEqual(['column2', 'value'], list(df.columns))
+        self.assertEqual(len([row for row in r.iterdict if row['row_num'] < 5]), len(df))
+
+        t = r.arrow_table(columns=['value', 'column1'])
+        self.assertEqual(['value', 'column1'], t.schema.names)
+
+    def test_row_index(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+
+            rows = list(r)
+
+            self.assertEqual(len(rows) - 1, r.row_count())
+            self.assertEqual(rows[1:], r.rows())
+            self.assertEqual(rows[4:9], r.rows(3, 8))
+            self.assertEqual(rows[-2:], r.rows(len(rows) - 3))
+            self.assertEqual([], r.rows(len(rows) + 10, len(rows) + 20))
+
+            idx = r.row_index(build=False)
+            self.assertTrue(idx.valid)
+            self.assertEqual(len(rows), idx.count)
+
+    def test_iterate_workers(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+
+            rows = list(r)
+
+            self.assertEqual(rows, list(r.iterate(workers=2)))
+            self.assertEqual(len(rows) - 1, len(r.dataframe(workers=2)))
+
+            where = {r.headers[1]: rows[1][1]}
+            self.assertEqual(list(r.iterate(where=where)), list(r.iterate(where=where, workers=2)))
+
+        # Errors are counted across chunks, so workers stop at the same count of casting errors
+        import shutil
+        import tempfile
+        from os.path import join
+        from unittest.mock import patch
+        from metapack import MetapackDoc
+        from rowgenerators.rowpipe.exceptions import TooManyCastingErrors
+
+        with tempfile.TemporaryDirectory() as d:
+            pkg_dir = join(d, 'pkg')
+            shutil.copytree(test_data('packages', 'example.com-iterators'), pkg_dir)
+
+            with open(join(pkg_dir, 'data', 'data.csv'), 'w') as f:
+                f.write('row_num,value,col_1,col_2,col_3,col_4,col_5\n')
+                f.writelines(','.join('x{}'.format(i) for _ in range(7)) + '\n' for i in range(20))
+
+            r = MetapackDoc(join(pkg_dir, 'metadata.csv')).resource('data1')
+
+            with self.assertRaises(TooManyCastingErrors):
+                list(r)
+
+            with patch('metapack.processor.DEFAULT_CHUNK_SIZE', 5), self.assertRaises(TooManyCastingErrors):
+                list(r.iterate(workers=2))
+
+        # Transforms with state across rows would only see the rows of their own worker's chunks
+        from metapack.exc import ResourceError
+
+        with tempfile.TemporaryDirectory() as d:
+            pkg_dir = join(d, 'pkg')
+            shutil.copytree(test_data('packages', 'example.com-iterators'), pkg_dir)
+
+            with open(join(pkg_dir, 'metadata.csv')) as f:
+                metadata = f.read().replace('str(v)+row.value', '"scratch.setdefault(\'first\', v)"', 1)
+
+            with open(join(pkg_dir, 'metadata.csv'), 'w') as f:
+                f.write(metadata)
+
+            r = MetapackDoc(join(pkg_dir, 'metadata.csv')).resource('data2')
+
+            self.assertEqual(1, len({row[2] for row in list(r)[1:]}))
+
+            with self.assertRaises(ResourceError):
+                list(r.iterate(workers=2))
+
+    def test_compiled_transforms(self):
+        from collections import defaultdict
+        from glob import glob
+        from os.path import dirname
+
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data1', 'data2'):
+            r = pkg.resource(name)
+            r.vectorize = False
+
+            r.compile_transforms = False
+            expected = list(r)
+
+            r.compile_transforms = True
+            self.assertEqual(expected, list(r))
+
+            f = r.compile_row_processor_table()
+            source_rows = list(r.raw_row_generator)[1:]
+            self.assertEqual(expected[1:], f(source_rows, range(len(source_rows)), defaultdict(set), {}, {}, None, r, None))
+
+        self.assertTrue(glob(dirname(r.code_path) + '/data2-*.py'))
+
+    def test_error_summary(self):
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+
+        c = r.schema_term.find_first('Table.Column', value='value')
+        c['datatype'] = 'integer'
+        r.invalidate()
+
+        expected = list(r)
+        self.assertEqual(10, len(r.errors['value']))
+
+        r.summarize_errors = True
+
+        for vectorize in (True, False):
+            r.vectorize = vectorize
+
+            self.assertEqual(expected, list(r))
+
+            errors = r.errors['value']
+            self.assertEqual(10, errors.count)
+            self.assertEqual(list(range(10)), errors.rows)
+            self.assertTrue(set(errors.samples) <= set('abcdefghij'))
+            self.assertEqual(10, r.post_iter_meta['errors']['value']['count'])
+
+    def test_iterrecords(self):
+        pkg = open_package('example.com-iterators')
+
+        for name in ('data0', 'data1', 'data2'):
+            r = pkg.resource(name)
+
+            dicts = list(r.iterdict)
+            records = list(r.iterrecords())
+
+            self.assertEqual([list(d.values()) for d in dicts], [list(e) for e in records])
+            self.assertEqual(dicts, [e._asdict() for e in records])
+            self.assertIs(type(records[0]), r.record_class())
+
+            e = records[2]
+            self.assertEqual(dicts[2]['value'], e.value)
+            self.assertEqual(dicts[2]['value'], e['value'])
+            self.assertEqual(dicts[2]['value'], e[1])
+
+            with self.assertRaises(AttributeError):
+                e.value = 'x'
+
+            with self.assertRaises(AttributeError):
+                e.foo = 'x'
+
+        r = pkg.resource('data1')
+        records = list(r.iterrecords(['value', 'row_num'], where={'row_num': 3}))
+        self.assertEqual(1, len(records))
+        self.assertEqual(('value', 'row_num'), records[0]._fields)
+        self.assertEqual(3, records[0].row_num)
+
+        # Columns can have the names of record methods
+        from metapack.records import record_class
+
+        e = record_class('t', ['dict', 'get', 'headers', '_asdict', 'a b'])._make([1, 2, 3, 4, 5])
+        self.assertEqual((1, 2, 3), (e.dict, e.get, e.headers))
+        self.assertEqual(['dict', 'get', 'headers', '_asdict', 'a b'], list(e._asdict()))
+        self.assertEqual((4, 5, None), (e['_asdict'], e._get('a b'), e._get('c')))
+
+    def test_struct_builder(self):
+        from io import StringIO
+        import json
+        from rowgenerators.rowpipe.json import add_to_struct
+        from metapack.jsonstruct import compile_struct_builder, write_ndjson
+
+        specs = [
+            [(0, 'id'), (1, 'name.first'), (2, 'name.last'), (3, 'geo.loc.lat')],
+            [(0, 'id'), (1, 'tags[]'), (2, 'tags[]'), (3, 'b.c')],
+            [(0, 'id'), (1, 'people[].name'), (2, 'people[-].age'), (3, 'people[].name')],
+            [(0, 'a.b'), (1, 'a'), (2, 'c'), (3, 'c')],
+        ]
+
+        rows = [[1, 'a', 'b', 2.5], [2, None, 'c"d', 0]]
+
+        for json_headers in specs:
+            build = compile_struct_builder(json_headers)
+
+            for row in rows:
+                d = {}
+                for pos, jh in json_headers:
+                    add_to_struct(d, jh, row[pos])
+
+                self.assertEqual(d, build(row))
+
+        build = compile_struct_builder(specs[2])
+        f = StringIO()
+        self.assertEqual(2, write_ndjson((build(row) for row in rows), f, chunk_size=1))
+        self.assertEqual([json.dumps(build(row)) for row in rows], f.getvalue().splitlines())
+
+    def test_decode_geometry(self):
+        import pandas as pd
+        import pyarrow as pa
+        from shapely.geometry import Point
+        from shapely.wkb import loads
+        from rowgenerators.valuetype.geo import ShapeValue
+        from metapack.geo import decode_geometry, wkb_batch
+
+        values = ['POINT (1 2)', None, float('nan'), 'not a shape', 'POLYGON ((0 0, 1 0, 1 1, 0 0))']
+
+        g = decode_geometry(pd.Series(values), batch_size=2)
+        self.assertEqual([Point(1, 2), None, None, None], list(g[:4]))
+        self.assertEqual('Polygon', g[4].geom_type)
+
+        g = decode_geometry([ShapeValue('POINT (3 4)'), Point(5, 6), Point(7, 8).wkb, b'xx', None])
+        self.assertEqual([Point(3, 4), Point(5, 6), Point(7, 8), None, None], list(g))
+
+        b = pa.RecordBatch.from_arrays([pa.array([1, 2]), pa.array(['POINT (1 2)', None])],
+                                       names=['id', 'geometry'])
+        d = wkb_batch(b).to_pydict()
+        self.assertEqual([1, 2], d['id'])
+        self.assertEqual(Point(1, 2), loads(d['geometry'][0]))
+        self.assertIsNone(d['geometry'][1])
+
+    def test_geoparquet_crs(self):
+        import tempfile
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from os.path import join
+        from metapack.geo import DEFAULT_CRS, geoparquet_crs, row_generator_crs, wkb_batch, wkb_schema
+
+        batch = pa.RecordBatch.from_arrays([pa.array([1]), pa.array(['POINT (1 2)'])], names=['id', 'geometry'])
+
+        with tempfile.TemporaryDirectory() as d:
+            path = join(d, 'points.wkb.parquet')
+
+            with pq.ParquetWriter(path, wkb_schema(batch.schema, crs='epsg:2230')) as writer:
+                writer.write_batch(wkb_batch(batch))
+
+            self.assertEqual('epsg:2230', geoparquet_crs(pq.ParquetFile(path).schema_arrow))
+
+        self.assertEqual(DEFAULT_CRS, geoparquet_crs(batch.schema))
+
+        class Source(object):
+            target_projection = '<source>'
+            projection = None
+
+            def __iter__(self):
+                self.projection = 'epsg:26911'
+                yield ['id', 'geometry']
+                raise AssertionError('Only the headers should be read')
+
+        self.assertEqual('epsg:26911', row_generator_crs(Source()))
+        self.assertEqual(DEFAULT_CRS, row_generator_crs(object()))
+
+    def test_spatial_index(self):
+        import tempfile
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from os.path import exists, join
+        from shapely.geometry import Point, box
+        from metapack.geo import wkb_batch, wkb_schema
+        from metapack.spatial import SpatialIndex, envelopes_path
+
+        wkt = ['POINT ({} {})'.format(i, i) for i in range(100)] + [None]
+
+        with tempfile.TemporaryDirectory() as d:
+            path = join(d, 'points-{}.wkb.parquet'.format('0' * 32))
+
+            batch = pa.RecordBatch.from_arrays([pa.array(list(range(len(wkt)))), pa.array(wkt)],
+                                               names=['id', 'geometry'])
+
+            with pq.ParquetWriter(path, wkb_schema(batch.schema, crs='epsg:2230')) as writer:
+                for i in range(0, len(wkt), 10):
+                    writer.write_batch(wkb_batch(batch.slice(i, 10)))
+
+            si = SpatialIndex(path)
+
+            self.assertEqual('epsg:2230', si.crs)
+
+            self.assertTrue(exists(envelopes_path(path)))
+            self.assertEqual(len(wkt), len(si))
+            self.assertTrue(np.isnan(si.envelopes[-1]).all())
+
+            self.assertEqual([20, 21, 22], list(si.candidates(box(19.5, 19.5, 22.5, 22.5))))
+            self.assertEqual([50], list(si.candidates(Point(50, 50).buffer(0.1))))
+            self.assertEqual([], list(si.candidates(box(-10, -10, -5, -5))))
+            self.assertEqual([99], list(si.candidates(box(98.5, 98.5, 200, 200))))
+
+    def test_fixed_width_reader(self):
+        import tempfile
+        from os.path import join
+        from metapack.fixedwidth import FixedWidthLayout, FixedWidthReader
+
+        layout = FixedWidthLayout(['a', 'b', 'c'], [3, '5', 4])
+        self.assertEqual([0, 3, 8], layout.offsets)
+
+        lines = ['{:>3}{:<5}{:>4}'.format(i, 'x' * (i % 5), i * 7 % 1000) for i in range(200)]
+        # Short, empty and non-ASCII lines, which can't be sliced as records
+        lines = lines[:10] + ['12', '', '\u00e9  ab   cd  '] + lines[10:]
+
+        rows = [layout.parse_line(line) for line in lines]
+        self.assertEqual(['0', '', '0'], rows[0])
+
+        with tempfile.TemporaryDirectory() as d:
+            path = join(d, 'data.txt')
+
+            with open(path, 'w', encoding='utf8') as f:
+                f.write('\n'.join(lines))  # No newline at the end
+
+            for block_size in (7, 100, 1000000):
+                r = FixedWidthReader(path, layout, block_size=block_size)
+
+                self.assertEqual(rows, list(r.iter_rows()))
+                self.assertEqual(rows[5:17], list(r.iter_rows(5, 17)))
+                self.assertEqual(rows[3:], list(r.iter_rows(3, offset=13 * 2, first_row=2)))
+
+                cols = []
+                for _, block in r.iter_arrow_columns(2, 150):
+                    cols.extend(map(list, zip(*(c.to_pylist() for c in block))))
+
+                self.assertEqual([[v or None for v in row] for row in rows[2:150]], cols)
+
+    def test_iterlines(self):
+        import bz2
+        import gzip
+        import lzma
+        import tempfile
+        from os.path import join
+        from metapack.buffers import compression, iter_lines
+
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+
+        lines = r.readlines()
+
+        self.assertEqual(lines, list(r.iterlines()))
+        self.assertEqual([l.encode('utf8') for l in lines], list(r.iterlines(binary=True)))
+
+        with r.buffer() as b:
+            self.assertEqual(''.join(lines).encode('utf8'), b[:])
+            self.assertEqual(lines[1].encode('utf8'), b[len(lines[0]):b.find(b'\n', len(lines[0])) + 1])
+
+        data = ''.join(lines).encode('utf8')
+
+        with tempfile.TemporaryDirectory() as d:
+            for name, m in (('gzip', gzip), ('bz2', bz2), ('xz', lzma)):
+                path = join(d, 'data.' + name)
+
+                with open(path, 'wb') as f:
+                    f.write(m.compress(data))
+
+                self.assertEqual(name, compression(path))
+                self.assertEqual(lines, list(iter_lines(path)))
+
+            self.assertIsNone(compression(r.plan.target.fspath))
+
+    def test_compact_dataframe(self):
+        import numpy as np
+        import pandas as pd
+        from metapack.compact import compact_frame
+
+        pkg = open_package('example.com-iterators')
+
+        r = pkg.resource('data1')
+
+        df = r.dataframe()
+        cdf = r.dataframe(compact=True)
+
+        self.assertEqual(list(df.columns), list(cdf.columns))
+        self.assertLess(cdf.memory_usage(deep=True).sum(), df.memory_usage(deep=True).sum())
+        self.assertEqual(1, cdf['col_1'].dtype.itemsize)
+        self.assertEqual(df['col_1'].tolist(), cdf['col_1'].tolist())
+
+        # Text columns are loaded as Arrow strings, not converted after the whole frame is built
+        from metapack.compact import compact_dtypes
+
+        self.assertEqual({'value': 'string[pyarrow]'}, compact_dtypes(r.columns()))
+
+        for ldf in (r._load_dataframe(compact=True), r._load_dataframe(columns=['value'], compact=True),
+                    r._build_dataframe(compact=True)):
+            self.assertEqual(pd.StringDtype('pyarrow'), ldf['value'].dtype)
+            self.assertEqual(df['value'].tolist(), ldf['value'].tolist())
+
+        df = pd.DataFrame({
+            'i': pd.array([1, None, 300], dtype='Int64'),
+            'big': [1, 2 ** 40, 3],
+            'f': [0.5, 0.25, np.nan],
+            'g': [0.1, 0.2, 0.3],
+            'cat': ['a', 'a', 'b'],
+            'd': ['01/02/2020', 'bad', None],
+        })
+
+        columns = [dict(header='i', datatype='integer'),
+                   dict(header='big', datatype='integer'),
+                   dict(header='f', datatype='number'),
+                   dict(header='g', datatype='number'),
+                   dict(header='cat', datatype='string', nuniques=2),
+                   dict(header='d', datatype='date', format='%m/%d/%Y')]
+
+        c = compact_frame(df, columns, category_ratio=0.7)
+
+        self.assertEqual('Int16', str(c['i'].dtype))
+        self.assertEqual('int64', str(c['big'].dtype))
+        self.assertEqual('float32', str(c['f'].dtype))
+        self.assertEqual('float64', str(c['g'].dtype))  # 0.1 isn't exact in float32
+        self.assertEqual('category', str(c['cat'].dtype))
+        self.assertEqual(pd.Timestamp('2020-01-02'), c['d'][0])
+        self.assertTrue(c['d'][1:].isna().all())
+
+    def test_parse_cache(self):
+        import shutil
+        import tempfile
+        from os.path import join
+        from unittest.mock import patch
+        from metatab import MetatabDoc
+        from metapack import MetapackDoc
+
+        def op(pkg_dir):
+            return MetapackDoc(join(pkg_dir, 'metadata.csv'))
+
+        def walk(t):
+            return (t.join, str(t.value), t.args, t.section.name if t.section else None, t.row,
+                    [walk(c) for c in t.children])
+
+        with tempfile.TemporaryDirectory() as d:
+            pkg_dir = join(d, 'pkg')
+            shutil.copytree(test_data('packages', 'example.com-iterators'), pkg_dir)
+
+            parsed = op(pkg_dir)
+
+            # The second open loads from the cache, without parsing
+            with patch.object(MetatabDoc, 'load_terms', side_effect=AssertionError('parsed')):
+                cached = op(pkg_dir)
+
+            self.assertEqual([walk(t) for t in parsed.terms], [walk(t) for t in cached.terms])
+            self.assertEqual(list(parsed.sections), list(cached.sections))
+            self.assertEqual(parsed.decl_terms, cached.decl_terms)
+
+            r = cached.resource('data1')
+            self.assertIs(cached, r.doc)
+            self.assertIs(cached.root, r.parent)
+            self.assertEqual(list(parsed.resource('data1')), list(r))
+
+            # Changing the metadata file changes the key, so it is parsed again
+            mf = join(pkg_dir, 'metadata.csv')
+
+            with open(mf) as f:
+                text = f.read()
+
+            with open(mf, 'w') as f:
+                f.write(text.replace(parsed.find_first_value('Root.Title'), 'Changed Title'))
+
+            self.assertEqual('Changed Title', op(pkg_dir).find_first_value('Root.Title'))
+
+    def test_document_registry(self):
+        import shutil
+        import tempfile
+        from os.path import join
+        from metapack import Downloader, MetapackUrl, open_package as op
+        from metapack.registry import DocumentRegistry
+
+        registry = DocumentRegistry.get_instance()
+
+        with tempfile.TemporaryDirectory() as d:
+            pkg_dir = join(d, 'pkg')
+            shutil.copytree(test_data('packages', 'example.com-iterators'), pkg_dir)
+
+            doc = op(pkg_dir, shared=True)
+
+            self.assertIs(doc, op(join(pkg_dir, 'metadata.csv'), shared=True))
+            self.assertIs(doc, MetapackUrl(pkg_dir + '#data1', downloader=doc.downloader).doc)
+            self.assertIs(doc, MetapackUrl(pkg_dir + '#data1', downloader=doc.downloader).resource.doc)
+            self.assertIn(MetapackUrl(pkg_dir, downloader=doc.downloader), registry)
+            self.assertEqual(str(op(pkg_dir).package_url), str(doc.package_url))
+
+            # Sharing is opt in, and documents for a resource, or with another downloader, aren't shared
+            self.assertIsNot(doc, op(pkg_dir))
+            self.assertIsNot(doc, op(pkg_dir, downloader=Downloader(), shared=True))
+
+            d1 = op(pkg_dir + '#data1', shared=True)
+            d2 = op(pkg_dir + '#data2', shared=True)
+            self.assertIsNot(doc, d1)
+            self.assertEqual('data1', d1.resource().name)
+            self.assertEqual('data2', d2.resource().name)
+            self.assertIsNone(doc.default_resource)
+
+            registry.invalidate(MetapackUrl(pkg_dir, downloader=doc.downloader))
+            reopened = op(pkg_dir, shared=True)
+            self.assertIsNot(doc, reopened)
+
+            # A change to the metadata file is detected
+            mf = join(pkg_dir, 'metadata.csv')
+
+            with open(mf) as f:
+                text = f.read()
+
+            with open(mf, 'w') as f:
+                f.write(text.replace(reopened.find_first_value('Root.Title'), 'Changed Title'))
+
+            changed = op(pkg_dir, shared=True)
+            self.assertIsNot(reopened, changed)
+            self.assertEqual('Changed Title', changed.find_first_value('Root.Title'))
+
+        # Least recently used documents are evicted
+        small = DocumentRegistry(max_docs=1)
+        u1 = MetapackUrl(test_data('packages', 'example.com-iterators'), downloader=doc.downloader)
+        d1 = small.get(u1)
+        self.assertIs(d1, small.get(u1))
+
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copytree(test_data('packages', 'example.com-iterators'), join(d, 'pkg'))
+            small.get(MetapackUrl(join(d, 'pkg'), downloader=doc.downloader))
+
+            self.assertEqual(1, len(small))
+            self.assertNotIn(u1, small)
+            self.assertIsNot(d1, small.get(u1))
+
+    def test_lazy_sections(self):
+        from os.path import join
+        from metapack import MetapackDoc
+
+        mf = join(test_data('packages', 'example.com-iterators'), 'metadata.csv')
+
+        def walk(t):
+            return (t.join, str(t.value), t.args, t.section.name if t.section else None, t.row,
+                    t.term_value_name, [walk(c) for c in t.children])
+
+        full = MetapackDoc(mf)
+        lazy = MetapackDoc(mf, lazy=True)
+
+        self.assertEqual(full.name, lazy.name)
+        self.assertEqual([r.name for r in full.resources()], [r.name for r in lazy.resources()])
+        self.assertEqual([r.name for r in full.references()], [r.name for r in lazy.references()])
+        self.assertIsNotNone(lazy._deferred)
+
+        # The schema is loaded when it is needed
+        self.assertEqual(full.resource('data1').headers, lazy.resource('data1').headers)
+        self.assertIsNone(lazy._deferred)
+
+        self.assertEqual([walk(t) for t in full.terms], [walk(t) for t in lazy.terms])
+        self.assertEqual(list(full.sections), list(lazy.sections))
+
+        lazy = MetapackDoc(mf, lazy=True)
+        self.assertIn('Schema', lazy)
+        self.assertIsNone(lazy._deferred)
+
+        lazy = MetapackDoc(mf, lazy=True)
+        self.assertEqual(full.find_first_value('Root.Wrangler'), lazy.find_first_value('Root.Wrangler'))
+        self.assertIsNone(lazy._deferred)
+
+    def test_concurrent_iteration(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from os.path import join
+        from metapack import MetapackDoc
+        from metapack.terms import ResourceIterator
+
+        doc = open_package('example.com-iterators')
+        r = doc.resource('data1')
+
+        expected = list(r)
+
+        def run(i):
+            itr = iter(r)
+            self.assertIsInstance(itr, ResourceIterator)
+            return list(itr), itr.meta, itr.errors
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(run, range(16)))
+
+        for rows, meta, errors in results:
+            self.assertEqual(expected, rows)
+            self.assertEqual({}, errors)
+
+        # Threads that need the deferred sections of a lazy document load them once
+        mf = join(test_data('packages', 'example.com-iterators'), 'metadata.csv')
+        lazy = MetapackDoc(mf, lazy=True)
+        full = MetapackDoc(mf)
+
+        with ThreadPoolExecutor(8) as pool:
+            counts = list(pool.map(lambda i: len(lazy.find('Table.Column')), range(8)))
+
+        self.assertEqual([len(full.find('Table.Column'))] * 8, counts)
+        self.assertEqual(len(full.terms), len(lazy.terms))
+
+    def test_prefetch(self):
+        import tempfile
+        import threading
+        import time
+        from collections import Counter
+        from os.path import join
+        from metapack import Downloader, MetapackDoc
+
+        class RecordingDownloader(Downloader):
+            """Records downloads, and the most concurrent downloads from each host, without the network"""
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.lock = threading.Lock()
+                self.urls = []
+                self.active = Counter()
+                self.max_active = Counter()
+
+            def download(self, url):
+                from types import SimpleNamespace
+
+                host = url.netloc
+
+                with self.lock:
+                    self.urls.append(str(url.resource_url))
+                    self.active[host] += 1
+                    self.max_active[host] = max(self.max_active[host], self.active[host])
+
+                time.sleep(.05)
+
+                with self.lock:
+                    self.active[host] -= 1
+
+                if 'missing' in str(url):
+                    raise IOError('Not found')
+
+                return SimpleNamespace(sys_path='/cache/' + url.path.strip('/'))
+
+        rows = ['Declare,metatab-latest', 'Identifier,prefetch', 'Name,example.com-prefetch', '',
+                'Section,Resources,Name']
+        rows += ['Datafile,http://a.example.com/{}.csv,a{}'.format(i, i) for i in range(8)]
+        rows += ['Datafile,http://b.example.com/archive.zip#one.csv,one',
+                 'Datafile,http://b.example.com/archive.zip#two.csv,two',
+                 'Datafile,http://b.example.com/missing.csv,missing',
+                 'Datafile,data/local.csv,local', '',
+                 'Section,References,Name',
+                 'Reference,http://c.example.com/ref.csv,ref']
+
+        with tempfile.TemporaryDirectory() as d:
+            with open(join(d, 'metadata.csv'), 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+
+            doc = MetapackDoc(join(d, 'metadata.csv'))
+
+            dl = RecordingDownloader()
+            doc.downloader = dl
+            results = doc.prefetch(workers=8, per_host=2)
+
+            self.assertEqual(11, len(results))
+            self.assertEqual(sorted(results), sorted(dl.urls))
+            self.assertEqual(1, dl.urls.count('http://b.example.com/archive.zip'))
+            self.assertEqual('/cache/archive.zip', results['http://b.example.com/archive.zip'])
+            self.assertIsInstance(results['http://b.example.com/missing.csv'], IOError)
+            self.assertLessEqual(dl.max_active['a.example.com'], 2)
+
+            dl = RecordingDownloader()
+            doc.downloader = dl
+            results = doc.prefetch(include_references=False)
+
+            self.assertEqual(10, len(results))
+            self.assertNotIn('http://c.example.com/ref.csv', results)
 
 
 if __name__ == '__main__':